@@ -0,0 +1,319 @@
+import asyncio
+import json
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import protocol
+from particle import Decimator, ParticleSystem, density_grid, positions_to_dicts
+from simulation import Simulation, hot_changes
+
+
+def encode_json(positions):
+    """Кадр JSON для старых клиентов (в процессе пула: кодирование идет
+    на чистом Python и иначе держало бы GIL, задерживая остальные форматы)"""
+    return json.dumps(positions_to_dicts(positions)).encode()
+
+
+async def read_settings(reader):
+    """Настройки подписчика при подключении (как protocol.recv_settings):
+    сообщение с префиксом длины или JSON старого клиента без префикса"""
+    first = await reader.readexactly(1)
+    if first != b'{':
+        size_data = first + await reader.readexactly(3)
+        return json.loads(await reader.readexactly(int.from_bytes(size_data, byteorder='big')))
+    data = bytearray(first)
+    while True:
+        settings = protocol.parse_legacy_settings(data)
+        if settings is not None:
+            return settings
+        chunk = await reader.read(65536)
+        if not chunk:
+            raise ValueError("Соединение закрыто до конца настроек")
+        data += chunk
+
+
+class Subscriber:
+    """Подписчик на кадры общей симуляции с ограниченной очередью"""
+
+    def __init__(self, writer, encoding, options, flow, queue_size, budget=None, render=None):
+        self.writer = writer
+        self.encoding = encoding
+        self.options = options
+        self.budget = budget
+        self.render = render or protocol.parse_render(None)
+        self.flow = flow
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.sent = 0
+        self.dropped = 0
+
+    @property
+    def format_key(self):
+        """Ключ формата: подписчики с одинаковым ключом получают одни байты"""
+        return (self.encoding, tuple(sorted(self.options.items())), self.budget,
+                tuple(sorted(self.render.items())))
+
+    def offer(self, data):
+        """Постановка кадра в очередь; при переполнении выбрасывается самый старый"""
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(data)
+
+
+class AsyncServer:
+    """Сервер asyncio: много подписчиков на одну симуляцию.
+
+    Каждый кадр кодируется один раз для каждого различного формата, и
+    одни и те же байты раздаются всем подписчикам этого формата. Форматы
+    кодируются независимо: подписчики получают кадр, как только готов их
+    формат, а формат, не успевший закодировать предыдущий кадр,
+    пропускает текущий. У каждого подписчика своя ограниченная очередь:
+    медленный клиент теряет кадры, не задерживая остальных. Разностные
+    кадры здесь не используются - при потере кадров цепочка дельт была
+    бы нарушена.
+    """
+
+    def __init__(self, host='127.0.0.2', port=12345, queue_size=4):
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.simulation = None
+        self.settings = {}
+        self.broadcast_task = None
+        # Запуск, перезапуск и остановка симуляции - по одному за раз
+        self.simulation_lock = asyncio.Lock()
+        # Выборки частиц по форматам подписчиков и кодирование, идущее
+        # сейчас для каждого формата
+        self.decimators = {}
+        self.encoding = {}
+        self.skipped = 0
+        # Процесс для кадров JSON (создается с первым старым клиентом)
+        self.json_pool = None
+        self._pool_lock = threading.Lock()
+
+    def create_simulation(self, settings, previous=None):
+        """Остановка прежней и создание новой симуляции (в потоке исполнителя)"""
+        if previous:
+            previous.stop()
+        system = ParticleSystem.from_settings(settings)
+        simulation = Simulation(system, dt=0.01, rate=settings.get('step_rate', 100))
+        simulation.start()
+        print(f"Симуляция запущена: {len(system)} частиц")
+        return simulation
+
+    async def start_simulation(self, settings, restart=True):
+        """Запуск (или перезапуск) общей симуляции; без restart - только
+        если она еще не запущена"""
+        async with self.simulation_lock:
+            if self.simulation and not restart:
+                return
+            loop = asyncio.get_running_loop()
+            self.settings = dict(settings)
+            previous, self.simulation = self.simulation, None
+            self.simulation = await loop.run_in_executor(
+                None, self.create_simulation, settings, previous)
+
+    async def update_simulation(self, settings):
+        """Изменение настроек общей симуляции на ходу или перезапуск"""
+        changes = hot_changes(self.settings, settings)
+        if changes is None or not self.simulation:
+            await self.start_simulation(dict(self.settings, **settings))
+            return
+        if changes:
+            self.simulation.update(changes)
+        self.settings.update(settings)
+
+    async def stop_simulation(self):
+        """Остановка общей симуляции, если подписчиков не осталось"""
+        async with self.simulation_lock:
+            if self.subscribers or not self.simulation:
+                return
+            simulation, self.simulation = self.simulation, None
+            await asyncio.get_running_loop().run_in_executor(None, simulation.stop)
+            print("Симуляция остановлена: подписчиков нет")
+
+    @staticmethod
+    def take_snapshot(simulation, newer_than):
+        """Копия снимка новее newer_than (или None): кодирование форматов
+        идет дольше, чем буфер снимка принадлежит читателю"""
+        snapshot = simulation.snapshot.acquire(newer_than, 0.5)
+        if snapshot is None:
+            return None
+        return snapshot._replace(positions=snapshot.positions.copy())
+
+    def encode_format(self, snapshot, key):
+        """Кодирование кадра в одном формате (в потоке исполнителя)"""
+        encoding, options, budget, render = key
+        render = dict(render)
+        total = len(snapshot.positions)
+        encoder = protocol.FrameEncoder(**dict(options))
+        if render['mode'] == protocol.RENDER_DENSITY:
+            grid = density_grid(snapshot.positions, render['bins'],
+                                protocol.AXES.get(render['axis']))
+            return encoder.encode_density(snapshot.seq, grid, total)
+        # У каждого формата своя выборка: форматы кодируются параллельно
+        decimator = self.decimators.setdefault(key, Decimator(budget))
+        positions, _ = decimator.sample(snapshot.positions, snapshot.ids)
+        if encoding == protocol.ENCODING_BINARY:
+            return encoder.encode(snapshot.seq, positions, total=total)
+        with self._pool_lock:
+            if self.json_pool is None:
+                self.json_pool = ProcessPoolExecutor(
+                    1, mp_context=multiprocessing.get_context('spawn'))
+        # Поток исполнителя ждет процесс, не удерживая GIL
+        return self.json_pool.submit(encode_json, positions).result()
+
+    def deliver(self, key, future):
+        """Раздача кадра, готового в формате key, его подписчикам"""
+        if self.encoding.get(key) is future:
+            del self.encoding[key]
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            print(f"Ошибка кодирования кадра: {future.exception()}")
+            return
+        data = future.result()
+        for subscriber in list(self.subscribers):
+            if subscriber.format_key == key:
+                subscriber.offer(data)
+
+    async def broadcast(self):
+        """Раздача последних снимков всем подписчикам"""
+        loop = asyncio.get_running_loop()
+        simulation = None
+        last_seq = 0
+        while True:
+            if self.simulation is None:
+                await asyncio.sleep(0.05)
+                continue
+            if self.simulation is not simulation:
+                simulation = self.simulation
+                last_seq = 0
+
+            # Ожидание снимка и кодирование - вне цикла событий
+            snapshot = await loop.run_in_executor(
+                None, self.take_snapshot, simulation, last_seq)
+            if snapshot is None:
+                continue
+            last_seq = snapshot.seq
+
+            for key in {subscriber.format_key for subscriber in self.subscribers}:
+                if key in self.encoding:
+                    # Формат еще кодирует прошлый кадр: этот он пропускает
+                    self.skipped += 1
+                    continue
+                future = loop.run_in_executor(None, self.encode_format, snapshot, key)
+                self.encoding[key] = future
+                future.add_done_callback(lambda future, key=key: self.deliver(key, future))
+
+    async def send_frames(self, subscriber):
+        """Отправка кадров из очереди подписчика"""
+        while True:
+            data = await subscriber.queue.get()
+            subscriber.writer.write(len(data).to_bytes(4, byteorder='big'))
+            subscriber.writer.write(data)
+            await subscriber.writer.drain()
+            subscriber.sent += 1
+
+    async def read_control(self, reader, subscriber):
+        """Чтение сообщений подписчика до закрытия соединения"""
+        while True:
+            if subscriber.flow != protocol.FLOW_CREDIT:
+                # Старые клиенты присылают b'ACK' без префикса: просто читаем.
+                # Поток здесь ограничивает очередь, а не подтверждения
+                if not await reader.read(4096):
+                    return
+                continue
+
+            size_data = await reader.readexactly(4)
+            message = json.loads(await reader.readexactly(int.from_bytes(size_data, byteorder='big')))
+            kind = message.get('type')
+            if kind == 'settings':
+                print(f"Получены настройки: {message['settings']}")
+                await self.start_simulation(message['settings'])
+            elif kind == 'update':
+                print(f"Изменение настроек: {message['settings']}")
+                await self.update_simulation(message['settings'])
+            elif kind == 'render':
+                subscriber.render = protocol.parse_render(message.get('render'),
+                                                          subscriber.encoding)
+            elif kind == 'stop':
+                return
+
+    async def handle_client(self, reader, writer):
+        """Подключение подписчика"""
+        address = writer.get_extra_info('peername')
+        print(f"Accepted connection from {address}")
+        subscriber = None
+        try:
+            settings = await read_settings(reader)
+
+            encoding = protocol.choose_encoding(settings)
+            options = protocol.frame_options(settings)
+            options['keyframe_interval'] = 0
+            flow, window = protocol.choose_flow(settings)
+            subscriber = Subscriber(writer, encoding, options, flow, self.queue_size,
+                                    protocol.max_points(settings),
+                                    protocol.render_options(settings, encoding))
+
+            # Первый подписчик задает параметры общей симуляции
+            await self.start_simulation(settings, restart=False)
+
+            if 'protocol' in settings:
+                hello = json.dumps({
+                    'type': 'hello',
+                    'version': protocol.PROTOCOL_VERSION,
+                    'encoding': encoding,
+                    'frame': options,
+                    'flow': {'mode': flow, 'window': window},
+                    'max_points': subscriber.budget,
+                    'render': subscriber.render,
+                    'subscribers': len(self.subscribers) + 1
+                }).encode()
+                writer.write(len(hello).to_bytes(4, byteorder='big') + hello)
+                await writer.drain()
+
+            self.subscribers.add(subscriber)
+            sender = asyncio.create_task(self.send_frames(subscriber))
+            try:
+                await self.read_control(reader, subscriber)
+            finally:
+                sender.cancel()
+
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            print(f"Подписчик {address} отключен: {e}")
+        finally:
+            if subscriber:
+                self.subscribers.discard(subscriber)
+                print(f"Подписчик {address}: отправлено {subscriber.sent}, "
+                      f"пропущено {subscriber.dropped}")
+            writer.close()
+            await self.stop_simulation()
+
+    async def serve_forever(self):
+        """Запуск сервера"""
+        server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        print(f"Async server listening on {self.host}:{self.port}")
+        self.broadcast_task = asyncio.create_task(self.broadcast())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.broadcast_task.cancel()
+            if self.simulation:
+                self.simulation.stop()
+            if self.json_pool:
+                self.json_pool.shutdown(cancel_futures=True)
+
+
+def main():
+    """Запуск многоклиентского сервера"""
+    try:
+        asyncio.run(AsyncServer().serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
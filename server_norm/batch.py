@@ -0,0 +1,88 @@
+import argparse
+import json
+import time
+from checkpoint import Checkpointer, load_checkpoint
+from particle import ParticleSystem
+from trajectory import TrajectoryWriter
+
+
+def run_batch(settings, steps, every=1, dt=0.01, output='trajectory',
+              velocities=False, collide=False, dtype='float32',
+              checkpoint=None, checkpoint_every=0, resume=None):
+    """Расчет без сети и GUI с записью каждого every-го кадра в траекторию.
+
+    Записывается начальное состояние и состояние после каждых every
+    шагов. С checkpoint каждые checkpoint_every шагов (и в конце) в фоне
+    пишется контрольная точка; resume - продолжить с контрольной точки
+    (dt берется из нее). Возвращает словарь со временем расчета и
+    частотой шагов.
+    """
+    first_step = 0
+    if resume:
+        system, first_step, dt = load_checkpoint(resume)
+        print(f"Продолжение с {resume}: шаг {first_step}")
+    else:
+        system = ParticleSystem.from_settings(settings)
+    checkpointer = Checkpointer(checkpoint) if checkpoint else None
+    frames = steps // every + 1
+    metadata = {'settings': settings, 'dt': dt, 'every': every, 'steps': steps,
+                'collide': collide, 'first_step': first_step}
+    print(f"Частиц: {len(system)}, шагов: {steps}, кадров: {frames}, "
+          f"интегратор: {system.integrator}")
+
+    with TrajectoryWriter(output, frames, len(system), velocities=velocities,
+                          dtype=dtype, metadata=metadata) as writer:
+        writer.write(system)
+        start = time.perf_counter()
+        for step in range(1, steps + 1):
+            system.step(dt)
+            if collide:
+                system.collide()
+            if step % every == 0:
+                writer.write(system)
+            if checkpointer and checkpoint_every and step % checkpoint_every == 0:
+                checkpointer.submit(dict(system.state(), step=first_step + step, dt=dt))
+        elapsed = time.perf_counter() - start
+
+    if checkpointer:
+        checkpointer.submit(dict(system.state(), step=first_step + steps, dt=dt))
+        checkpointer.close()
+
+    rate = steps / elapsed if elapsed > 0 else float('inf')
+    print(f"Время расчета: {elapsed:.3f} с, {rate:.1f} шаг/с, "
+          f"траектория: {output}.*")
+    return {'seconds': elapsed, 'steps_per_second': rate, 'frames': frames}
+
+
+def main(argv=None):
+    """Пакетный запуск: python batch.py --steps 1000 --every 10 --output run"""
+    parser = argparse.ArgumentParser(description="Пакетный расчет без сети и GUI")
+    parser.add_argument('--settings', default='settings.json', help="файл настроек")
+    parser.add_argument('--steps', type=int, default=1000, help="число шагов")
+    parser.add_argument('--every', type=int, default=1, help="запись каждого K-го шага")
+    parser.add_argument('--dt', type=float, default=0.01, help="шаг по времени")
+    parser.add_argument('--output', default='trajectory', help="префикс файлов траектории")
+    parser.add_argument('--velocities', action='store_true', help="записывать скорости")
+    parser.add_argument('--collide', action='store_true', help="обрабатывать столкновения")
+    parser.add_argument('--dtype', choices=('float32', 'float64'), default='float32')
+    parser.add_argument('--seed', type=int, help="зерно ГСЧ (по умолчанию - из настроек)")
+    parser.add_argument('--checkpoint', help="файл контрольной точки (.npz)")
+    parser.add_argument('--checkpoint-every', type=int, default=0,
+                        help="контрольная точка каждые N шагов (0 - только в конце)")
+    parser.add_argument('--resume', help="продолжить с контрольной точки")
+    args = parser.parse_args(argv)
+    if args.steps < 0 or args.every < 1:
+        parser.error("steps >= 0 и every >= 1")
+
+    with open(args.settings, encoding='utf-8') as file:
+        settings = json.load(file)
+    if args.seed is not None:
+        settings['seed'] = args.seed
+    run_batch(settings, args.steps, every=args.every, dt=args.dt, output=args.output,
+              velocities=args.velocities, collide=args.collide, dtype=args.dtype,
+              checkpoint=args.checkpoint, checkpoint_every=args.checkpoint_every,
+              resume=args.resume)
+
+
+if __name__ == "__main__":
+    main()
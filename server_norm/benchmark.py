@@ -0,0 +1,476 @@
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+import protocol
+from particle import (ParticleSystem, find_collision_pairs, positions_to_dicts,
+                      select_disjoint_pairs)
+
+# Размеры по умолчанию: от 1e2 до 1e6 частиц
+DEFAULT_SIZES = (100, 1000, 10000, 100000, 1000000)
+# JSON-кадры дороже на порядки: для них только до 1e5 частиц
+JSON_MAX_SIZE = 100000
+# Регрессия - ухудшение больше чем на эту долю
+DEFAULT_THRESHOLD = 0.25
+
+# Форматы кадров для кодирования и передачи
+FRAME_FORMATS = {
+    'json': None,
+    'float32': {'dtype': 'float32'},
+    'uint16+zlib': {'dtype': 'uint16', 'compress': True},
+    'uint8+zlib+delta': {'dtype': 'uint8', 'compress': True, 'keyframe_interval': 30},
+}
+
+SETTINGS = {'temperature': 300, 'viscosity': 1e-3, 'size': 1e-6, 'mass': 1e-18}
+# Точки входа для замера холодного старта и тяжелые зависимости, которые
+# они не должны загружать при импорте
+STARTUP_MODULES = ('server', 'client', 'async_server', 'sessions', 'batch')
+HEAVY_MODULES = ('mpi4py', 'tkinter', 'matplotlib')
+
+# Шагов в секунду при замере передачи. Без ограничения поток физики
+# не отпускает GIL и публикация ждет интервала переключения потоков
+TRANSPORT_STEP_RATE = 1000
+
+
+def best_time(func, repeat=3):
+    """Лучшее время из нескольких запусков, с"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def steps_for(count, budget=1e6):
+    """Число повторов, чтобы замер занимал сопоставимое время при любом N"""
+    return int(min(100, max(3, budget // count)))
+
+
+def bench_creation(sizes=DEFAULT_SIZES, repeat=3):
+    """Создание частиц (координаты и распределение Максвелла) и время до
+    первого кадра: создание, шаг и кодирование всех координат"""
+    print(f"{'N':>10} {'время, с':>10} {'частиц/с':>12} {'1-й кадр, с':>12}")
+    results = []
+    for count in sizes:
+        settings = dict(SETTINGS, frequency=count, seed=0)
+        elapsed = best_time(lambda: ParticleSystem.from_settings(settings), repeat)
+
+        def first_frame():
+            system = ParticleSystem.from_settings(settings)
+            system.step(0.01)
+            protocol.FrameEncoder().encode(1, system.positions)
+
+        first = best_time(first_frame, repeat)
+        print(f"{count:>10} {elapsed:>10.4f} {count / elapsed:>12.0f} {first:>12.4f}")
+        results.append({'n': count, 'seconds': elapsed, 'particles_per_s': count / elapsed,
+                        'first_frame_seconds': first})
+    return results
+
+
+def bench_step(sizes=DEFAULT_SIZES, repeat=3):
+    """Частота шагов для обоих интеграторов"""
+    print(f"{'N':>10} {'интегратор':>11} {'шаг, мс':>9} {'шаг/с':>9}")
+    results = []
+    for count in sizes:
+        for integrator in ParticleSystem.INTEGRATORS:
+            system = ParticleSystem.from_settings(dict(SETTINGS, frequency=count,
+                                                       integrator=integrator))
+            system.step(0.01)  # кэш σ и буфер шума
+            steps = steps_for(count)
+
+            def run():
+                for _ in range(steps):
+                    system.step(0.01)
+
+            per_step = best_time(run, repeat) / steps
+            print(f"{count:>10} {integrator:>11} {per_step * 1000:>9.3f} {1 / per_step:>9.1f}")
+            results.append({'n': count, 'integrator': integrator, 'seconds': per_step,
+                            'steps_per_s': 1 / per_step})
+    return results
+
+
+def bench_collisions(sizes=DEFAULT_SIZES, radius=1e-3, seed=0, repeat=3):
+    """Стоимость поиска пар столкновений по сетке ячеек в зависимости от N"""
+    rng = np.random.default_rng(seed)
+    print(f"{'N':>10} {'пар':>8} {'время, с':>10} {'мкс/частицу':>12}")
+    results = []
+    for count in sizes:
+        positions = rng.random((count, 3))
+        radii = np.full(count, radius)
+        pairs = find_collision_pairs(positions, radii)
+
+        elapsed = best_time(lambda: select_disjoint_pairs(
+            find_collision_pairs(positions, radii), positions), repeat)
+        per_particle = elapsed / count * 1e6
+        print(f"{count:>10} {len(pairs):>8} {elapsed:>10.4f} {per_particle:>12.3f}")
+        results.append({'n': count, 'pairs': len(pairs), 'seconds': elapsed})
+    return results
+
+
+def bench_encoding(sizes=DEFAULT_SIZES, repeat=3):
+    """Кодирование и декодирование кадра в каждом формате"""
+    print(f"{'N':>10} {'формат':>18} {'байт':>11} {'код., мс':>9} {'декод., мс':>11}")
+    results = []
+    rng = np.random.default_rng(0)
+    for count in sizes:
+        positions = rng.random((count, 3)).astype(np.float32)
+        # Второй кадр - небольшое смещение, как между соседними шагами
+        moved = np.clip(positions + rng.normal(0, 1e-3, positions.shape), 0, 1).astype(np.float32)
+        for name, options in FRAME_FORMATS.items():
+            if options is None:
+                if count > JSON_MAX_SIZE:
+                    continue
+                encode = lambda: json.dumps(positions_to_dicts(moved)).encode()
+                payload = encode()
+                decode = lambda: json.loads(payload)
+            else:
+                encoder = protocol.FrameEncoder(**options)
+                keyframe = encoder.encode(0, positions)
+
+                def encode():
+                    encoder.reset()
+                    encoder.encode(0, positions)
+                    return encoder.encode(1, moved)
+
+                payload = encode()
+
+                def decode():
+                    decoder = protocol.FrameDecoder()
+                    decoder.decode(keyframe)
+                    return decoder.decode(payload)
+
+            encode_time = best_time(encode, repeat)
+            decode_time = best_time(decode, repeat)
+            if options and options.get('keyframe_interval'):
+                # В замер вошли опорный и разностный кадры: время на кадр
+                encode_time /= 2
+                decode_time /= 2
+            print(f"{count:>10} {name:>18} {len(payload):>11} "
+                  f"{encode_time * 1000:>9.2f} {decode_time * 1000:>11.2f}")
+            results.append({'n': count, 'format': name, 'frame_bytes': len(payload),
+                            'encode_seconds': encode_time, 'decode_seconds': decode_time})
+    return results
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def bench_transport(sizes=DEFAULT_SIZES, duration=2.0):
+    """Передача кадров локальным Server через loopback.
+
+    Пропускная способность - в режиме кредитов (окно 8 кадров), задержка -
+    в режиме ACK: время от подтверждения кадра до получения следующего.
+    Частота шагов физики - TRANSPORT_STEP_RATE (при большом N ее
+    ограничивает сам шаг).
+    """
+    from server import Server
+
+    port = free_port()
+    server = Server(host='127.0.0.1', port=port)
+    threading.Thread(target=server.start, daemon=True).start()
+    time.sleep(0.2)
+
+    print(f"{'N':>10} {'формат':>18} {'кадр/с':>8} {'МБ/с':>8} "
+          f"{'ACK p50, мс':>12} {'ACK p95, мс':>12}")
+    results = []
+    try:
+        for count in sizes:
+            for name, options in FRAME_FORMATS.items():
+                if options is None and count > JSON_MAX_SIZE:
+                    continue
+                row = {'n': count, 'format': name}
+                for flow in (protocol.FLOW_CREDIT, protocol.FLOW_ACK):
+                    row.update(transport_run(port, count, options, flow, duration))
+                print(f"{count:>10} {name:>18} {row['frames_per_s']:>8.1f} "
+                      f"{row['mb_per_s']:>8.1f} {row['latency_p50_ms']:>12.2f} "
+                      f"{row['latency_p95_ms']:>12.2f}")
+                results.append(row)
+    finally:
+        server.close()
+    return results
+
+
+def transport_run(port, count, options, flow, duration):
+    """Один прогон: подключение, рукопожатие и прием кадров duration секунд"""
+    encodings = [protocol.ENCODING_JSON] if options is None else [protocol.ENCODING_BINARY]
+    offer = protocol.protocol_offer(encodings, options,
+                                    flow={'mode': flow, 'window': protocol.DEFAULT_WINDOW})
+    settings = dict(SETTINGS, frequency=count, step_rate=TRANSPORT_STEP_RATE, protocol=offer)
+
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(10.0)
+        protocol.send_control(sock, settings)
+        hello = protocol.recv_control(sock)
+        window = hello['flow']['window']
+
+        frames = 0
+        received = 0
+        gaps = []
+        consumed = 0
+        start = time.perf_counter()
+        acknowledged = None
+        while time.perf_counter() - start < duration:
+            payload = protocol.recv_message(sock)
+            if payload is None:
+                break
+            if protocol.is_control_message(payload):
+                continue
+            now = time.perf_counter()
+            frames += 1
+            received += len(payload) + 4
+            if flow == protocol.FLOW_ACK:
+                if acknowledged is not None:
+                    gaps.append(now - acknowledged)
+                sock.sendall(b'ACK')
+                acknowledged = time.perf_counter()
+            else:
+                consumed += 1
+                if consumed >= max(1, window // 2):
+                    protocol.send_control(sock, {'type': 'credit', 'frames': consumed})
+                    consumed = 0
+        elapsed = time.perf_counter() - start
+
+        if flow == protocol.FLOW_CREDIT:
+            protocol.send_control(sock, {'type': 'stop'})
+            return {'frames_per_s': frames / elapsed, 'mb_per_s': received / elapsed / 1e6}
+        sock.sendall(b'STOP')
+        gaps = np.array(gaps or [np.nan]) * 1000
+        return {'latency_p50_ms': float(np.percentile(gaps, 50)),
+                'latency_p95_ms': float(np.percentile(gaps, 95))}
+
+
+def legacy_receive(sock):
+    """Прежний способ приема: recv по 4096 байт, список кусков и join"""
+    size_data = sock.recv(4)
+    msg_size = int.from_bytes(size_data, byteorder='big')
+    chunks = []
+    bytes_received = 0
+    while bytes_received < msg_size:
+        chunk = sock.recv(min(msg_size - bytes_received, 4096))
+        chunks.append(chunk)
+        bytes_received += len(chunk)
+    return b''.join(chunks)
+
+
+def bench_client_receive(frame_sizes=(12000, 1200000, 12000000), frames=50):
+    """Пропускная способность приема кадров клиентом, МБ/с"""
+    from client import Client
+
+    print(f"{'кадр, байт':>12} {'recv+join, МБ/с':>16} {'recv_into, МБ/с':>16}")
+    results = []
+    for frame_size in frame_sizes:
+        payload = bytes(frame_size)
+        rates = {}
+        for method in ('legacy', 'recv_into'):
+            sender_socket, receiver_socket = socket.socketpair()
+            client = Client()
+            client.client_socket = receiver_socket
+
+            def send():
+                for _ in range(frames):
+                    sender_socket.sendall(len(payload).to_bytes(4, byteorder='big'))
+                    sender_socket.sendall(payload)
+
+            sender = threading.Thread(target=send)
+            start = time.perf_counter()
+            sender.start()
+            for _ in range(frames):
+                if method == 'legacy':
+                    legacy_receive(receiver_socket)
+                else:
+                    client.receive_message()
+            elapsed = time.perf_counter() - start
+            sender.join()
+            sender_socket.close()
+            receiver_socket.close()
+            rates[method] = frame_size * frames / elapsed / 1e6
+
+        print(f"{frame_size:>12} {rates['legacy']:>16.1f} {rates['recv_into']:>16.1f}")
+        results.append({'frame_bytes': frame_size, 'legacy_mb_per_s': rates['legacy'],
+                        'recv_into_mb_per_s': rates['recv_into']})
+    return results
+
+
+def import_time(module):
+    """Импорт module в новом интерпретаторе с -X importtime.
+
+    Возвращает время импорта по отчету (мс), время до выхода процесса (с),
+    загруженные тяжелые зависимости и самые дорогие прямые импорты.
+    """
+    code = (f"import sys, {module}; "
+            f"print(' '.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))")
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                               cwd=os.path.dirname(os.path.abspath(__file__)),
+                               capture_output=True, text=True, check=True)
+    elapsed = time.perf_counter() - start
+
+    # Строки отчета: "import time: self | cumulative | <отступ>имя", отступ -
+    # два пробела на уровень вложенности
+    total = 0.0
+    children = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        if level == 0 and name.strip() == module:
+            total = int(cumulative) / 1000
+        elif level == 1:
+            children.append((int(cumulative) / 1000, name.strip()))
+    children.sort(reverse=True)
+    return total, elapsed, completed.stdout.split(), [name for _, name in children[:3]]
+
+
+def bench_startup(sizes=None, repeat=3):
+    """Холодный старт точек входа: время импорта (лучшее из repeat) и
+    тяжелые зависимости, загруженные без нужды (sizes не используется)"""
+    print(f"{'модуль':>13} {'импорт, мс':>11} {'процесс, мс':>12}  самые дорогие импорты")
+    results = []
+    for module in STARTUP_MODULES:
+        runs = [import_time(module) for _ in range(repeat)]
+        import_ms = min(run[0] for run in runs)
+        elapsed = min(run[1] for run in runs)
+        heavy, slowest = runs[-1][2], runs[-1][3]
+        print(f"{module:>13} {import_ms:>11.1f} {elapsed * 1000:>12.1f}  {', '.join(slowest)}")
+        if heavy:
+            print(f"{'':>13} ВНИМАНИЕ: загружены {', '.join(heavy)}")
+        results.append({'module': module, 'import_ms': import_ms, 'seconds': elapsed,
+                         'heavy': heavy, 'slowest': slowest})
+    return results
+
+
+STAGES = {
+    'creation': bench_creation,
+    'step': bench_step,
+    'collisions': bench_collisions,
+    'encoding': bench_encoding,
+    'transport': bench_transport,
+    'startup': bench_startup,
+}
+
+# Поля, по которым сопоставляются строки результатов
+KEY_FIELDS = ('n', 'integrator', 'format', 'frame_bytes', 'module')
+
+
+def metric_direction(name):
+    """+1 - чем больше, тем лучше; -1 - чем меньше, тем лучше; 0 - не метрика"""
+    if name.endswith('_per_s'):
+        return 1
+    if name == 'seconds' or name.endswith(('_seconds', '_ms')):
+        return -1
+    return 0
+
+
+def row_key(row):
+    return tuple((field, row[field]) for field in KEY_FIELDS
+                 if field in row and not (field == 'frame_bytes' and 'n' in row))
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """Сравнение с сохраненными результатами: список регрессий.
+
+    Регрессия - метрика хуже базовой больше чем на threshold (доля).
+    """
+    regressions = []
+    for stage, rows in results['results'].items():
+        base_rows = {row_key(row): row for row in baseline.get('results', {}).get(stage, [])}
+        for row in rows:
+            base = base_rows.get(row_key(row))
+            if base is None:
+                continue
+            for name, value in row.items():
+                direction = metric_direction(name)
+                old = base.get(name)
+                if not direction or not old or value is None or np.isnan(value):
+                    continue
+                # Относительное ухудшение: рост времени или падение частоты
+                change = (value - old) / old * -direction
+                if change > threshold:
+                    regressions.append({'stage': stage, 'key': dict(row_key(row)),
+                                        'metric': name, 'baseline': old, 'value': value,
+                                        'change': change})
+    return regressions
+
+
+def run(stages, sizes, repeat=3):
+    """Запуск выбранных этапов; результат готов к сохранению в JSON"""
+    results = {}
+    for stage in stages:
+        print(f"\n== {stage} ==")
+        bench = STAGES[stage]
+        if stage == 'transport':
+            results[stage] = bench(sizes)
+        else:
+            results[stage] = bench(sizes, repeat=repeat)
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor() or platform.machine(),
+            'sizes': list(sizes),
+        },
+        'results': results,
+    }
+
+
+def main(argv=None):
+    """python benchmark.py [этапы] [--sizes ...] [--json out.json] [--compare base.json]"""
+    parser = argparse.ArgumentParser(description="Замеры производительности по этапам")
+    parser.add_argument('stages', nargs='*',
+                        help=f"этапы: {', '.join(STAGES)}, receive (по умолчанию все, кроме receive)")
+    parser.add_argument('--sizes', type=float, nargs='+', help="числа частиц")
+    parser.add_argument('--repeat', type=int, default=3, help="повторов замера")
+    parser.add_argument('--json', help="сохранить результаты в файл JSON")
+    parser.add_argument('--compare', help="сравнить с сохраненными результатами")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="допустимое ухудшение (доля)")
+    args = parser.parse_args(argv)
+
+    if args.stages == ['receive']:
+        bench_client_receive([int(size) for size in args.sizes] if args.sizes
+                             else (12000, 1200000, 12000000))
+        return 0
+
+    stages = args.stages or list(STAGES)
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        parser.error(f"неизвестные этапы: {', '.join(unknown)}")
+    sizes = [int(size) for size in args.sizes] if args.sizes else list(DEFAULT_SIZES)
+
+    results = run(stages, sizes, args.repeat)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты сохранены в {args.json}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.threshold)
+        print(f"\nСравнение с {args.compare} (порог {args.threshold:.0%}):")
+        for item in regressions:
+            key = ', '.join(f"{name}={value}" for name, value in item['key'].items())
+            print(f"  РЕГРЕССИЯ {item['stage']} [{key}] {item['metric']}: "
+                  f"{item['baseline']:.4g} -> {item['value']:.4g} (+{item['change']:.0%})")
+        if regressions:
+            return 1
+        print("  регрессий нет")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+import json
+import os
+import threading
+import numpy as np
+from particle import ParticleSystem
+
+# Контрольная точка - файл .npz без сжатия и без pickle: массивы частиц
+# плюс строка JSON 'meta' (параметры среды, состояние ГСЧ, шаг, dt)
+CHECKPOINT_VERSION = 1
+ARRAYS = ('positions', 'velocities', 'radii', 'masses', 'ids')
+
+
+def save_checkpoint(path, state):
+    """Атомарная запись состояния: во временный файл, fsync, затем замена.
+
+    При сбое во время записи на диске остается предыдущая контрольная точка.
+    """
+    meta = {key: value for key, value in state.items() if key not in ARRAYS}
+    meta['version'] = CHECKPOINT_VERSION
+    arrays = {key: state[key] for key in ARRAYS}
+
+    temporary = f"{path}.tmp"
+    with open(temporary, 'wb') as file:
+        np.savez(file, meta=np.array(json.dumps(meta)), **arrays)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+
+def load_checkpoint(path):
+    """Загрузка контрольной точки: (система, номер шага, dt)"""
+    with np.load(path, allow_pickle=False) as data:
+        meta = json.loads(str(data['meta']))
+        if meta.get('version', 0) > CHECKPOINT_VERSION:
+            raise ValueError(f"Неподдерживаемая версия контрольной точки: {meta['version']}")
+        state = dict(meta, **{key: data[key] for key in ARRAYS})
+    return ParticleSystem.from_state(state), int(meta.get('step', 0)), float(meta['dt'])
+
+
+class Checkpointer:
+    """Фоновая запись контрольных точек.
+
+    submit() только передает уже снятое состояние потоку записи и сразу
+    возвращается, поэтому шаги не ждут диска. Если поток еще пишет
+    предыдущую точку, ожидающая заменяется более новой.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.written = 0
+        self.last_step = None
+        self._condition = threading.Condition()
+        self._pending = None
+        self._running = True
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, state):
+        """Постановка состояния в очередь на запись"""
+        with self._condition:
+            self._pending = state
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending is not None or not self._running)
+                state, self._pending = self._pending, None
+            if state is None:
+                return
+            try:
+                save_checkpoint(self.path, state)
+                self.written += 1
+                self.last_step = state.get('step')
+            except OSError as e:
+                print(f"Ошибка записи контрольной точки {self.path}: {e}")
+
+    def close(self):
+        """Запись ожидающей точки и остановка потока"""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
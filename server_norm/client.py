@@ -1,15 +1,50 @@
 import socket
-import tkinter as tk
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import threading
 import ast
 import json
-from gui import SimulationGUI
+import numpy as np
+import protocol
+from shared_frames import SharedFrameMailbox
 import time
 
+# Таймаут чтения, с: поток приема между кадрами проверяет, не остановлен ли
+# клиент; внутри кадра таймаут лишь продлевает ожидание
+READ_TIMEOUT = 1.0
+# Ответ receive_message, если сервер за READ_TIMEOUT не начал новое сообщение
+NO_MESSAGE = object()
+
+class FrameMailbox:
+    """Последний принятый кадр для потока Tk.
+
+    Поток приема кладет кадр, заменяя неотрисованный предыдущий (он
+    считается пропущенным); GUI забирает кадр по таймеру root.after.
+    Поток приема не трогает matplotlib/Tk и не ждет отрисовки.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._frame = None
+        self.received = 0
+        self.dropped = 0
+
+    def put(self, frame):
+        """Новый кадр (вызывается потоком приема)"""
+        with self._lock:
+            if self._frame is not None:
+                self.dropped += 1
+            self._frame = frame
+            self.received += 1
+
+    def take(self):
+        """Последний кадр или None, если нового кадра нет"""
+        with self._lock:
+            frame, self._frame = self._frame, None
+            return frame
+
+
 class Client:
-    def __init__(self, server_host='127.0.0.2', server_port=12345):
+    def __init__(self, server_host='127.0.0.2', server_port=12345, frame_options=None, session=None,
+                 transport=None):
         self.server_host = server_host
         self.server_port = server_port
         self.client_socket = None
@@ -17,6 +52,43 @@ class Client:
         self.running = False
         self.receive_thread = None
         self.gui = None  # Ссылка на GUI
+        # Кодировки кадров, предлагаемые серверу (по порядку предпочтения)
+        self.encodings = [protocol.ENCODING_BINARY, protocol.ENCODING_JSON]
+        self.encoding = protocol.ENCODING_JSON  # до ответа сервера
+        # Параметры бинарных кадров, например {'dtype': 'uint16', 'compress': True,
+        # 'keyframe_interval': 30}; None - float32 без сжатия
+        self.frame_options = frame_options
+        self.decoder = protocol.FrameDecoder()
+        # Управление потоком: запрашиваем кредит на window кадров вместо
+        # подтверждения каждого кадра; до ответа сервера - режим ACK
+        self.window = protocol.DEFAULT_WINDOW
+        self.flow = protocol.FLOW_ACK
+        self.consumed_frames = 0
+        # Наибольшее число точек в кадре (None - все частицы) и полное
+        # число частиц по последнему кадру
+        self.max_points = None
+        self.total_particles = 0
+        # Режим отображения: None - точки, иначе, например,
+        # {'mode': 'density', 'axis': 'z', 'bins': 128}
+        self.render = None
+        # Положение воспроизведения записи (последнее сообщение сервера)
+        self.replay_state = None
+        # Время фаз на сервере (последнее сообщение 'stats')
+        self.server_stats = None
+        # Сводки профиля сервера (по одной на ранг) и команда, ожидающая
+        # отправки вместо ACK в режиме подтверждений
+        self.profile = None
+        self.pending_command = None
+        # Сессия на сервере сессий: None или 'new' - новая, иначе идентификатор
+        self.session = session
+        # Переиспользуемые буферы приема
+        self.size_buffer = bytearray(4)
+        self.receive_buffer = bytearray(64 * 1024)
+        # Кадры для GUI: отрисовку ведет главный поток Tk
+        self.mailbox = FrameMailbox()
+        # Желаемый транспорт кадров (protocol.TRANSPORT_SHM - разделяемая
+        # память, если сервер на этой же машине); None - сокет
+        self.transport = transport
 
     def set_gui(self, gui):
         """Установка ссылки на GUI"""
@@ -26,7 +98,11 @@ class Client:
         """Подключение к серверу."""
         try:
             self.client_socket = socket.create_connection((self.server_host, self.server_port), timeout=2)
+            # Таймаут 2 с - только на подключение: медленный кадр не должен
+            # закрывать соединение
+            self.client_socket.settimeout(READ_TIMEOUT)
             self.connected = True
+            self.flow = protocol.FLOW_ACK
             print("Connected to server.")
             return True
         except (socket.timeout, socket.error) as e:
@@ -50,9 +126,20 @@ class Client:
                 json.dump(settings, file, ensure_ascii=False, indent=4)
                 print("Настройки сохранены в settings.json")
 
-            # Отправка настроек на сервер
-            settings_data = json.dumps(settings)
-            self.client_socket.sendall(settings_data.encode())
+            if self.flow == protocol.FLOW_CREDIT:
+                # После рукопожатия в режиме кредитов - управляющим сообщением
+                protocol.send_control(self.client_socket, {'type': 'settings', 'settings': settings})
+            else:
+                # Отправка настроек на сервер вместе с предложением протокола
+                offer = protocol.protocol_offer(
+                    self.encodings, self.frame_options,
+                    flow={'mode': protocol.FLOW_CREDIT, 'window': self.window},
+                    max_points=self.max_points, render=self.render,
+                    transport=self.transport)
+                message = dict(settings, protocol=offer)
+                if self.session:
+                    message['session'] = self.session
+                protocol.send_control(self.client_socket, message)
             print(f"Настройки отправлены на сервер: {settings}") 
             return True
 
@@ -60,28 +147,72 @@ class Client:
             print(f"Ошибка при сохранении настроек: {e}")
             return False
 
+
+    def update_settings(self, settings):
+        """Изменение параметров работающей симуляции без ее перезапуска.
+
+        В режиме кредитов сервер применяет изменения на ходу и не прерывает
+        поток кадров; до рукопожатия и у старых серверов - send_settings.
+        """
+        if not self.connected or self.flow != protocol.FLOW_CREDIT:
+            return self.send_settings(settings)
+        try:
+            with open('settings.json', 'w', encoding='utf-8') as file:
+                json.dump(settings, file, ensure_ascii=False, indent=4)
+            protocol.send_control(self.client_socket, {'type': 'update', 'settings': settings})
+            print(f"Изменение настроек отправлено на сервер: {settings}")
+            return True
+        except Exception as e:
+            print(f"Ошибка при изменении настроек: {e}")
+            return False
+
+    def recv_exact_into(self, view):
+        """Заполнение view целиком данными из сокета (False, если соединение закрыто)"""
+        received = 0
+        while received < len(view):
+            try:
+                count = self.client_socket.recv_into(view[received:])
+            except socket.timeout:
+                # Сервер задерживает начатое сообщение: ждем, пока клиент работает
+                if self.running:
+                    continue
+                raise
+            if not count:
+                return False
+            received += count
+        return True
+
     def receive_message(self):
-        """Получение полного сообщения от сервера"""
+        """Получение полного сообщения от сервера.
+
+        Сообщение читается через recv_into прямо в переиспользуемый буфер,
+        который растет по мере необходимости. Возвращается memoryview на
+        буфер - он действителен только до следующего вызова (сообщение
+        может быть и пустым); None - соединение закрыто, NO_MESSAGE -
+        сервер еще не начал новое сообщение.
+        """
         try:
-            # Получаем размер сообщения
-            size_data = self.client_socket.recv(4)
-            if not size_data or len(size_data) != 4:
+            # Получаем размер сообщения; таймаут здесь значит лишь, что сервер
+            # пока не прислал кадр (например, процесс сессии еще запускается)
+            try:
+                count = self.client_socket.recv_into(self.size_buffer)
+            except socket.timeout:
+                return NO_MESSAGE
+            if not count or not self.recv_exact_into(memoryview(self.size_buffer)[count:]):
                 return None
                 
-            msg_size = int.from_bytes(size_data, byteorder='big')
+            msg_size = int.from_bytes(self.size_buffer, byteorder='big')
             
+            # Новый буфер вместо расширения: на старый могут ссылаться
+            # массивы предыдущего кадра
+            if msg_size > len(self.receive_buffer):
+                self.receive_buffer = bytearray(max(msg_size, 2 * len(self.receive_buffer)))
+
             # Получаем само сообщение
-            chunks = []
-            bytes_received = 0
-            
-            while bytes_received < msg_size:
-                chunk = self.client_socket.recv(min(msg_size - bytes_received, 4096))
-                if not chunk:
-                    return None
-                chunks.append(chunk)
-                bytes_received += len(chunk)
-            
-            return b''.join(chunks).decode()
+            message = memoryview(self.receive_buffer)[:msg_size]
+            if not self.recv_exact_into(message):
+                return None
+            return message
             
         except Exception as e:
             print(f"Ошибка при получении сообщения: {e}")
@@ -93,30 +224,28 @@ class Client:
             try:
                 # Получаем данные
                 data = self.receive_message()
-                if not data:
+                if data is NO_MESSAGE:
+                    continue
+                if data is None:
                     print("Соединение закрыто сервером")
                     break
+                if not len(data):
+                    continue
 
-                # Парсим JSON
-                coordinates = json.loads(data)
-                
-                # Проверяем валидность данных
-                if not coordinates or not isinstance(coordinates, list):
+                # Управляющие сообщения сервера (ответ на рукопожатие и т.п.)
+                if protocol.is_control_message(data):
+                    self.handle_control(json.loads(bytes(data)))
                     continue
+
+                frame = self.decode_frame(data)
+
+                # Передаем кадр GUI; буфер приема будет перезаписан следующим кадром
+                if frame is not None:
+                    self.mailbox.put(protocol.detach_frame(frame))
                     
-                # Проверяем наличие всех необходимых координат
-                valid_coordinates = []
-                for coord in coordinates:
-                    if all(key in coord for key in ['x', 'y', 'z']):
-                        valid_coordinates.append(coord)
-                
-                # Обновляем график только если есть валидные координаты
-                if valid_coordinates and self.gui:
-                    self.gui.update_plot(valid_coordinates)
-                    
-                # Подтверждаем получение данных
+                # Подтверждаем получение данных или продлеваем кредит
                 try:
-                    self.client_socket.sendall(b'ACK')
+                    self.acknowledge_frame()
                 except:
                     pass
                     
@@ -134,10 +263,113 @@ class Client:
             except:
                 pass
 
+    def acknowledge_frame(self):
+        """ACK на каждый кадр или новый кредит после половины окна"""
+        if self.flow != protocol.FLOW_CREDIT:
+            command, self.pending_command = self.pending_command, None
+            if command:
+                # Сервер без канала управления принимает команду вместо ACK
+                protocol.send_control(self.client_socket, command)
+            else:
+                self.client_socket.sendall(b'ACK')
+            return
+        self.consumed_frames += 1
+        if self.consumed_frames >= max(1, self.window // 2):
+            protocol.send_control(self.client_socket, {'type': 'credit', 'frames': self.consumed_frames})
+            self.consumed_frames = 0
+
+    def handle_control(self, message):
+        """Обработка управляющего сообщения сервера"""
+        if message.get('type') == 'hello':
+            self.encoding = message.get('encoding', protocol.ENCODING_JSON)
+            self.decoder = protocol.FrameDecoder()
+            flow = message.get('flow') or {}
+            self.flow = flow.get('mode', protocol.FLOW_ACK)
+            self.window = flow.get('window', self.window)
+            self.consumed_frames = 0
+            self.session = message.get('session', self.session)
+            self.use_transport(message.get('transport') or {})
+            print(f"Согласован формат кадров: {self.encoding} {message.get('frame', {})}")
+            if self.session:
+                print(f"Сессия: {self.session}")
+        elif message.get('type') == 'replay':
+            self.replay_state = message
+        elif message.get('type') == 'shm':
+            if isinstance(self.mailbox, SharedFrameMailbox):
+                self.mailbox.attach(message['name'])
+        elif message.get('type') == 'stats':
+            self.server_stats = message
+        elif message.get('type') == 'profile':
+            from profiler import format_profile
+            self.profile = message.get('profiles', [])
+            for summary in self.profile:
+                print(format_profile(summary))
+        elif message.get('type') == 'sessions':
+            print(f"Сессии на сервере: {message.get('sessions')}")
+        elif message.get('type') == 'error':
+            print(f"Ошибка сервера: {message.get('message')}")
+
+    def use_transport(self, transport):
+        """Кадры из сокета или из кольца сервера в разделяемой памяти"""
+        previous = self.mailbox
+        if transport.get('mode') == protocol.TRANSPORT_SHM and transport.get('name'):
+            self.mailbox = SharedFrameMailbox(transport['name'])
+            print(f"Кадры через разделяемую память: {transport['name']}")
+        elif isinstance(previous, SharedFrameMailbox):
+            self.mailbox = FrameMailbox()
+        else:
+            return
+        if isinstance(previous, SharedFrameMailbox):
+            previous.close()
+
+    def set_render(self, render):
+        """Смена режима отображения (на лету, если сервер принимает
+        управляющие сообщения, иначе - при следующем подключении)"""
+        self.render = render
+        if self.connected and self.flow == protocol.FLOW_CREDIT:
+            protocol.send_control(self.client_socket, {'type': 'render', 'render': render})
+
+    def control_replay(self, **changes):
+        """Управление воспроизведением: seek (номер кадра), speed, skip, paused"""
+        if self.connected and self.flow == protocol.FLOW_CREDIT:
+            protocol.send_control(self.client_socket, dict(changes, type='replay'))
+
+    def request_profile(self, action, top=None, sort=None):
+        """Окно профилирования сервера: action 'start' или 'stop'
+        (сводка придет сообщением 'profile')"""
+        command = {'type': 'profile', 'action': action}
+        if top is not None:
+            command['top'] = top
+        if sort is not None:
+            command['sort'] = sort
+        if self.flow == protocol.FLOW_CREDIT:
+            protocol.send_control(self.client_socket, command)
+        else:
+            self.pending_command = command
+
+    def decode_frame(self, data):
+        """Кадр (protocol.Frame): координаты (N, 3) или сетка плотности"""
+        if protocol.is_binary_frame(data):
+            frame = self.decoder.decode(data)
+            self.total_particles = frame.total
+            return frame
+
+        # Кадр в старом формате JSON: список словарей {'x','y','z'}
+        coordinates = json.loads(bytes(data))
+        if not coordinates or not isinstance(coordinates, list):
+            return None
+        valid_coordinates = [
+            (coord['x'], coord['y'], coord['z']) for coord in coordinates
+            if all(key in coord for key in ['x', 'y', 'z'])
+        ]
+        positions = np.array(valid_coordinates, dtype=np.float32).reshape(-1, 3)
+        self.total_particles = len(positions)
+        return protocol.Frame(0, positions, None, len(positions))
+
     def update_plot(self, coordinates):
-        """Обновление графика через GUI"""
-        if self.gui:
-            self.gui.update_plot(coordinates)
+        """Передача координат GUI (отрисуются в главном потоке Tk)"""
+        coordinates = np.asarray(coordinates, dtype=np.float32).reshape(-1, 3)
+        self.mailbox.put(protocol.Frame(0, coordinates, None, len(coordinates)))
 
     def start_simulation(self):
         """Запуск симуляции"""
@@ -163,18 +395,23 @@ class Client:
     def stop_simulation(self):
         """Остановка симуляции"""
         try:
-            self.running = False
-            if self.receive_thread:
-                self.receive_thread.join(timeout=1.0)
-                self.receive_thread = None
-                
-            if self.client_socket:
+            # Команду остановки отправляем до завершения потока приема,
+            # который при выходе закрывает сокет
+            if self.client_socket and self.connected:
                 try:
                     # Отправляем команду остановки
-                    self.client_socket.sendall(b'STOP')
+                    if self.flow == protocol.FLOW_CREDIT:
+                        protocol.send_control(self.client_socket, {'type': 'stop'})
+                    else:
+                        self.client_socket.sendall(b'STOP')
                     print("Команда остановки отправлена")
                 except:
                     pass
+
+            self.running = False
+            if self.receive_thread:
+                self.receive_thread.join(timeout=1.0)
+                self.receive_thread = None
                     
             print("Симуляция остановлена")
             return True
@@ -186,11 +423,15 @@ class Client:
     def close(self):
         """Закрытие соединения с сервером"""
         self.stop_simulation()
+        if isinstance(self.mailbox, SharedFrameMailbox):
+            self.mailbox.close()
         if self.client_socket:
             self.client_socket.close()
             print("Connection closed.")
 
 if __name__ == "__main__":
+    # Стек GUI (tkinter, matplotlib) нужен только при запуске с окном
+    from gui import SimulationGUI
     client = Client()
     gui = SimulationGUI(client)
     # Устанавливаем GUI объект в клиенте
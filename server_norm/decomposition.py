@@ -0,0 +1,141 @@
+import numpy as np
+from particle import find_collision_pairs, select_disjoint_pairs
+
+
+class SlabDecomposition:
+    """Разбиение единичного куба на слои вдоль одной оси между рангами MPI.
+
+    Ранг r владеет частицами с координатой axis в [r/size, (r+1)/size).
+    После каждого шага частицы, покинувшие свой слой, мигрируют к
+    рангу-владельцу; пары столкновений через границу слоя решает один
+    из двух соседних рангов (см. collide).
+    """
+
+    def __init__(self, comm, axis=0):
+        self.comm = comm
+        self.rank = comm.Get_rank()
+        self.size = comm.Get_size()
+        self.axis = axis
+
+        # Границы собственного слоя
+        self.low = self.rank / self.size
+        self.high = (self.rank + 1) / self.size
+
+        # Соседи по оси разбиения (у стенок куба соседей нет); mpi4py
+        # загружается здесь, а не при импорте модуля (импорт инициализирует MPI)
+        from mpi4py import MPI
+        self.lower_neighbour = self.rank - 1 if self.rank > 0 else MPI.PROC_NULL
+        self.upper_neighbour = self.rank + 1 if self.rank < self.size - 1 else MPI.PROC_NULL
+
+    def bounds(self):
+        """Нижний и верхний углы собственной подобласти"""
+        low = np.zeros(3)
+        high = np.ones(3)
+        low[self.axis] = self.low
+        high[self.axis] = self.high
+        return low, high
+
+    def local_count(self, total):
+        """Доля общего числа частиц, создаваемая на этом ранге"""
+        return total // self.size + (1 if self.rank < total % self.size else 0)
+
+    def owner(self, positions):
+        """Ранг-владелец для каждой частицы"""
+        owners = (positions[:, self.axis] * self.size).astype(np.int64)
+        return np.clip(owners, 0, self.size - 1)
+
+    def migrate(self, system):
+        """Передача частиц, покинувших слой, их новым владельцам.
+
+        Возвращает число частиц, полученных от других рангов.
+        """
+        owners = self.owner(system.positions)
+        leaving = owners != self.rank
+
+        # Упаковываем уходящие частицы, сгруппировав по получателю
+        destinations = owners[leaving]
+        order = np.argsort(destinations, kind='stable')
+        send_rows = np.ascontiguousarray(system.pack(leaving)[order])
+        system.remove(leaving)
+
+        width = system.PACKED_WIDTH
+        send_counts = np.bincount(destinations, minlength=self.size).astype(np.int64) * width
+        recv_counts = np.empty(self.size, dtype=np.int64)
+        self.comm.Alltoall(send_counts, recv_counts)
+
+        send_displs = np.cumsum(send_counts) - send_counts
+        recv_displs = np.cumsum(recv_counts) - recv_counts
+        recv_rows = np.empty((int(recv_counts.sum()) // width, width))
+        from mpi4py import MPI
+        self.comm.Alltoallv([send_rows, (send_counts, send_displs), MPI.DOUBLE],
+                            [recv_rows, (recv_counts, recv_displs), MPI.DOUBLE])
+
+        system.add_packed(recv_rows)
+        return len(recv_rows)
+
+    def _shift(self, rows, dest, source):
+        """Отправка строк dest и прием строк от source (сначала размеры)"""
+        send_count = np.array([len(rows)], dtype=np.int64)
+        recv_count = np.zeros(1, dtype=np.int64)
+        self.comm.Sendrecv(send_count, dest=dest, recvbuf=recv_count, source=source)
+
+        received = np.empty((int(recv_count[0]), rows.shape[1]))
+        self.comm.Sendrecv(np.ascontiguousarray(rows), dest=dest,
+                           recvbuf=received, source=source)
+        return received
+
+    def collide(self, system, width):
+        """Столкновения собственных частиц, в том числе через границы слоя.
+
+        Сначала пары внутри слоя. Затем каждую границу решает только
+        нижний из двух рангов: верхний присылает ему свободные частицы
+        полосы width у границы и получает обратно новые скорости тех из
+        них, что столкнулись. Так обе стороны применяют одно и то же
+        решение, и скорости не теряются и не дублируются. Границы
+        обрабатываются в два прохода (четные, затем нечетные нижние
+        ранги), чтобы частица тонкого слоя не попала в пары у обеих
+        границ сразу. Возвращает число пар с участием частиц этого ранга.
+        """
+        pairs = system.collide()
+        free = np.ones(len(system), dtype=bool)
+        free[pairs.ravel()] = False
+        count = len(pairs)
+        for parity in (0, 1):
+            count += self._collide_boundary(system, width, free, parity)
+        return count
+
+    def _collide_boundary(self, system, width, free, parity):
+        """Пары через границы, нижний ранг которых имеет четность parity"""
+        from mpi4py import MPI
+        coordinate = system.positions[:, self.axis]
+        packed = np.empty((0, system.PACKED_WIDTH))
+
+        if self.rank > 0 and (self.rank - 1) % 2 == parity:
+            # Верхняя сторона границы: кандидаты уходят нижнему рангу,
+            # обратно приходят (номер кандидата, новая скорость)
+            mask = free & (coordinate < self.low + width)
+            candidates = np.nonzero(mask)[0]
+            self._shift(system.pack(mask), self.lower_neighbour, MPI.PROC_NULL)
+            result = self._shift(np.empty((0, 4)), MPI.PROC_NULL, self.lower_neighbour)
+            collided = candidates[result[:, 0].astype(np.int64)]
+            system.velocities[collided] = result[:, 1:4]
+            free[collided] = False
+            return len(collided)
+
+        if self.upper_neighbour != MPI.PROC_NULL and self.rank % 2 == parity:
+            # Нижняя сторона: решение по своим и присланным частицам полосы
+            others = self._shift(packed, MPI.PROC_NULL, self.upper_neighbour)
+            own = np.nonzero(free & (coordinate >= self.high - width))[0]
+            positions = np.concatenate([system.positions[own], others[:, 0:3]])
+            radii = np.concatenate([system.radii[own], others[:, 6]])
+            pairs = find_collision_pairs(positions, radii)
+            pairs = select_disjoint_pairs(pairs[(pairs[:, 0] < len(own))
+                                                & (pairs[:, 1] >= len(own))], positions)
+            mine = own[pairs[:, 0]]
+            theirs = pairs[:, 1] - len(own)
+            result = np.column_stack([theirs, system.velocities[mine]])
+            system.velocities[mine] = others[theirs, 3:6]
+            free[mine] = False
+            self._shift(result, self.upper_neighbour, MPI.PROC_NULL)
+            return len(mine)
+        return 0
@@ -9,9 +9,30 @@ import ast
 import matplotlib
 import math
 import time
+import numpy as np
+from profiler import format_profile
 matplotlib.use('TkAgg')  # Установка backend перед импортом pyplot
 #from client import Client
 
+# Режимы отображения: ось проекции для сетки плотности (None - точки)
+RENDER_MODES = {
+    'Точки': None,
+    'Плотность XY': 'z',
+    'Плотность XZ': 'y',
+    'Плотность YZ': 'x',
+}
+DENSITY_RESOLUTIONS = ['64', '128', '256', '512']
+# Фазы сервера в панели лога: имя в сообщении 'stats' и подпись
+SERVER_PHASES = [
+    ('step_ms', 'шаг'),
+    ('collide_ms', 'столкновения'),
+    ('read_ms', 'чтение кадра'),
+    ('encode_ms', 'кодирование'),
+    ('send_ms', 'отправка'),
+    ('ack_wait_ms', 'ожидание ACK'),
+    ('credit_wait_ms', 'ожидание кредита'),
+]
+
 
 class SimulationGUI:
     def __init__(self, client):
@@ -24,6 +45,11 @@ class SimulationGUI:
         self.animation_running = False
         self.last_frame_time = 0
         self.frame_interval = 33  # ~30 FPS в миллисекундах
+
+        # Больше точек scatter не успевает рисовать: сервер присылает
+        # устойчивую выборку частиц, а полное число показывается в заголовке
+        self.max_points = 10000
+        client.max_points = self.max_points
         
         # Сохраняем текущий размер окна для отслеживания изменений
         self.current_width = self.root.winfo_width()
@@ -60,6 +86,9 @@ class SimulationGUI:
         # Привязываем обработчик изменения размера окна
         self.root.bind('<Configure>', self.on_window_resize)
         
+        # Кадры из потока приема забираются таймером главного потока
+        self.root.after(self.frame_interval, self.poll_frames)
+        
         # Сохраняем базовый размер шрифта
         self.base_font_size = 10
         
@@ -121,6 +150,68 @@ class SimulationGUI:
         self.frequency_slider = create_slider_with_units(
             self.control_frame, "Количество (N):", "шт", 1e0, 1e6, is_int=True)
         
+        # Стохастическое (броуновское) смещение D = kT/(6πηr)
+        self.brownian_var = tk.BooleanVar(value=False)
+        brownian_check = ttk.Checkbutton(
+            self.control_frame, text="Броуновское движение", variable=self.brownian_var)
+        brownian_check.pack(fill='x', padx=10, pady=2)
+
+        # Зерно генератора случайных чисел: пусто - каждый запуск свой
+        seed_frame = ttk.Frame(self.control_frame)
+        seed_frame.pack(fill='x', padx=5, pady=2)
+        ttk.Label(seed_frame, text="Зерно ГСЧ:", style='Controls.TLabel', width=15).pack(side='left')
+        self.seed_var = tk.StringVar(value='')
+        ttk.Entry(seed_frame, textvariable=self.seed_var, width=12).pack(side='left', padx=5)
+        
+        # Режим отображения: точки или сетка плотности, посчитанная на
+        # сервере (размер кадра не зависит от числа частиц)
+        render_frame = ttk.Frame(self.control_frame)
+        render_frame.pack(fill='x', padx=5, pady=2)
+        ttk.Label(render_frame, text="Отображение:", style='Controls.TLabel', width=15).pack(side='left')
+        self.render_var = tk.StringVar(value='Точки')
+        render_box = ttk.Combobox(render_frame, textvariable=self.render_var,
+                                  values=list(RENDER_MODES), state='readonly', width=14)
+        render_box.pack(side='left', padx=5)
+        self.bins_var = tk.StringVar(value='128')
+        bins_box = ttk.Combobox(render_frame, textvariable=self.bins_var,
+                                values=DENSITY_RESOLUTIONS, state='readonly', width=5)
+        bins_box.pack(side='left', padx=5)
+        render_box.bind('<<ComboboxSelected>>', self.set_render_mode)
+        bins_box.bind('<<ComboboxSelected>>', self.set_render_mode)
+        
+        # Воспроизведение записанной траектории (префикс файлов batch.py)
+        replay_frame = ttk.LabelFrame(self.control_frame, text="Воспроизведение")
+        replay_frame.pack(fill='x', padx=5, pady=2)
+        self.replay_path_var = tk.StringVar(value='trajectory')
+        ttk.Entry(replay_frame, textvariable=self.replay_path_var, width=24).grid(
+            row=0, column=0, columnspan=3, sticky='ew', padx=2, pady=2)
+        ttk.Button(replay_frame, text="Открыть", command=self.open_replay).grid(
+            row=0, column=3, padx=2, pady=2)
+        
+        # Положение в записи; во время перетаскивания ответы сервера не применяются
+        self.replay_seeking = False
+        self.replay_slider = ttk.Scale(replay_frame, from_=0, to=1, orient='horizontal', length=200)
+        self.replay_slider.grid(row=1, column=0, columnspan=4, sticky='ew', padx=2)
+        self.replay_slider.bind('<ButtonPress-1>', self.start_replay_seek)
+        self.replay_slider.bind('<ButtonRelease-1>', self.seek_replay)
+        
+        ttk.Label(replay_frame, text="Скорость:").grid(row=2, column=0, sticky='w')
+        self.replay_speed_var = tk.StringVar(value='1')
+        speed_box = ttk.Combobox(replay_frame, textvariable=self.replay_speed_var, state='readonly',
+                                 values=['0.25', '0.5', '1', '2', '4', '8'], width=5)
+        speed_box.grid(row=2, column=1, sticky='w')
+        speed_box.bind('<<ComboboxSelected>>', self.set_replay_speed)
+        ttk.Label(replay_frame, text="Шаг:").grid(row=2, column=2, sticky='e')
+        self.replay_skip_var = tk.StringVar(value='1')
+        ttk.Spinbox(replay_frame, from_=1, to=1000, textvariable=self.replay_skip_var, width=5,
+                    command=self.set_replay_skip).grid(row=2, column=3, sticky='w')
+        
+        self.replay_paused = False
+        self.replay_pause_button = ttk.Button(replay_frame, text="Пауза", command=self.toggle_replay_pause)
+        self.replay_pause_button.grid(row=3, column=0, sticky='w', padx=2, pady=2)
+        self.replay_label = ttk.Label(replay_frame, text="Кадр: -")
+        self.replay_label.grid(row=3, column=1, columnspan=3, sticky='w')
+        
         # Кнопки управления
         button_frame = ttk.Frame(self.control_frame)
         button_frame.pack(fill='x', padx=5, pady=10)
@@ -141,11 +232,25 @@ class SimulationGUI:
         # Кнопка для перезапуска с новыми параметрами
         self.restart_button = ttk.Button(button_frame, text="Перезапустить", command=self.restart_simulation)
         self.restart_button.pack(side='left', padx=5)
+
+        # Окно профилирования сервера: сводка появится в логе
+        self.profile_button = ttk.Button(button_frame, text="Профиль", command=self.toggle_profile)
+        self.profile_button.pack(side='left', padx=5)
+        self.profiling = False
+        self.shown_profile = None
         
         # Лог
         self.log_frame = ttk.Frame(self.control_frame)
         self.log_frame.pack(fill='both', expand=True, pady=10)
         
+        # Счетчики кадров: принято, отрисовано, пропущено, время отрисовки
+        self.stats_label = ttk.Label(self.log_frame, text="Кадры: -", style='Controls.TLabel')
+        self.stats_label.pack(side='top', fill='x')
+        # Время фаз на сервере (сообщение 'stats'): p50/p95, мс
+        self.server_stats_label = ttk.Label(self.log_frame, text="Сервер: -",
+                                            style='Controls.TLabel')
+        self.server_stats_label.pack(side='top', fill='x')
+        
         self.log_text = tk.Text(self.log_frame, height=10, width=30)
         self.log_text.pack(side='left', fill='both', expand=True)
         
@@ -166,21 +271,9 @@ class SimulationGUI:
     def create_plot(self):
         """Создание графика"""
         self.figure = plt.Figure(figsize=(6, 6), dpi=100)
-        self.ax = self.figure.add_subplot(111, projection='3d')
         self.canvas = FigureCanvasTkAgg(self.figure, master=self.plot_frame)
         self.canvas.get_tk_widget().pack(fill='both', expand=True)
-        
-        # Начальная настройка графика
-        self.ax.set_xlim([0, 1])
-        self.ax.set_ylim([0, 1])
-        self.ax.set_zlim([0, 1])
-        self.ax.set_xlabel('X')
-        self.ax.set_ylabel('Y')
-        self.ax.set_zlabel('Z')
-        self.ax.set_title('Симуляция частиц')
-        
-        # Создаем начальный scatter plot
-        self.particles_plot = self.ax.scatter([], [], [], c='b', marker='o', alpha=0.6)
+        self.create_axes()
         
         # Добавляем обработчики событий для вращения
         self.canvas.mpl_connect('button_press_event', self.on_mouse_press)
@@ -194,9 +287,53 @@ class SimulationGUI:
         self.current_azim = 0
         self.current_elev = 0
         
-        # Переменные для контроля частоты обновления
-        self.last_update_time = time.time()
-        self.update_interval = 0.033  # ~30 FPS
+        # Счетчики отрисовки кадров
+        self.rendered_frames = 0
+        self.render_time = 0.0
+        self.stats_time = time.perf_counter()
+        self.stats_received = 0
+        self.stats_rendered = 0
+        self.stats_render_time = 0.0
+
+    def create_axes(self, axis=None, bins=128):
+        """Оси графика: 3D scatter для точек или imshow для сетки плотности
+        в проекции вдоль axis"""
+        self.figure.clf()
+        self.density_image = None
+        self.particles_plot = None
+        if axis is None:
+            self.ax = self.figure.add_subplot(111, projection='3d')
+            self.ax.set_xlim([0, 1])
+            self.ax.set_ylim([0, 1])
+            self.ax.set_zlim([0, 1])
+            self.ax.set_xlabel('X')
+            self.ax.set_ylabel('Y')
+            self.ax.set_zlabel('Z')
+            # Создаем начальный scatter plot
+            self.particles_plot = self.ax.scatter([], [], [], c='b', marker='o', alpha=0.6)
+        else:
+            # Сетка (i, j) по оставшимся осям: i - по горизонтали, j - по вертикали
+            horizontal, vertical = [name for name in 'xyz' if name != axis]
+            self.ax = self.figure.add_subplot(111)
+            self.density_image = self.ax.imshow(
+                np.zeros((bins, bins)), origin='lower', extent=(0, 1, 0, 1),
+                cmap='viridis', interpolation='nearest')
+            self.ax.set_xlabel(horizontal.upper())
+            self.ax.set_ylabel(vertical.upper())
+        self.ax.set_title('Симуляция частиц')
+
+    def set_render_mode(self, event=None):
+        """Переключение между точками и сеткой плотности"""
+        axis = RENDER_MODES[self.render_var.get()]
+        bins = int(self.bins_var.get())
+        render = None if axis is None else {'mode': 'density', 'axis': axis, 'bins': bins}
+        try:
+            self.client.set_render(render)
+        except Exception as e:
+            self.log_text.insert(tk.END, f"Ошибка при смене отображения: {e}\n")
+        self.create_axes(axis, bins)
+        self.canvas.draw_idle()
+        self.log_text.insert(tk.END, f"Отображение: {self.render_var.get()}\n")
 
     def on_window_resize(self, event=None):
         """Обработка изменения размера окна"""
@@ -254,33 +391,200 @@ class SimulationGUI:
             self.last_x = event.xdata
             self.last_y = event.ydata
 
-    def update_plot(self, coordinates):
-        """Обновление графика с новыми координатами"""
+    def update_plot(self, coordinates, total=None):
+        """Обновление графика с новыми координатами.
+
+        total - полное число частиц, если coordinates - их выборка.
+        """
         try:
-            if not coordinates:
-                return
-                
-            current_time = time.time()
-            if current_time - self.last_update_time < self.update_interval:
+            if coordinates is None or len(coordinates) == 0:
                 return
-                
-            self.last_update_time = current_time
             
-            # Получаем координаты
-            x = [p['x'] for p in coordinates]
-            y = [p['y'] for p in coordinates]
-            z = [p['z'] for p in coordinates]
+            # Получаем координаты: массив (N, 3) или список словарей
+            if isinstance(coordinates, list):
+                coordinates = np.array([(p['x'], p['y'], p['z']) for p in coordinates])
+            x = coordinates[:, 0]
+            y = coordinates[:, 1]
+            z = coordinates[:, 2]
             
             # Обновляем данные существующего scatter plot
+            if self.particles_plot is None:
+                return
             self.particles_plot._offsets3d = (x, y, z)
-            
-            # Обновляем только если окно существует
-            if self.root.winfo_exists():
-                self.canvas.draw_idle()
+            shown = len(coordinates)
+            total = total or shown
+            if total > shown:
+                self.ax.set_title(f'Симуляция частиц: показано {shown} из {total}')
+            else:
+                self.ax.set_title(f'Симуляция частиц: {total}')
                 
         except Exception as e:
             print(f"Ошибка при обновлении графика: {e}")
 
+    def update_density(self, grid, total=None):
+        """Обновление сетки плотности (объемная сетка показывается в проекции на XY)"""
+        try:
+            if self.density_image is None:
+                return
+            if grid.ndim == 3:
+                grid = grid.sum(axis=2)
+            # imshow: строки - вертикальная ось, столбцы - горизонтальная
+            self.density_image.set_data(grid.T)
+            self.density_image.set_clim(0, max(1, int(grid.max())))
+            self.ax.set_title(f'Плотность частиц: {total or int(grid.sum())}')
+
+        except Exception as e:
+            print(f"Ошибка при обновлении графика: {e}")
+
+    def poll_frames(self):
+        """Отрисовка последнего кадра из почтового ящика клиента.
+
+        Вызывается таймером главного потока с целевой частотой кадров;
+        кадры, пришедшие между вызовами, отбрасываются в почтовом ящике.
+        """
+        try:
+            frame = self.client.mailbox.take()
+            if frame is not None:
+                start = time.perf_counter()
+                if frame.density is not None:
+                    self.update_density(frame.density, total=frame.total)
+                else:
+                    self.update_plot(frame.positions, total=frame.total)
+                self.canvas.draw()
+                self.render_time = time.perf_counter() - start
+                self.rendered_frames += 1
+                self.stats_render_time += self.render_time
+            self.update_replay_position()
+            self.update_stats()
+        except Exception as e:
+            print(f"Ошибка при отрисовке кадра: {e}")
+        finally:
+            try:
+                self.root.after(self.frame_interval, self.poll_frames)
+            except tk.TclError:
+                pass  # окно уже закрыто
+
+    def open_replay(self):
+        """Воспроизведение записанной траектории вместо расчета"""
+        try:
+            settings = {
+                'temperature': self.get_slider_value(self.temperature_slider, 1e1, 1e4),
+                'viscosity': self.get_slider_value(self.viscosity_slider, 1e-5, 1e-1),
+                'size': self.get_slider_value(self.size_slider, 1e-9, 1e-4),
+                'mass': self.get_slider_value(self.mass_slider, 1e-21, 1e-15),
+                'frequency': int(self.get_slider_value(self.frequency_slider, 1e0, 1e6)),
+                'replay': self.replay_path_var.get()
+            }
+            self.client.replay_state = None
+            if not self.client.send_settings(settings):
+                self.log_text.insert(tk.END, "Ошибка при отправке настроек\n")
+                return
+            if not self.client.running and self.client.start_simulation():
+                self.start_button.config(state='disabled')
+                self.stop_button.config(state='normal')
+            self.replay_paused = False
+            self.replay_pause_button.config(text="Пауза")
+            self.log_text.insert(tk.END, f"Воспроизведение {settings['replay']}\n")
+        except Exception as e:
+            self.log_text.insert(tk.END, f"Ошибка при открытии записи: {e}\n")
+
+    def start_replay_seek(self, event=None):
+        self.replay_seeking = True
+
+    def seek_replay(self, event=None):
+        """Перемотка к положению ползунка"""
+        self.replay_seeking = False
+        state = self.client.replay_state
+        if state:
+            frame = round(self.replay_slider.get() * (state['frames'] - 1))
+            self.client.control_replay(seek=frame)
+
+    def set_replay_speed(self, event=None):
+        self.client.control_replay(speed=float(self.replay_speed_var.get()))
+
+    def set_replay_skip(self):
+        self.client.control_replay(skip=int(self.replay_skip_var.get()))
+
+    def toggle_replay_pause(self):
+        self.replay_paused = not self.replay_paused
+        self.replay_pause_button.config(text="Продолжить" if self.replay_paused else "Пауза")
+        self.client.control_replay(paused=self.replay_paused)
+
+    def update_replay_position(self):
+        """Положение воспроизведения по последнему сообщению сервера"""
+        state = self.client.replay_state
+        if not state:
+            return
+        self.replay_label.config(text=f"Кадр: {state['frame']} из {state['frames']}")
+        if not self.replay_seeking and state['frames'] > 1:
+            self.replay_slider.set(state['frame'] / (state['frames'] - 1))
+
+    def update_stats(self):
+        """Счетчики кадров в панели лога (раз в секунду)"""
+        now = time.perf_counter()
+        elapsed = now - self.stats_time
+        if elapsed < 1.0:
+            return
+        mailbox = self.client.mailbox
+        received = mailbox.received - self.stats_received
+        if received < 0:
+            # Клиент сменил источник кадров (сокет или разделяемая память)
+            received = mailbox.received
+        rendered = self.rendered_frames - self.stats_rendered
+        mean_render = self.stats_render_time / rendered * 1000 if rendered else 0.0
+        self.stats_label.config(
+            text=f"Кадры: принято {received / elapsed:.0f}/с, показано {rendered / elapsed:.0f}/с\n"
+                 f"пропущено всего {mailbox.dropped}, отрисовка {mean_render:.1f} мс")
+        self.stats_time = now
+        self.stats_received = mailbox.received
+        self.stats_rendered = self.rendered_frames
+        self.stats_render_time = 0.0
+        self.update_server_stats()
+        self.show_profile()
+
+    def toggle_profile(self):
+        """Начало или конец окна профилирования на сервере"""
+        if not self.client.connected:
+            self.log_text.insert(tk.END, "Профилирование: нет подключения\n")
+            return
+        self.profiling = not self.profiling
+        self.client.request_profile('start' if self.profiling else 'stop')
+        self.profile_button.config(text="Стоп профиля" if self.profiling else "Профиль")
+        self.log_text.insert(tk.END, "Профилирование включено\n" if self.profiling
+                             else "Профилирование остановлено, ждем сводку\n")
+
+    def show_profile(self):
+        """Вывод в лог новой сводки профиля сервера"""
+        profile = self.client.profile
+        if profile is None or profile is self.shown_profile:
+            return
+        self.shown_profile = profile
+        for summary in profile:
+            self.log_text.insert(tk.END, format_profile(summary, limit=5) + "\n")
+        self.log_text.see(tk.END)
+
+    def update_server_stats(self):
+        """Квантили фаз сервера из последнего сообщения 'stats'"""
+        stats = self.client.server_stats
+        if not stats:
+            return
+        phases = stats.get('phases', {})
+        lines = [f"Сервер: {stats.get('steps_per_second', 0):.0f} шаг/с, "
+                 f"{stats.get('frames_per_second', 0):.0f} кадр/с"]
+        for name, label in SERVER_PHASES:
+            phase = phases.get(name)
+            if phase:
+                lines.append(f"{label}: p50 {phase['p50']:.2f}, p95 {phase['p95']:.2f} мс")
+        frame_bytes = phases.get('frame_bytes')
+        if frame_bytes:
+            lines.append(f"кадр: {frame_bytes['p50'] / 1024:.1f} КБ")
+        self.server_stats_label.config(text="\n".join(lines))
+
+    def get_seed(self):
+        """Зерно ГСЧ из поля ввода (None - случайное)"""
+        value = self.seed_var.get().strip()
+        return int(value) if value else None
+
     def get_slider_value(self, slider, min_val, max_val):
         """Преобразует значение слайдера (0-100) в логарифмическую шкалу"""
         normalized = slider.get() / 100.0
@@ -294,9 +598,12 @@ class SimulationGUI:
                 'viscosity': self.get_slider_value(self.viscosity_slider, 1e-5, 1e-1),
                 'size': self.get_slider_value(self.size_slider, 1e-9, 1e-4),
                 'mass': self.get_slider_value(self.mass_slider, 1e-21, 1e-15),
-                'frequency': int(self.get_slider_value(self.frequency_slider, 1e0, 1e6))
+                'frequency': int(self.get_slider_value(self.frequency_slider, 1e0, 1e6)),
+                'integrator': 'brownian' if self.brownian_var.get() else 'ballistic',
+                'seed': self.get_seed()
             }
-            self.client.send_settings(settings)
+            # Без пересоздания частиц: симуляция продолжается с новыми параметрами
+            self.client.update_settings(settings)
             self.log_text.insert(tk.END, "Параметры успешно применены.\n")
         except Exception as e:
             self.log_text.insert(tk.END, f"Ошибка при применении параметров: {e}\n")
@@ -374,11 +681,7 @@ class SimulationGUI:
             time.sleep(0.5)  # Даем время на полную остановку
             
             # Очищаем график
-            if hasattr(self, 'particles_plot') and self.particles_plot:
-                self.particles_plot.remove()
-            
-            # Создаем новый scatter plot
-            self.particles_plot = self.ax.scatter([], [], [], c='b', marker='o', alpha=0.6)
+            self.create_axes(RENDER_MODES[self.render_var.get()], int(self.bins_var.get()))
             self.canvas.draw()
             
             # Получаем текущие настройки
@@ -387,7 +690,9 @@ class SimulationGUI:
                 'viscosity': self.get_slider_value(self.viscosity_slider, 1e-5, 1e-1),
                 'size': self.get_slider_value(self.size_slider, 1e-9, 1e-4),
                 'mass': self.get_slider_value(self.mass_slider, 1e-21, 1e-15),
-                'frequency': int(self.get_slider_value(self.frequency_slider, 1e0, 1e6))
+                'frequency': int(self.get_slider_value(self.frequency_slider, 1e0, 1e6)),
+                'integrator': 'brownian' if self.brownian_var.get() else 'ballistic',
+                'seed': self.get_seed()
             }
             
             # Отправляем новые настройки
@@ -1,23 +1,35 @@
-import threading
+import multiprocessing
+import signal
+import sys
 import time
-from server import Server  # Импортируем класс Server из server.py
-from gui import SimulationGUI  # Импортируем класс SimulationGUI из gui.py
-from client import Client  # Импортируем класс Client из client.py
+
+# Модули импортируются в функциях процессов: серверу не нужен стек GUI
+# (tkinter, matplotlib), а окну - физика
 
 def run_server():
+    from server import Server
+    # terminate() главного процесса завершает сервер через finally в
+    # Server.start: сокеты закрываются, разделяемая память удаляется
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     server = Server()
     server.start()
 
 def run_client():
-    client = Client()
+    from gui import SimulationGUI
+    from client import Client
+    import protocol
+    # Сервер на этой же машине: кадры через разделяемую память,
+    # по сокету - только управляющие сообщения
+    client = Client(transport=protocol.TRANSPORT_SHM)
     gui = SimulationGUI(client)
-    gui.protocol("WM_DELETE_WINDOW", gui.on_closing)
-    gui.mainloop()
+    client.set_gui(gui)
+    gui.root.protocol("WM_DELETE_WINDOW", gui.on_closing)
+    gui.root.mainloop()
 
 if __name__ == "__main__":
-    # Запускаем сервер в отдельном потоке
-    server_thread = threading.Thread(target=run_server)
-    server_thread.start()
+    # Запускаем сервер в отдельном процессе: физика и Tk не делят GIL
+    server_process = multiprocessing.Process(target=run_server, daemon=True)
+    server_process.start()
 
     # Даем серверу немного времени для инициализации
     time.sleep(1)
@@ -25,5 +37,6 @@ if __name__ == "__main__":
     # Запускаем клиент
     run_client()
 
-    # Ждем завершения потока сервера
-    server_thread.join()
+    # Окно закрыто - останавливаем сервер
+    server_process.terminate()
+    server_process.join()
@@ -1,69 +1,308 @@
-from mpi4py import MPI
 import numpy as np
-import random
 import time
 import socket
 import json
 import threading
+from profiler import PROFILE_TOP, SORT_KEYS, Profiler, format_profile
+from stats import RollingStats
+import protocol
+
+# Постоянная Больцмана, Дж/К
+K_B = 1.380649e-23
+
+
+def reflect_walls(positions, velocities):
+    """Отражаем частицы от стенок единичного куба (векторно, на месте)"""
+    below = positions < 0
+    if below.any():
+        positions[below] = 0
+        velocities[below] = np.abs(velocities[below])
+
+    above = positions > 1
+    if above.any():
+        positions[above] = 1
+        velocities[above] = -np.abs(velocities[above])
+
+
+# Половина окрестности 3x3x3: сама ячейка и 13 соседей "вперед",
+# чтобы каждая пара соседних ячеек просматривалась ровно один раз
+_HALF_SHELL = [(0, 0, 0)] + [
+    (dx, dy, dz)
+    for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)
+    if (dx, dy, dz) > (0, 0, 0)
+]
+
+
+def find_collision_pairs(positions, radii):
+    """Поиск пар пересекающихся частиц по сетке ячеек (cell list).
+
+    Ячейка не меньше 2*max(r), поэтому соседи частицы лежат только в
+    соседних ячейках. Число ячеек ограничено ~N, так что в среднем на
+    ячейку приходится O(1) частиц и стоимость растет линейно по N.
+    Возвращает массив (K, 2) индексов i < j, упорядоченный по (i, j).
+    """
+    count = len(positions)
+    no_pairs = np.empty((0, 2), dtype=np.int64)
+    if count < 2:
+        return no_pairs
+    cutoff = 2 * radii.max()
+    if cutoff <= 0:
+        return no_pairs
+
+    # Сетка над ограничивающим прямоугольником частиц
+    low = positions.min(axis=0)
+    extent = np.maximum(positions.max(axis=0) - low, cutoff)
+    max_cells = max(1, int(round(count ** (1 / 3))))
+    cells = np.clip((extent // cutoff).astype(np.int64), 1, max_cells)
+    coords = ((positions - low) * (cells / extent)).astype(np.int64)
+    np.minimum(coords, cells - 1, out=coords)
+
+    # Сортируем частицы по номеру ячейки
+    cell_ids = (coords[:, 0] * cells[1] + coords[:, 1]) * cells[2] + coords[:, 2]
+    order = np.argsort(cell_ids, kind='stable')
+    sorted_coords = coords[order]
+    counts = np.bincount(cell_ids, minlength=int(np.prod(cells)))
+    starts = np.cumsum(counts) - counts
+    slots = np.arange(count)
+
+    first, second = [], []
+    for offset in _HALF_SHELL:
+        neighbour = sorted_coords + offset
+        valid = np.all((neighbour >= 0) & (neighbour < cells), axis=1)
+        source = slots[valid]
+        neighbour = neighbour[valid]
+        neighbour_ids = (neighbour[:, 0] * cells[1] + neighbour[:, 1]) * cells[2] + neighbour[:, 2]
+        begin = starts[neighbour_ids]
+        length = counts[neighbour_ids]
+        if offset == (0, 0, 0):
+            # В своей ячейке берем только частицы после текущей
+            length = begin + length - source - 1
+            begin = source + 1
+
+        total = int(length.sum())
+        if total == 0:
+            continue
+        group_start = np.repeat(np.cumsum(length) - length, length)
+        first.append(np.repeat(source, length))
+        second.append(np.repeat(begin, length) + (np.arange(total) - group_start))
+
+    if not first:
+        return no_pairs
+
+    i = order[np.concatenate(first)]
+    j = order[np.concatenate(second)]
+    delta = positions[i] - positions[j]
+    reach = radii[i] + radii[j]
+    hit = np.einsum('ij,ij->i', delta, delta) < reach * reach
+
+    pairs = np.stack([np.minimum(i[hit], j[hit]), np.maximum(i[hit], j[hit])], axis=1)
+    return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+
+def select_disjoint_pairs(pairs, positions):
+    """Детерминированный выбор непересекающихся пар столкновений.
+
+    Если частица участвует в нескольких парах, за раунд принимаются
+    только взаимно ближайшие пары (при равных расстояниях - меньшие
+    индексы). Частицы принятых пар выбывают, раунды повторяются, пока
+    остаются пары. Результат не зависит от порядка обхода.
+    """
+    if len(pairs) == 0:
+        return pairs
+    delta = positions[pairs[:, 0]] - positions[pairs[:, 1]]
+    distances = np.einsum('ij,ij->i', delta, delta)
+    pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0], distances))]
+
+    count = len(positions)
+    active = np.ones(len(pairs), dtype=bool)
+    accepted = []
+    while active.any():
+        candidates = np.nonzero(active)[0]
+        best = np.full(count, len(pairs))
+        np.minimum.at(best, pairs[candidates, 0], candidates)
+        np.minimum.at(best, pairs[candidates, 1], candidates)
+        mutual = candidates[(best[pairs[candidates, 0]] == candidates)
+                            & (best[pairs[candidates, 1]] == candidates)]
+        accepted.append(mutual)
+
+        used = np.zeros(count, dtype=bool)
+        used[pairs[mutual].ravel()] = True
+        active &= ~(used[pairs[:, 0]] | used[pairs[:, 1]])
+
+    return pairs[np.sort(np.concatenate(accepted))]
+
+
+def positions_to_dicts(rows):
+    """Строки (x, y, z[, vx, vy, vz]) в список словарей для JSON"""
+    keys = ('x', 'y', 'z', 'vx', 'vy', 'vz')[:np.shape(rows)[1]]
+    return [dict(zip(keys, row)) for row in np.asarray(rows).tolist()]
+
+
+def density_grid(positions, bins, axis=None):
+    """Число частиц в ячейках сетки над единичным кубом.
+
+    С axis (0, 1, 2) - проекция вдоль этой оси, массив (bins, bins) с
+    индексами по оставшимся осям в порядке возрастания; без axis -
+    объемная сетка (bins, bins, bins). Одна векторная гистограмма
+    через bincount по плоским индексам ячеек.
+    """
+    cells = np.multiply(positions, bins).astype(np.intp)
+    np.clip(cells, 0, bins - 1, out=cells)
+    columns = [column for column in range(3) if column != axis]
+    flat = cells[:, columns[0]]
+    for column in columns[1:]:
+        flat = flat * bins + cells[:, column]
+    counts = np.bincount(flat, minlength=bins ** len(columns))
+    return counts.reshape((bins,) * len(columns))
+
+
+def id_priority(ids):
+    """Детерминированный псевдослучайный приоритет частицы по id (splitmix64)"""
+    z = ids.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+class Decimator:
+    """Устойчивая прореженная выборка частиц под бюджет точек клиента.
+
+    Выбираются budget частиц с наименьшим приоритетом id_priority(id),
+    упорядоченные по id: пока набор частиц не меняется, от кадра к
+    кадру передаются одни и те же частицы в одном порядке, а при
+    добавлении или удалении частиц выборка меняется минимально.
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self._ids = None
+        self._indices = None
+        self._selected = None
+
+    def select(self, ids):
+        """Индексы выборки (None - передавать все) и признак смены выборки"""
+        if ids is self._ids:
+            return self._indices, False
+        self._ids = ids
+
+        if not self.budget or len(ids) <= self.budget:
+            indices = None
+            selected = ids
+        else:
+            indices = np.argpartition(id_priority(ids), self.budget - 1)[:self.budget]
+            indices = indices[np.argsort(ids[indices], kind='stable')]
+            selected = ids[indices]
+
+        changed = self._selected is None or not np.array_equal(selected, self._selected)
+        self._indices = indices
+        self._selected = selected
+        return indices, changed
+
+    def sample(self, positions, ids):
+        """Координаты выборки и признак смены выборки"""
+        if ids is None:
+            return positions, False
+        indices, changed = self.select(ids)
+        return (positions if indices is None else positions[indices]), changed
+
+
+def _column(array_name, column):
+    """Свойство частицы, читающее компоненту строки массива системы"""
+    def getter(self):
+        return float(getattr(self.system, array_name)[self.index, column])
+
+    def setter(self, value):
+        getattr(self.system, array_name)[self.index, column] = value
+
+    return property(getter, setter)
+
+
+def _scalar(array_name):
+    """Свойство частицы, читающее элемент одномерного массива системы"""
+    def getter(self):
+        return float(getattr(self.system, array_name)[self.index])
+
+    def setter(self, value):
+        getattr(self.system, array_name)[self.index] = value
+
+    return property(getter, setter)
+
+
+def _medium(attribute):
+    """Свойство частицы, читающее параметр среды системы (только чтение).
+
+    Среда общая для всех частиц системы: меняется она через систему
+    (ParticleSystem.update), а не через одну из частиц.
+    """
+    def getter(self):
+        return getattr(self.system, attribute)
+
+    def setter(self, value):
+        raise AttributeError(f"{attribute} - параметр среды всей системы; "
+                             f"используйте ParticleSystem.update({attribute}=...)")
+
+    return property(getter, setter)
+
 
 class Particle:
+    """Частица - тонкое представление одной строки ParticleSystem.
+
+    Созданная напрямую частица хранит данные в собственной системе
+    из одного элемента, а ParticleSystem[i] возвращает представление
+    i-й строки общих массивов без копирования.
+    """
+
+    x = _column('positions', 0)
+    y = _column('positions', 1)
+    z = _column('positions', 2)
+    vx = _column('velocities', 0)
+    vy = _column('velocities', 1)
+    vz = _column('velocities', 2)
+    radius = _scalar('radii')      # м
+    mass = _scalar('masses')       # кг
+    temperature = _medium('temperature')  # K
+    viscosity = _medium('viscosity')      # Па·с
+
     def __init__(self, x, y, z, radius, mass, temperature, viscosity):
-        # Позиция
-        self.x = x
-        self.y = y
-        self.z = z
-        
-        # Физические параметры
-        self.radius = radius  # м
-        self.mass = mass      # кг
-        self.temperature = temperature  # K
-        self.viscosity = viscosity      # Па·с
-        
+        self.system = ParticleSystem(temperature=temperature, viscosity=viscosity)
+        self.system.add([[x, y, z]], radius=radius, mass=mass,
+                        velocities=np.zeros((1, 3)))
+        self.index = 0
+
         # Константы
-        self.k_b = 1.380649e-23  # Постоянная Больцмана, Дж/К
-        
+        self.k_b = K_B
+
         # Рассчитываем параметры движения
         self.calculate_initial_velocities()
-        
+
+    @classmethod
+    def view(cls, system, index):
+        """Представление index-й частицы системы без копирования данных"""
+        particle = cls.__new__(cls)
+        particle.system = system
+        particle.index = index
+        particle.k_b = K_B
+        return particle
+
     def calculate_initial_velocities(self):
         """Рассчитываем начальные скорости на основе распределения Максвелла-Больцмана"""
         # Среднеквадратичная скорость: v_rms = sqrt(3kT/m)
         v_rms = np.sqrt(3 * self.k_b * self.temperature / self.mass)
-        
+
         # Генерируем случайные компоненты скорости
-        self.vx = np.random.normal(0, v_rms/np.sqrt(3))
-        self.vy = np.random.normal(0, v_rms/np.sqrt(3))
-        self.vz = np.random.normal(0, v_rms/np.sqrt(3))
-        
+        self.system.velocities[self.index] = self.system.rng.normal(0, v_rms/np.sqrt(3), 3)
+
     def update_position(self, dt):
         """Обновляем позицию частицы"""
+        position = self.system.positions[self.index:self.index + 1]
+        velocity = self.system.velocities[self.index:self.index + 1]
+
         # Обновляем позиции с учетом скорости
-        self.x += self.vx * dt
-        self.y += self.vy * dt
-        self.z += self.vz * dt
-        
+        position += velocity * dt
+
         # Проверяем границы и отражаем частицы
-        if self.x < 0:
-            self.x = 0
-            self.vx = abs(self.vx)
-        elif self.x > 1:
-            self.x = 1
-            self.vx = -abs(self.vx)
-            
-        if self.y < 0:
-            self.y = 0
-            self.vy = abs(self.vy)
-        elif self.y > 1:
-            self.y = 1
-            self.vy = -abs(self.vy)
-            
-        if self.z < 0:
-            self.z = 0
-            self.vz = abs(self.vz)
-        elif self.z > 1:
-            self.z = 1
-            self.vz = -abs(self.vz)
-            
+        reflect_walls(position, velocity)
+
     def check_collision(self, other):
         """Проверяем столкновение с другой частицей"""
         dx = self.x - other.x
@@ -72,9 +311,328 @@ class Particle:
         distance = np.sqrt(dx*dx + dy*dy + dz*dz)
         return distance < (self.radius + other.radius)
 
+
+def make_rng(seed=None, stream=0, streams=1):
+    """Генератор случайных чисел расчета.
+
+    seed из настроек делает расчет воспроизводимым (None - энтропия ОС).
+    Ранги MPI получают независимые потоки одной SeedSequence: stream -
+    номер ранга, streams - число рангов.
+    """
+    sequence = np.random.SeedSequence(seed)
+    if streams > 1:
+        sequence = sequence.spawn(streams)[stream]
+    return np.random.default_rng(sequence)
+
+
+class ParticleSystem:
+    """Набор частиц в виде непрерывных массивов NumPy (structure-of-arrays).
+
+    positions и velocities имеют форму (N, 3), radii и masses - (N,).
+    Шаг, отражение от стенок и экспорт выполняются над всеми частицами
+    сразу, без цикла по объектам Particle.
+
+    Интеграторы:
+        'ballistic' - только перенос со скоростью: x += v*dt
+        'brownian'  - перенос плюс стохастическое смещение N(0, σ²) по
+                      каждой оси, σ = sqrt(2*D*dt), D = kT/(6πηr)
+    """
+
+    INTEGRATORS = ('ballistic', 'brownian')
+
+    def __init__(self, temperature=300, viscosity=0.001, integrator='ballistic', rng=None):
+        if integrator not in self.INTEGRATORS:
+            raise ValueError(f"Неизвестный интегратор: {integrator}")
+
+        # Параметры среды
+        self._temperature = temperature  # K
+        self._viscosity = viscosity      # Па·с
+        self.integrator = integrator
+        self.rng = rng if rng is not None else np.random.default_rng()
+
+        # Состояние частиц
+        self.positions = np.empty((0, 3))
+        self.velocities = np.empty((0, 3))
+        self.radii = np.empty(0)
+        self.masses = np.empty(0)
+
+        # Постоянные идентификаторы частиц (сохраняются при миграции)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.next_id = 0
+
+        # Кэш стохастического члена: σ на частицу и буфер для шума
+        self._sigma = None
+        self._sigma_dt = None
+        self._noise = np.empty((0, 3))
+
+    @property
+    def temperature(self):
+        return self._temperature
+
+    @temperature.setter
+    def temperature(self, value):
+        self._temperature = value
+        self._sigma = None
+
+    @property
+    def viscosity(self):
+        return self._viscosity
+
+    @viscosity.setter
+    def viscosity(self, value):
+        self._viscosity = value
+        self._sigma = None
+
+    @classmethod
+    def from_settings(cls, settings, count=None, rng=None):
+        """Создание системы по словарю настроек клиента (с 'seed' -
+        воспроизводимо)"""
+        if rng is None:
+            rng = make_rng(settings.get('seed'))
+        system = cls(temperature=settings['temperature'],
+                     viscosity=settings['viscosity'],
+                     integrator=settings.get('integrator', 'ballistic'),
+                     rng=rng)
+        if count is None:
+            count = int(settings['frequency'])
+        system.create(count, radius=settings['size'], mass=settings['mass'])
+        return system
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Индекс частицы вне диапазона")
+        return Particle.view(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield Particle.view(self, index)
+
+    def maxwell_velocities(self, masses):
+        """Скорости по распределению Максвелла-Больцмана для заданных масс"""
+        sigma = np.sqrt(K_B * self.temperature / masses)
+        velocities = self.rng.standard_normal((len(masses), 3))
+        velocities *= sigma[:, None]
+        return velocities
+
+    def create(self, count, radius, mass, low=0.0, high=1.0):
+        """Добавление count частиц, равномерно распределенных в кубе
+        (координаты и скорости - по одному векторному вызову self.rng)"""
+        positions = self.rng.uniform(low, high, (count, 3))
+        self.add(positions, radius=radius, mass=mass)
+
+    def add(self, positions, radius, mass, velocities=None, ids=None):
+        """Добавление частиц с заданными позициями (и скоростями).
+
+        Без ids частицы получают новые последовательные идентификаторы.
+        Массивы не изменяются на месте, а заменяются новыми, поэтому
+        ссылка на старый массив ids остается верной для своего снимка.
+        """
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        count = len(positions)
+        radii = np.broadcast_to(np.asarray(radius, dtype=np.float64), (count,))
+        masses = np.broadcast_to(np.asarray(mass, dtype=np.float64), (count,))
+        if velocities is None:
+            velocities = self.maxwell_velocities(masses)
+        velocities = np.asarray(velocities, dtype=np.float64).reshape(-1, 3)
+        if ids is None:
+            ids = np.arange(self.next_id, self.next_id + count, dtype=np.int64)
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids):
+            self.next_id = max(self.next_id, int(ids.max()) + 1)
+
+        self.positions = np.concatenate([self.positions, positions])
+        self.velocities = np.concatenate([self.velocities, velocities])
+        self.radii = np.concatenate([self.radii, radii])
+        self.masses = np.concatenate([self.masses, masses])
+        self.ids = np.concatenate([self.ids, ids])
+        self._sigma = None
+
+    # Строка упакованного состояния: x y z vx vy vz radius mass id
+    PACKED_WIDTH = 9
+
+    def pack(self, mask=None):
+        """Упаковка состояния частиц в массив (K, PACKED_WIDTH) для передачи"""
+        select = slice(None) if mask is None else np.asarray(mask, dtype=bool)
+        return np.column_stack([self.positions[select], self.velocities[select],
+                                self.radii[select], self.masses[select],
+                                self.ids[select]])
+
+    def add_packed(self, rows):
+        """Добавление частиц из упакованного массива"""
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, self.PACKED_WIDTH)
+        self.add(rows[:, 0:3], radius=rows[:, 6], mass=rows[:, 7],
+                 velocities=rows[:, 3:6], ids=rows[:, 8].astype(np.int64))
+
+    def state(self):
+        """Полное состояние системы (копии массивов) для контрольной точки.
+
+        Вместе с состоянием генератора случайных чисел этого достаточно
+        для побитно одинакового продолжения расчета после from_state.
+        """
+        return {
+            'positions': self.positions.copy(),
+            'velocities': self.velocities.copy(),
+            'radii': self.radii.copy(),
+            'masses': self.masses.copy(),
+            'ids': self.ids.copy(),
+            'next_id': self.next_id,
+            'temperature': self._temperature,
+            'viscosity': self._viscosity,
+            'integrator': self.integrator,
+            'rng': self.rng.bit_generator.state,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        """Система из состояния, сохраненного state()"""
+        rng_state = state['rng']
+        bit_generator = getattr(np.random, rng_state['bit_generator'])()
+        bit_generator.state = rng_state
+        system = cls(temperature=state['temperature'], viscosity=state['viscosity'],
+                     integrator=state['integrator'], rng=np.random.Generator(bit_generator))
+        system.positions = np.array(state['positions'], dtype=np.float64)
+        system.velocities = np.array(state['velocities'], dtype=np.float64)
+        system.radii = np.array(state['radii'], dtype=np.float64)
+        system.masses = np.array(state['masses'], dtype=np.float64)
+        system.ids = np.array(state['ids'], dtype=np.int64)
+        system.next_id = int(state['next_id'])
+        return system
+
+    def remove(self, mask):
+        """Удаление частиц, отмеченных булевой маской"""
+        keep = ~np.asarray(mask, dtype=bool)
+        self.positions = self.positions[keep]
+        self.velocities = self.velocities[keep]
+        self.radii = self.radii[keep]
+        self.masses = self.masses[keep]
+        self.ids = self.ids[keep]
+        self._sigma = None
+
+    def clear(self):
+        """Удаление всех частиц"""
+        self.remove(np.ones(len(self), dtype=bool))
+
+    def resize(self, count, radius, mass):
+        """Добавление или удаление только разницы до count частиц
+        (удаляются случайные частицы, новые создаются как в create)"""
+        excess = len(self) - int(count)
+        if excess > 0:
+            drop = np.zeros(len(self), dtype=bool)
+            drop[self.rng.choice(len(self), excess, replace=False)] = True
+            self.remove(drop)
+        elif excess < 0:
+            self.create(-excess, radius=radius, mass=mass)
+
+    def update(self, temperature=None, viscosity=None, count=None, radius=None, mass=None,
+               integrator=None):
+        """Смена параметров без пересоздания частиц (между шагами).
+
+        temperature - скорости масштабируются на sqrt(T/T0), распределение
+        остается максвелловским; viscosity и radius меняют только кэш σ
+        стохастического члена; mass - скорости приводятся к новой массе
+        при той же температуре; count - добавляется или удаляется только
+        разница. None - параметр не меняется.
+        """
+        if integrator is not None:
+            if integrator not in self.INTEGRATORS:
+                raise ValueError(f"Неизвестный интегратор: {integrator}")
+            self.integrator = integrator
+        if mass is not None and np.any(self.masses != mass):
+            masses = np.full(len(self), float(mass))
+            self.velocities *= np.sqrt(self.masses / masses)[:, None]
+            self.masses = masses
+        if radius is not None and np.any(self.radii != radius):
+            self.radii = np.full(len(self), float(radius))
+            self._sigma = None
+        if temperature is not None and temperature != self.temperature:
+            if self.temperature > 0:
+                self.velocities *= np.sqrt(temperature / self.temperature)
+                self.temperature = temperature
+            else:
+                self.temperature = temperature
+                self.velocities = self.maxwell_velocities(self.masses)
+        if viscosity is not None and viscosity != self.viscosity:
+            self.viscosity = viscosity
+        if count is not None:
+            # Новые частицы - с заданными или текущими размером и массой
+            if radius is None or mass is None:
+                if not len(self):
+                    raise ValueError("Для новых частиц нужны radius и mass")
+                radius = self.radii[-1] if radius is None else radius
+                mass = self.masses[-1] if mass is None else mass
+            self.resize(count, radius=radius, mass=mass)
+
+    def diffusion_coefficients(self):
+        """Коэффициенты диффузии Стокса-Эйнштейна D = kT/(6πηr), м²/с"""
+        return K_B * self.temperature / (6 * np.pi * self.viscosity * self.radii)
+
+    def update_diffusion(self, dt):
+        """Пересчет σ стохастического смещения после смены настроек или dt"""
+        self._sigma = np.sqrt(2 * self.diffusion_coefficients() * dt)
+        self._sigma_dt = dt
+        if self._noise.shape != self.positions.shape:
+            self._noise = np.empty_like(self.positions)
+
+    def step(self, dt):
+        """Обновляем позиции всех частиц за один шаг"""
+        self.positions += self.velocities * dt
+
+        if self.integrator == 'brownian':
+            if self._sigma is None or self._sigma_dt != dt:
+                self.update_diffusion(dt)
+            # Все 3N нормальных отклонений одним вызовом генератора
+            self.rng.standard_normal(out=self._noise)
+            self._noise *= self._sigma[:, None]
+            self.positions += self._noise
+
+        reflect_walls(self.positions, self.velocities)
+
+    def collision_pairs(self, mask=None):
+        """Непересекающиеся пары столкнувшихся частиц, массив (K, 2) индексов.
+
+        mask - частицы, которые еще могут сталкиваться (None - все).
+        """
+        if mask is None:
+            return select_disjoint_pairs(find_collision_pairs(self.positions, self.radii),
+                                         self.positions)
+        indices = np.nonzero(mask)[0]
+        positions = self.positions[indices]
+        pairs = select_disjoint_pairs(find_collision_pairs(positions, self.radii[indices]),
+                                      positions)
+        return indices[pairs]
+
+    def collide(self, mask=None):
+        """Обмен скоростями для всех столкнувшихся пар за один шаг.
+
+        Возвращает пары, обменявшиеся скоростями (см. collision_pairs).
+        """
+        pairs = self.collision_pairs(mask)
+        first, second = pairs[:, 0], pairs[:, 1]
+        self.velocities[first], self.velocities[second] = \
+            self.velocities[second], self.velocities[first]
+        return pairs
+
+    def export_positions(self, dtype=np.float32):
+        """Копия координат в заданном типе для отправки клиенту"""
+        return self.positions.astype(dtype)
+
+    def export_dicts(self, velocities=False):
+        """Координаты (и скорости) в виде списка словарей для JSON"""
+        if velocities:
+            return positions_to_dicts(np.hstack([self.positions, self.velocities]))
+        return positions_to_dicts(self.positions)
+
 class MPIParticleSimulation:
     def __init__(self, settings):
-        # Инициализация MPI
+        # Инициализация MPI: mpi4py импортируется только здесь, чтобы
+        # обычный сервер и пакетный расчет не запускали MPI при импорте модуля
+        from mpi4py import MPI
+        from decomposition import SlabDecomposition
         self.comm = MPI.COMM_WORLD
         self.rank = self.comm.Get_rank()
         self.size = self.comm.Get_size()
@@ -86,25 +644,46 @@ class MPIParticleSimulation:
         self.particle_radius = settings.get('size', 0.01)
         self.particle_mass = settings.get('mass', 1.0)
         self.num_particles = settings.get('frequency', 100)
+        self.integrator = settings.get('integrator', 'ballistic')
+
+        # Пространственное разбиение куба на слои по рангам
+        self.decomposition = SlabDecomposition(self.comm)
+        # Частицы пары через границу слоя ближе суммы радиусов, поэтому
+        # обе лежат не дальше диаметра от границы
+        self.boundary_width = 2 * self.particle_radius
+
+        # Общий буфер координат всех рангов на ранге 0; в stats - время
+        # сбора (gather_ms) и отправки кадра (encode_ms, send_ms), мс
+        self._gather_buffer = np.empty((0, 3))
+        self.stats = RollingStats()
+
+        # Формат кадров согласуется с клиентом при подключении
+        self.encoding = protocol.ENCODING_JSON
+        self.encoder = protocol.FrameEncoder()
+
+        # Профилирование по команде клиента: на каждом ранге свой файл
+        self.profiler = Profiler(suffix=f'-rank{self.rank}')
 
         # Сокет для связи с клиентом
         self.server_socket = None
         self.client_connection = None
         
     def create_particles(self):
-        # Создаем частицы для текущего процесса
-        particles_per_process = max(1, self.num_particles // self.size)
-        return [
-            Particle(
-                random.uniform(0, 1), 
-                random.uniform(0, 1), 
-                random.uniform(0, 1),
-                radius=self.particle_radius,
-                mass=self.particle_mass,
-                temperature=self.temperature,
-                viscosity=self.viscosity
-            ) for _ in range(particles_per_process)
-        ]
+        # Создаем частицы текущего процесса внутри его подобласти
+        low, high = self.decomposition.bounds()
+        # Свой поток случайных чисел на каждом ранге из общего seed
+        system = ParticleSystem(temperature=self.temperature,
+                                viscosity=self.viscosity,
+                                integrator=self.integrator,
+                                rng=make_rng(self.settings.get('seed'), self.rank, self.size))
+        # Идентификаторы уникальны по всем рангам
+        count = self.decomposition.local_count(self.num_particles)
+        system.next_id = self.comm.exscan(count) or 0
+        system.create(count,
+                      radius=self.particle_radius,
+                      mass=self.particle_mass,
+                      low=low, high=high)
+        return system
 
     def setup_server(self, host='127.0.0.2', port=12345):
         """Настройка сервера для обмена данными"""
@@ -118,6 +697,96 @@ class MPIParticleSimulation:
             # Ожидание подключения клиента
             self.client_connection, addr = self.server_socket.accept()
             print(f"Подключен клиент: {addr}")
+            self.handshake(self.client_connection)
+
+    def handshake(self, connection):
+        """Настройки клиента и согласование формата кадров.
+
+        Цикл рангов ждет ответа на каждый кадр, поэтому управление потоком -
+        всегда ACK; бинарные кадры получают клиенты с предложением протокола.
+        """
+        settings = protocol.recv_settings(connection) or {}
+        self.encoding = protocol.choose_encoding(settings)
+        self.encoder = protocol.create_encoder(settings)
+        if 'protocol' in settings:
+            protocol.send_control(connection, {
+                'type': 'hello',
+                'version': protocol.PROTOCOL_VERSION,
+                'encoding': self.encoding,
+                'frame': self.encoder.options(),
+                'flow': {'mode': protocol.FLOW_ACK, 'window': 0}
+            })
+        print(f"Формат кадров: {self.encoding} {self.encoder.options()}")
+
+    def gather_positions(self, system):
+        """Сбор координат всех рангов в непрерывный массив на ранге 0.
+
+        Число частиц на рангах меняется при миграции, поэтому сначала
+        собираются размеры, затем координаты буферным Gatherv (без pickle)
+        в заранее выделенный буфер, растущий по мере необходимости.
+        На ранге 0 возвращает представление буфера формы (N, 3), на
+        остальных - None. Время сбора добавляется в stats (gather_ms).
+        """
+        from mpi4py import MPI
+        start = MPI.Wtime()
+        local = np.ascontiguousarray(system.positions)
+
+        counts = np.empty(self.size, dtype=np.int64) if self.rank == 0 else None
+        self.comm.Gather(np.array([len(local)], dtype=np.int64), counts, root=0)
+
+        gathered = None
+        receive = None
+        if self.rank == 0:
+            total = int(counts.sum())
+            if len(self._gather_buffer) < total:
+                self._gather_buffer = np.empty((max(total, 2 * len(self._gather_buffer)), 3))
+            counts *= 3
+            displacements = np.cumsum(counts) - counts
+            gathered = self._gather_buffer[:total]
+            receive = [gathered, (counts, displacements), MPI.DOUBLE]
+        self.comm.Gatherv(local, receive, root=0)
+
+        self.stats.add('gather_ms', (MPI.Wtime() - start) * 1000)
+        return gathered
+
+    def send_frame(self, seq, positions):
+        """Отправка собранного массива клиенту одним кадром протокола"""
+        with self.stats.timer('encode_ms'):
+            if self.encoding == protocol.ENCODING_BINARY:
+                data = self.encoder.encode(seq, positions)
+            else:
+                data = json.dumps(positions_to_dicts(positions)).encode()
+        with self.stats.timer('send_ms'):
+            protocol.send_message(self.client_connection, data)
+
+    def report_stats(self, prefix):
+        """Квантили времени сбора и отправки кадров (ранг 0)"""
+        parts = [f"{phase} p50 {row['p50']:.3f} p95 {row['p95']:.3f} "
+                 f"p99 {row['p99']:.3f} max {row['max']:.3f} мс"
+                 for phase, row in self.stats.summary().items()]
+        print(f"{prefix}: {'; '.join(parts)}")
+
+    def handle_command(self, command):
+        """Команда клиента, разосланная рангом 0 (вызывается всеми рангами)"""
+        if command.get('type') != 'profile':
+            return
+        action = command.get('action')
+        if action == 'start':
+            self.profiler.start()
+        elif action == 'stop':
+            sort = command.get('sort', 'cumulative')
+            summary = self.profiler.stop(top=int(command.get('top', PROFILE_TOP)),
+                                         sort=sort if sort in SORT_KEYS else 'cumulative')
+            if summary is not None:
+                summary['rank'] = self.rank
+            summaries = self.comm.gather(summary, root=0)
+            if self.rank == 0:
+                profiles = [summary for summary in summaries if summary]
+                for summary in profiles:
+                    print(format_profile(summary))
+                if self.client_connection:
+                    protocol.send_control(self.client_connection,
+                                          {'type': 'profile', 'profiles': profiles})
 
     def simulate(self, max_iterations=1000):
         # Создаем частицы
@@ -126,42 +795,56 @@ class MPIParticleSimulation:
         dt = 0.01  # Шаг времени
 
         while iteration < max_iterations:
+            # Окно профилирования открывается и закрывается между итерациями
+            self.profiler.boundary()
+
             # Обновляем позиции частиц
-            for particle in local_particles:
-                particle.update_position(dt)
+            local_particles.step(dt)
+
+            # Передаем частицы, пересекшие границы слоя, их владельцам
+            self.decomposition.migrate(local_particles)
+
+            # Столкновения внутри слоя и через его границы
+            self.decomposition.collide(local_particles, self.boundary_width)
+
+            # Собираем данные со всех процессов на ранге 0
+            positions = self.gather_positions(local_particles)
 
-            # Собираем данные со всех процессов
+            stop = False
+            command = None
             if self.rank == 0 and self.client_connection:
                 try:
-                    # Собираем позиции частиц
-                    positions = []
-                    for particle in local_particles:
-                        positions.append({
-                            'x': particle.x,
-                            'y': particle.y,
-                            'z': particle.z,
-                            'vx': particle.vx,
-                            'vy': particle.vy,
-                            'vz': particle.vz
-                        })
-                    
                     # Отправляем данные клиенту
-                    data = json.dumps(positions)
-                    self.client_connection.send(data.encode())
+                    self.send_frame(iteration, positions)
                     
-                    # Получаем подтверждение от клиента
+                    # Получаем подтверждение (или команду) от клиента
                     try:
-                        self.client_connection.recv(1024)
+                        command = protocol.read_ack_reply(self.client_connection)
                     except:
                         print("Ошибка при получении подтверждения от клиента")
-                        break
+                        stop = True
                     
                 except Exception as e:
                     print(f"Ошибка при отправке данных: {e}")
-                    break
+                    stop = True
+
+            if self.rank == 0 and iteration % 100 == 0:
+                self.report_stats(f"Кадр {iteration}: {len(positions)} частиц")
+
+            # Остальные ранги должны остановиться вместе с рангом 0
+            # и выполнить команду клиента вместе с ним
+            stop, command = self.comm.bcast((stop, command), root=0)
+            if command:
+                self.handle_command(command)
+            if stop:
+                break
 
             iteration += 1
             time.sleep(0.01)  # Небольшая задержка для визуализации
+        self.profiler.leave()
+
+        if self.rank == 0:
+            self.report_stats(f"Итог за {iteration} кадров")
 
     def close(self):
         """Закрытие соединений"""
@@ -182,7 +865,8 @@ def load_settings():
             'viscosity': 0.001,
             'size': 0.01,
             'mass': 1.0,
-            'frequency': 100
+            'frequency': 100,
+            'integrator': 'ballistic'
         }
 
 def main():
@@ -0,0 +1,127 @@
+import os
+import threading
+import time
+
+# Каталог файлов профиля (создается при первой записи)
+PROFILE_DIRECTORY = 'profiles'
+# Сортировки, допустимые в запросе профиля (ключи pstats)
+SORT_KEYS = ('cumulative', 'tottime', 'calls')
+PROFILE_TOP = 20
+
+
+class Profiler:
+    """Профилирование работающего сервера по запросу.
+
+    До start() профилировщик выключен: циклы только проверяют флаг в
+    boundary(). После start() каждый поток, вызывающий boundary() на
+    границе итерации своего цикла, включает собственный cProfile; после
+    stop() потоки выключают его на следующей границе. stop() ждет их,
+    объединяет профили, пишет их в файл с отметкой времени и возвращает
+    сводку top самых дорогих функций.
+    """
+
+    def __init__(self, directory=PROFILE_DIRECTORY, suffix=''):
+        self.directory = directory
+        self.suffix = suffix  # например, '-rank1' для рангов MPI
+        self.active = False
+        self.started = None
+        self._local = threading.local()
+        self._condition = threading.Condition()
+        self._running = set()
+        self._finished = []
+
+    def start(self):
+        """Начало окна профилирования (False, если оно уже идет)"""
+        with self._condition:
+            if self.active:
+                return False
+            self._finished = []
+            self.started = time.perf_counter()
+            self.active = True
+            return True
+
+    def boundary(self):
+        """Граница итерации цикла: включение или выключение профиля потока"""
+        profile = getattr(self._local, 'profile', None)
+        if self.active:
+            if profile is None:
+                self._enable()
+        elif profile is not None:
+            self.leave()
+
+    def _enable(self):
+        # cProfile и pstats загружаются только при первом окне профилирования
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Начиная с Python 3.12 одновременно активен только один cProfile
+            print(f"Профилирование потока {threading.current_thread().name} недоступно: {e}")
+            self._local.profile = False
+            return
+        self._local.profile = profile
+        with self._condition:
+            self._running.add(threading.current_thread().name)
+
+    def leave(self):
+        """Выключение профиля текущего потока (при выходе из цикла)"""
+        profile = getattr(self._local, 'profile', None)
+        self._local.profile = None
+        if not profile:
+            return
+        profile.disable()
+        name = threading.current_thread().name
+        with self._condition:
+            self._running.discard(name)
+            self._finished.append((name, profile))
+            self._condition.notify_all()
+
+    def stop(self, top=PROFILE_TOP, sort='cumulative', timeout=2.0):
+        """Конец окна: сводка профиля (словарь) или None, если окна не было"""
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Неизвестная сортировка профиля: {sort}")
+        with self._condition:
+            if not self.active:
+                return None
+            self.active = False
+        self.leave()
+        with self._condition:
+            self._condition.wait_for(lambda: not self._running, timeout)
+            finished, self._finished = self._finished, []
+            pending = sorted(self._running)
+        seconds = time.perf_counter() - self.started
+
+        summary = {'seconds': seconds, 'threads': [name for name, _ in finished],
+                   'pending': pending, 'file': None, 'top': []}
+        if not finished:
+            return summary
+        import pstats
+        stats = pstats.Stats(*[profile for _, profile in finished])
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory,
+                            f"profile-{time.strftime('%Y%m%d-%H%M%S')}{self.suffix}.prof")
+        stats.dump_stats(path)
+        summary['file'] = path
+        summary['total_seconds'] = stats.total_tt
+
+        stats.sort_stats(sort)
+        for function in stats.fcn_list[:top]:
+            primitive, calls, own, cumulative, _ = stats.stats[function]
+            summary['top'].append({'function': pstats.func_std_string(function),
+                                   'calls': calls, 'primitive_calls': primitive,
+                                   'tottime': own, 'cumtime': cumulative})
+        return summary
+
+
+def format_profile(summary, limit=10):
+    """Текст сводки профиля для лога"""
+    title = f"Профиль ранга {summary['rank']}" if 'rank' in summary else "Профиль"
+    lines = [f"{title}: {summary['seconds']:.1f} с, "
+             f"потоки: {', '.join(summary['threads']) or '-'}, файл: {summary['file']}"]
+    if summary.get('pending'):
+        lines.append(f"  не остановлены: {', '.join(summary['pending'])}")
+    for row in summary['top'][:limit]:
+        lines.append(f"  {row['cumtime'] * 1000:9.1f} мс {row['tottime'] * 1000:9.1f} мс "
+                     f"{row['calls']:8d}  {row['function']}")
+    return "\n".join(lines)
@@ -0,0 +1,478 @@
+import json
+import struct
+import zlib
+from collections import namedtuple
+import numpy as np
+
+# Версия бинарного протокола кадров
+PROTOCOL_VERSION = 2
+
+# Кодировки кадров, согласуемые при подключении
+ENCODING_JSON = 'json'      # список словарей {'x','y','z'} (старые клиенты)
+ENCODING_BINARY = 'binary'  # заголовок + сырые массивы little-endian
+
+# Управление потоком кадров
+FLOW_ACK = 'ack'        # сервер ждет b'ACK' после каждого кадра (старые клиенты)
+FLOW_CREDIT = 'credit'  # клиент заранее выдает кредит на N кадров
+DEFAULT_WINDOW = 8
+
+# Предел настроек старых клиентов (JSON без префикса длины)
+MAX_LEGACY_SETTINGS = 1 << 20
+
+# Транспорт кадров: сокет или кольцо в разделяемой памяти (сервер и GUI
+# на одной машине); в режиме 'shm' по сокету идут только управляющие сообщения
+TRANSPORT_SOCKET = 'socket'
+TRANSPORT_SHM = 'shm'
+
+# Заголовок бинарного кадра (после 4-байтового префикса длины):
+# magic, версия, флаги, тип данных, маска полей, номер кадра, число частиц
+# в кадре, полное число частиц (с версии 2; кадр может быть выборкой)
+FRAME_MAGIC = b'PFRM'
+FRAME_HEADER = struct.Struct('<4sBBBBIII')
+FRAME_HEADER_V1 = struct.Struct('<4sBBBBII')
+
+# Типы данных массивов. Целые типы - квантованные координаты единичного
+# куба: x = q / QUANT_SCALE[dtype] (только для координат)
+DTYPE_FLOAT32 = 0
+DTYPE_UINT16 = 1
+DTYPE_UINT8 = 2
+DTYPES = {
+    DTYPE_FLOAT32: np.dtype('<f4'),
+    DTYPE_UINT16: np.dtype('<u2'),
+    DTYPE_UINT8: np.dtype('u1'),
+}
+DTYPE_NAMES = {'float32': DTYPE_FLOAT32, 'uint16': DTYPE_UINT16, 'uint8': DTYPE_UINT8}
+QUANT_SCALE = {DTYPE_UINT16: 65535, DTYPE_UINT8: 255}
+
+# Флаги кадра
+FLAG_ZLIB = 1     # тело кадра сжато zlib
+FLAG_DELTA = 2    # квантованные координаты - разность с предыдущим кадром (zigzag)
+FLAG_SHUFFLE = 4  # перед сжатием байты элементов сгруппированы по номеру байта
+
+# Маска полей кадра; массивы идут в порядке возрастания битов, каждый (N, 3)
+FIELD_POSITIONS = 1
+FIELD_VELOCITIES = 2
+# Кадры плотности вместо координат: число частиц в ячейках сетки uint16
+# (с насыщением), в заголовке вместо числа частиц - число ячеек по оси
+FIELD_DENSITY = 4  # проекция (bins, bins)
+FIELD_VOLUME = 8   # объем (bins, bins, bins)
+
+# Режимы отображения, запрашиваемые клиентом
+RENDER_POINTS = 'points'    # координаты частиц (или их выборка)
+RENDER_DENSITY = 'density'  # гистограмма координат, считается на сервере
+AXES = {'x': 0, 'y': 1, 'z': 2}
+DENSITY_BINS = 128
+MAX_DENSITY_BINS = {2: 1024, 3: 128}
+
+Frame = namedtuple('Frame', ['seq', 'positions', 'velocities', 'total', 'density'],
+                   defaults=(None,))
+
+
+def zigzag_encode(delta):
+    """Разность по модулю 2^bits -> zigzag: малые по модулю значения в малые коды"""
+    signed = delta.view(delta.dtype.str.replace('u', 'i'))
+    bits = delta.dtype.itemsize * 8
+    return ((signed << 1) ^ (signed >> (bits - 1))).view(delta.dtype)
+
+
+def zigzag_decode(codes):
+    """Обратное преобразование zigzag (результат - разность по модулю 2^bits)"""
+    return (codes >> 1) ^ (-(codes & 1)).astype(codes.dtype)
+
+
+class FrameEncoder:
+    """Кодировщик бинарных кадров.
+
+    dtype: 'float32' или квантованные 'uint16'/'uint8' (по каждой оси);
+    compress: сжимать тело кадра zlib;
+    keyframe_interval: для квантованных координат - отправлять между
+    опорными кадрами разности с предыдущим кадром (0 - только опорные).
+    Кодировщик хранит предыдущий кадр, поэтому нужен свой на каждый поток.
+    """
+
+    def __init__(self, dtype='float32', compress=False, keyframe_interval=0, level=1):
+        if dtype not in DTYPE_NAMES:
+            raise ValueError(f"Неизвестный тип данных кадра: {dtype}")
+        self.dtype_code = DTYPE_NAMES[dtype]
+        self.compress = compress
+        self.keyframe_interval = keyframe_interval if self.dtype_code in QUANT_SCALE else 0
+        self.level = level
+        self._previous = None
+        self._since_keyframe = 0
+
+    def options(self):
+        """Параметры кодирования для ответа клиенту"""
+        return {
+            'dtype': next(name for name, code in DTYPE_NAMES.items() if code == self.dtype_code),
+            'compress': self.compress,
+            'keyframe_interval': self.keyframe_interval
+        }
+
+    def reset(self):
+        """Следующий кадр - опорный (например, после смены выборки частиц)"""
+        self._previous = None
+        self._since_keyframe = 0
+
+    def quantize(self, positions):
+        """Квантование координат единичного куба"""
+        scale = QUANT_SCALE[self.dtype_code]
+        scaled = np.clip(positions, 0, 1) * scale
+        return np.rint(scaled, out=scaled).astype(DTYPES[self.dtype_code])
+
+    def encode(self, seq, positions, velocities=None, total=None):
+        """Кодирование кадра в байты (без префикса длины).
+
+        total - полное число частиц, если кадр содержит только их выборку.
+        """
+        flags = 0
+        fields = FIELD_POSITIONS
+        dtype = DTYPES[self.dtype_code]
+
+        if self.dtype_code in QUANT_SCALE:
+            if velocities is not None:
+                raise ValueError("Квантование применимо только к координатам")
+            body = self.quantize(positions)
+            if (self.keyframe_interval and self._previous is not None
+                    and self._previous.shape == body.shape
+                    and self._since_keyframe < self.keyframe_interval):
+                flags |= FLAG_DELTA
+                self._previous, body = body, zigzag_encode(body - self._previous)
+                self._since_keyframe += 1
+            else:
+                self._previous = body
+                self._since_keyframe = 0
+        else:
+            arrays = [positions]
+            if velocities is not None:
+                fields |= FIELD_VELOCITIES
+                arrays.append(velocities)
+            body = np.concatenate([np.ascontiguousarray(array, dtype=dtype).ravel()
+                                   for array in arrays])
+
+        return self._pack(seq, flags, self.dtype_code, fields, body, len(positions),
+                          len(positions) if total is None else total)
+
+    def encode_density(self, seq, grid, total):
+        """Кодирование сетки плотности (bins, bins) или (bins, bins, bins)"""
+        fields = FIELD_DENSITY if grid.ndim == 2 else FIELD_VOLUME
+        body = np.minimum(grid, 0xFFFF).astype(DTYPES[DTYPE_UINT16])
+        return self._pack(seq, 0, DTYPE_UINT16, fields, body, grid.shape[0], total)
+
+    def _pack(self, seq, flags, dtype_code, fields, body, count, total):
+        """Сжатие тела (если включено) и заголовок кадра"""
+        itemsize = body.dtype.itemsize
+        if self.compress:
+            flags |= FLAG_ZLIB
+            if itemsize > 1:
+                # Старшие байты малых разностей почти одинаковы и хорошо сжимаются
+                flags |= FLAG_SHUFFLE
+                body = body.view(np.uint8).reshape(-1, itemsize).T
+            body = zlib.compress(np.ascontiguousarray(body).tobytes(), self.level)
+        else:
+            body = body.tobytes()
+
+        header = FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_VERSION, flags,
+                                   dtype_code, fields, seq & 0xFFFFFFFF, count, total)
+        return header + body
+
+
+class FrameDecoder:
+    """Декодировщик бинарных кадров (хранит опорный кадр для дельт)"""
+
+    def __init__(self):
+        self._previous = None
+
+    def decode(self, payload):
+        """Декодирование кадра.
+
+        Несжатые кадры float32 возвращаются представлениями np.frombuffer
+        над payload без копирования; квантованные координаты переводятся
+        в float32 одной векторной операцией.
+        """
+        if len(payload) < FRAME_HEADER_V1.size:
+            raise ValueError("Кадр короче заголовка")
+        magic, version = struct.unpack_from('<4sB', payload)
+        if magic != FRAME_MAGIC:
+            raise ValueError("Неверная сигнатура кадра")
+        if version > PROTOCOL_VERSION:
+            raise ValueError(f"Неподдерживаемая версия протокола: {version}")
+        if version == 1:
+            header = FRAME_HEADER_V1
+            _, _, flags, dtype_code, fields, seq, count = header.unpack_from(payload)
+            total = count
+        else:
+            header = FRAME_HEADER
+            if len(payload) < header.size:
+                raise ValueError("Кадр короче заголовка")
+            _, _, flags, dtype_code, fields, seq, count, total = header.unpack_from(payload)
+        if dtype_code not in DTYPES:
+            raise ValueError(f"Неизвестный тип данных кадра: {dtype_code}")
+
+        dtype = DTYPES[dtype_code]
+        body = payload
+        offset = header.size
+        if flags & FLAG_ZLIB:
+            body = zlib.decompress(payload[offset:])
+            offset = 0
+            if flags & FLAG_SHUFFLE:
+                planes = np.frombuffer(body, dtype=np.uint8).reshape(dtype.itemsize, -1)
+                body = np.ascontiguousarray(planes.T).tobytes()
+        for field, ndim in ((FIELD_DENSITY, 2), (FIELD_VOLUME, 3)):
+            if fields & field:
+                density = np.frombuffer(body, dtype=dtype, count=count ** ndim,
+                                        offset=offset).reshape((count,) * ndim)
+                if offset + density.nbytes != len(body):
+                    raise ValueError("Размер кадра не совпадает с заголовком")
+                return Frame(seq, None, None, total, density)
+
+        arrays = {}
+        for field in (FIELD_POSITIONS, FIELD_VELOCITIES):
+            if fields & field:
+                arrays[field] = np.frombuffer(body, dtype=dtype, count=count * 3,
+                                              offset=offset).reshape(count, 3)
+                offset += count * 3 * dtype.itemsize
+        if offset != len(body):
+            raise ValueError("Размер кадра не совпадает с заголовком")
+
+        positions = arrays.get(FIELD_POSITIONS)
+        if dtype_code in QUANT_SCALE:
+            if flags & FLAG_DELTA:
+                if self._previous is None or self._previous.shape != positions.shape:
+                    raise ValueError("Разностный кадр без опорного кадра")
+                positions = self._previous + zigzag_decode(positions)
+            # Опорный кадр переживает payload: буфер приема клиента
+            # перезаписывается следующим сообщением
+            self._previous = positions if positions.flags.owndata else positions.copy()
+            positions = np.multiply(positions, np.float32(1 / QUANT_SCALE[dtype_code]),
+                                    dtype=np.float32)
+
+        return Frame(seq, positions, arrays.get(FIELD_VELOCITIES), total)
+
+
+def detach_frame(frame):
+    """Копия массивов кадра, которые ссылаются на чужой буфер
+    (буфер приема клиента или слот кольца в разделяемой памяти)"""
+    arrays = {}
+    for name in ('positions', 'velocities', 'density'):
+        array = getattr(frame, name)
+        if array is not None and not array.flags.owndata:
+            arrays[name] = array.copy()
+    return frame._replace(**arrays) if arrays else frame
+
+
+def encode_frame(seq, positions, velocities=None):
+    """Кодирование кадра float32 без сжатия"""
+    return FrameEncoder().encode(seq, positions, velocities)
+
+
+def is_binary_frame(payload):
+    """Проверка, что сообщение является бинарным кадром"""
+    return bytes(payload[:len(FRAME_MAGIC)]) == FRAME_MAGIC
+
+
+def decode_frame(payload):
+    """Декодирование одиночного (не разностного) кадра"""
+    return FrameDecoder().decode(payload)
+
+
+def protocol_offer(encodings=(ENCODING_BINARY, ENCODING_JSON), frame=None, flow=None,
+                   max_points=None, render=None, transport=None):
+    """Поле 'protocol' в настройках клиента: кодировки, параметры кадров,
+    режим управления потоком ({'mode': 'credit', 'window': N}),
+    наибольшее число точек, которое клиент готов отображать, режим
+    отображения ({'mode': 'density', 'axis': 'z', 'bins': 128}) и
+    желаемый транспорт кадров"""
+    offer = {'version': PROTOCOL_VERSION, 'encodings': list(encodings)}
+    if frame:
+        offer['frame'] = dict(frame)
+    if flow:
+        offer['flow'] = dict(flow)
+    if max_points:
+        offer['max_points'] = int(max_points)
+    if render:
+        offer['render'] = dict(render)
+    if transport:
+        offer['transport'] = transport
+    return offer
+
+
+def choose_encoding(settings):
+    """Выбор кодировки по настройкам клиента (JSON, если клиент старый)"""
+    offer = settings.get('protocol')
+    if not offer:
+        return ENCODING_JSON
+    for encoding in offer.get('encodings', []):
+        if encoding in (ENCODING_BINARY, ENCODING_JSON):
+            return encoding
+    return ENCODING_JSON
+
+
+def choose_flow(settings):
+    """Режим управления потоком и начальное окно кредита.
+
+    В режиме кредитов все сообщения клиента серверу после рукопожатия
+    идут с префиксом длины (управляющие сообщения JSON).
+    """
+    flow = (settings.get('protocol') or {}).get('flow') or {}
+    if flow.get('mode') != FLOW_CREDIT:
+        return FLOW_ACK, 0
+    return FLOW_CREDIT, max(1, int(flow.get('window', DEFAULT_WINDOW)))
+
+
+def choose_transport(settings, encoding, flow):
+    """Транспорт кадров: разделяемая память только для бинарных кадров
+    и клиентов с каналом управления (режим кредитов)"""
+    offer = settings.get('protocol') or {}
+    if (offer.get('transport') == TRANSPORT_SHM and encoding == ENCODING_BINARY
+            and flow == FLOW_CREDIT):
+        return TRANSPORT_SHM
+    return TRANSPORT_SOCKET
+
+
+def max_points(settings):
+    """Бюджет точек клиента (None - передавать все частицы)"""
+    budget = (settings.get('protocol') or {}).get('max_points')
+    return max(1, int(budget)) if budget else None
+
+
+def parse_render(render, encoding=ENCODING_BINARY):
+    """Проверенный режим отображения: mode, axis ('x'/'y'/'z' - ось
+    проекции, None - объемная сетка) и bins (ячеек по оси). Кадры
+    плотности есть только в бинарной кодировке."""
+    render = render or {}
+    if render.get('mode') != RENDER_DENSITY or encoding != ENCODING_BINARY:
+        return {'mode': RENDER_POINTS}
+    axis = render.get('axis', 'z')
+    if axis not in AXES:
+        axis = None
+    limit = MAX_DENSITY_BINS[2 if axis else 3]
+    bins = min(max(2, int(render.get('bins', DENSITY_BINS))), limit)
+    return {'mode': RENDER_DENSITY, 'axis': axis, 'bins': bins}
+
+
+def render_options(settings, encoding=ENCODING_BINARY):
+    """Режим отображения, запрошенный клиентом"""
+    return parse_render((settings.get('protocol') or {}).get('render'), encoding)
+
+
+def frame_options(settings):
+    """Параметры кадров, запрошенные клиентом (проверенные)"""
+    frame = (settings.get('protocol') or {}).get('frame') or {}
+    options = {
+        'dtype': frame.get('dtype', 'float32'),
+        'compress': bool(frame.get('compress', False)),
+        'keyframe_interval': int(frame.get('keyframe_interval', 0))
+    }
+    if options['dtype'] not in DTYPE_NAMES:
+        print(f"Тип данных кадров {options['dtype']} отклонен, используется float32")
+        options['dtype'] = 'float32'
+    return options
+
+
+def create_encoder(settings):
+    """Кодировщик кадров по параметрам, запрошенным клиентом"""
+    return FrameEncoder(**frame_options(settings))
+
+
+def send_message(sock, payload):
+    """Отправка сообщения с 4-байтовым префиксом длины"""
+    sock.sendall(len(payload).to_bytes(4, byteorder='big'))
+    sock.sendall(payload)
+
+
+def send_control(sock, message):
+    """Отправка управляющего сообщения (JSON-объект с полем 'type')"""
+    send_message(sock, json.dumps(message).encode())
+
+
+def is_control_message(payload):
+    """Управляющие сообщения - JSON-объекты, кадры JSON - списки"""
+    return bytes(payload[:1]) == b'{'
+
+
+def recv_exact(sock, size):
+    """Чтение ровно size байт (None, если соединение закрыто)"""
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def recv_message(sock):
+    """Чтение сообщения с 4-байтовым префиксом длины"""
+    size_data = recv_exact(sock, 4)
+    if size_data is None:
+        return None
+    return recv_exact(sock, int.from_bytes(size_data, byteorder='big'))
+
+
+def recv_control(sock):
+    """Чтение управляющего сообщения (None, если соединение закрыто)"""
+    payload = recv_message(sock)
+    if payload is None:
+        return None
+    return json.loads(payload)
+
+
+def recv_settings(sock):
+    """Настройки клиента при подключении (None, если соединение закрыто).
+
+    Новые клиенты присылают их управляющим сообщением с префиксом длины.
+    Старые - JSON без префикса: он может прийти несколькими пакетами и
+    дочитывается, пока документ не станет целым (префикс длины не может
+    начинаться с '{', поэтому форматы различаются по первому байту).
+    """
+    first = recv_exact(sock, 1)
+    if first is None:
+        return None
+    if first != b'{':
+        rest = recv_exact(sock, 3)
+        if rest is None:
+            return None
+        payload = recv_exact(sock, int.from_bytes(first + rest, byteorder='big'))
+        return None if payload is None else json.loads(payload)
+    data = bytearray(first)
+    while True:
+        settings = parse_legacy_settings(data)
+        if settings is not None:
+            return settings
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise ValueError("Соединение закрыто до конца настроек")
+        data += chunk
+
+
+def parse_legacy_settings(data):
+    """Разбор настроек старого клиента: None, пока JSON пришел не целиком"""
+    if len(data) > MAX_LEGACY_SETTINGS:
+        raise ValueError("Слишком длинные настройки клиента")
+    try:
+        return json.loads(data)
+    except ValueError:
+        return None
+
+
+def read_ack_reply(sock):
+    """Ответ клиента на кадр в режиме ACK: None для b'ACK' или управляющее
+    сообщение с префиксом длины, которое клиент присылает вместо ACK.
+
+    Читается ровно один ответ, сколько бы пакетов он ни занял. Закрытие
+    соединения и b'STOP' старого клиента - ConnectionError.
+    """
+    head = recv_exact(sock, 3)
+    if head == b'ACK':
+        return None
+    if head is None or head == b'STO':
+        raise ConnectionError("Клиент завершил прием кадров")
+    # Не ACK - значит первые байты префикса длины
+    tail = recv_exact(sock, 1)
+    payload = None if tail is None else recv_exact(
+        sock, int.from_bytes(head + tail, byteorder='big'))
+    if payload is None:
+        raise ConnectionError("Соединение закрыто посреди сообщения")
+    if not is_control_message(payload):
+        raise ValueError("Неизвестный ответ клиента на кадр")
+    return json.loads(payload)
@@ -1,9 +1,15 @@
 import socket
+import sys
 import threading
 import time
-import random
-from particle import Particle
-from mpi4py import MPI
+from collections import deque
+from particle import Decimator, ParticleSystem, density_grid, positions_to_dicts
+from profiler import PROFILE_TOP, Profiler, format_profile
+from shared_frames import SharedFrameRing
+from simulation import Replay, Simulation, hot_changes
+from stats import RollingStats
+from trajectory import Trajectory
+import protocol
 import json  # Добавляем импортирование json модуля
 
 class Server:
@@ -12,9 +18,40 @@ class Server:
         self.port = port
         self.server_socket = None
         self.client_socket = None
-        self.particles = []
+        self.particles = ParticleSystem()
         self.running = False
+        # Физика (свой поток) и отправка кадров (поток публикации);
+        # в режиме воспроизведения вместо физики - Replay записанной траектории
+        self.simulation = None
+        self.replay = None
         self.simulation_thread = None
+        # Настройки текущей симуляции (для изменения параметров на ходу)
+        self.settings = {}
+        self.encoding = protocol.ENCODING_JSON
+        self.encoder = protocol.FrameEncoder()
+        # Кадры по сокету или через кольцо в разделяемой памяти (GUI на этой же
+        # машине; по сокету тогда идут только управляющие сообщения)
+        self.transport = protocol.TRANSPORT_SOCKET
+        self.ring = None
+        # Устойчивая выборка частиц под бюджет точек клиента
+        self.decimator = Decimator()
+        # Точки или сетка плотности, посчитанная на сервере
+        self.render = protocol.parse_render(None)
+        # Период сообщения 'stats' со временем фаз, с
+        self.stats_interval = 1.0
+        # Профилирование по запросу клиента (выключено до команды)
+        self.profiler = Profiler()
+        # Управляющие сообщения клиенту, которые отправит поток публикации
+        self.outbox = deque()
+
+        # Управление потоком: ACK на каждый кадр или кредит на N кадров
+        self.flow = protocol.FLOW_ACK
+        self.credits = 0
+        # Клиент прислал предложение протокола и понимает управляющие
+        # сообщения (в том числе в режиме ACK); старые клиенты - нет
+        self.accepts_control = False
+        self.credit_condition = threading.Condition()
+        self.control_thread = None
 
     def create_particles(self, settings):
         """Создание частиц с заданными параметрами"""
@@ -24,88 +61,384 @@ class Server:
         print(f"Size: {settings['size']}")
         print(f"Mass: {settings['mass']}")
         print(f"Count: {settings['frequency']}")
+        print(f"Integrator: {settings.get('integrator', 'ballistic')}")
+        print(f"Seed: {settings.get('seed')}")
 
-        # Очищаем текущие частицы
-        self.particles.clear()
-        
-        # Создаем новые частицы
-        for _ in range(int(settings['frequency'])):
-            particle = Particle(
-                x=random.uniform(0, 1),
-                y=random.uniform(0, 1),
-                z=random.uniform(0, 1),
-                radius=settings['size'],
-                mass=settings['mass'],
-                temperature=settings['temperature'],
-                viscosity=settings['viscosity']
-            )
-            self.particles.append(particle)
+        # Создаем новые частицы одним набором массивов
+        self.particles = ParticleSystem.from_settings(settings)
+
+    def take_credit(self, timeout=0.5):
+        """Списание одного кадра из кредита клиента (ждет не дольше timeout)"""
+        with self.credit_condition:
+            if not self.credit_condition.wait_for(lambda: self.credits > 0, timeout):
+                return False
+            self.credits -= 1
+            return True
+
+    def encode_frame(self, snapshot):
+        """Кодирование снимка (или его выборки) в согласованном формате"""
+        render = self.render
+        if render['mode'] == protocol.RENDER_DENSITY:
+            grid = density_grid(snapshot.positions, render['bins'],
+                                protocol.AXES.get(render['axis']))
+            return self.encoder.encode_density(snapshot.seq, grid, len(snapshot.positions))
+
+        positions, changed = self.decimator.sample(snapshot.positions, snapshot.ids)
+        if self.encoding == protocol.ENCODING_BINARY:
+            if changed:
+                self.encoder.reset()
+            return self.encoder.encode(snapshot.seq, positions,
+                                       total=len(snapshot.positions))
+        return json.dumps(positions_to_dicts(positions)).encode()
+
+    def stats_message(self, stats, frames_per_second):
+        """Сообщение 'stats': квантили фаз физики и отправки, частоты"""
+        phases = dict(self.simulation.stats.summary(), **stats.summary())
+        return {'type': 'stats', 'phases': phases, 'flow': self.flow,
+                'frames_per_second': frames_per_second,
+                'steps_per_second': self.simulation.steps_per_second,
+                'step': self.simulation.step_count}
 
     def simulate(self):
-        """Основной цикл симуляции"""
+        """Цикл публикации: отправка последнего снимка физики клиенту.
+
+        Физика идет в собственном потоке (Simulation) с заданной частотой;
+        здесь кодируется и отправляется только самый свежий снимок, поэтому
+        медленный клиент не тормозит шаги, а лишь получает меньше кадров.
+        """
+        # Сокет и кольцо этого подключения: после переподключения прежний
+        # поток публикации не должен писать новому клиенту
+        client_socket = self.client_socket
+        ring = self.ring
+        # Кредит нужен только кадрам в сокете: кольцо писатель не ждет
+        credit = self.flow == protocol.FLOW_CREDIT and ring is None
+        last_seq = 0
+        frames_sent = 0
+        report_time = time.perf_counter()
+        replay_report_time = 0.0
+        # Время фаз отправки (encode_ms, send_ms, ack_wait_ms, credit_wait_ms)
+        # и размер кадров (frame_bytes)
+        stats = RollingStats()
+        stats_frames = 0
+        stats_time = report_time
         while self.running:
+            self.profiler.boundary()
             try:
-                # Обновляем позиции частиц
-                for particle in self.particles:
-                    particle.update_position(0.01)  # dt = 0.01 секунды
-
-                # Собираем данные о частицах
-                particles_data = []
-                for particle in self.particles:
-                    particles_data.append({
-                        'x': particle.x,
-                        'y': particle.y,
-                        'z': particle.z
-                    })
-
-                # Преобразуем данные в JSON и получаем размер
-                data = json.dumps(particles_data).encode()
-                msg_size = len(data)
-
-                # Отправляем размер сообщения (4 байта)
-                self.client_socket.sendall(msg_size.to_bytes(4, byteorder='big'))
-                
-                # Отправляем само сообщение
-                self.client_socket.sendall(data)
+                # Положение воспроизведения, статистика и ответы на команды -
+                # из этого же потока, между кадрами (в том числе на паузе,
+                # когда новых кадров нет)
+                while self.outbox:
+                    protocol.send_control(client_socket, self.outbox.popleft())
+                if self.accepts_control:
+                    now = time.perf_counter()
+                    if self.replay and now - replay_report_time >= 0.25:
+                        protocol.send_control(client_socket,
+                                              dict(self.replay.state(), type='replay'))
+                        replay_report_time = now
+                    if now - stats_time >= self.stats_interval:
+                        protocol.send_control(client_socket, self.stats_message(
+                            stats, stats_frames / (now - stats_time)))
+                        stats_frames = 0
+                        stats_time = now
+
+                # Без кредита не отправляем: к его приходу будет свежее состояние
+                if credit:
+                    start = time.perf_counter()
+                    if not self.take_credit(timeout=0.25):
+                        continue
+                    stats.add('credit_wait_ms', (time.perf_counter() - start) * 1000)
+
+                snapshot = self.simulation.snapshot.acquire(newer_than=last_seq, timeout=0.25)
+                if snapshot is None:
+                    if credit:
+                        with self.credit_condition:
+                            self.credits += 1
+                    continue
+                last_seq = snapshot.seq
+
+                # Отправляем кадр с префиксом размера (4 байта) или пишем в кольцо
+                start = time.perf_counter()
+                data = self.encode_frame(snapshot)
+                encoded = time.perf_counter()
+                if ring is None:
+                    protocol.send_message(client_socket, data)
+                elif not ring.write(data):
+                    ring = self.grow_ring(client_socket, len(data))
+                    ring.write(data)
+                sent = time.perf_counter()
+                stats.add('encode_ms', (encoded - start) * 1000)
+                stats.add('send_ms', (sent - encoded) * 1000)
+                stats.add('frame_bytes', len(data))
+                frames_sent += 1
+                stats_frames += 1
                     
-                # Ждем подтверждения от клиента
-                try:
-                    self.client_socket.recv(1024)
-                except:
-                    print("Ошибка при получении подтверждения от клиента")
-                    break
+                # Ждем подтверждения от клиента (режим совместимости)
+                if self.flow == protocol.FLOW_ACK:
+                    try:
+                        command = protocol.read_ack_reply(client_socket)
+                    except:
+                        print("Ошибка при получении подтверждения от клиента")
+                        break
+                    stats.add('ack_wait_ms', (time.perf_counter() - sent) * 1000)
+                    # Вместо ACK клиент может прислать команду профилирования;
+                    # остальные команды требуют режима кредитов
+                    if command and command.get('type') == 'profile':
+                        self.handle_profile(command)
+                    elif command:
+                        self.post_control({'type': 'error', 'message':
+                                           f"Команда {command.get('type')} требует режима кредитов"})
 
-                time.sleep(0.01)  # Небольшая задержка для стабильной анимации
+                now = time.perf_counter()
+                if now - report_time >= 5.0:
+                    print(f"Физика: {self.simulation.steps_per_second:.1f} шаг/с, "
+                          f"отправка: {frames_sent / (now - report_time):.1f} кадр/с")
+                    frames_sent = 0
+                    report_time = now
 
             except Exception as e:
                 print(f"Ошибка в цикле симуляции: {e}")
                 break
+        self.profiler.leave()
+
+    def grow_ring(self, client_socket, size):
+        """Новое кольцо под кадр size байт (вызывается потоком публикации)"""
+        ring = SharedFrameRing.create(2 * size)
+        old, self.ring = self.ring, ring
+        protocol.send_control(client_socket, {'type': 'shm', 'name': ring.name})
+        print(f"Кольцо кадров увеличено до {ring.capacity} байт на слот")
+        if old:
+            old.close()
+        return ring
+
+    def close_ring(self):
+        """Удаление кольца кадров прежнего клиента"""
+        ring, self.ring = self.ring, None
+        if ring:
+            ring.close()
+
+    def post_control(self, message):
+        """Управляющее сообщение клиенту: через поток публикации, чтобы не
+        разорвать кадр, или сразу, если публикация остановлена"""
+        if self.running:
+            self.outbox.append(message)
+        else:
+            protocol.send_control(self.client_socket, message)
+
+    def handle_profile(self, message):
+        """Окно профилирования: 'start' включает, 'stop' возвращает сводку"""
+        action = message.get('action')
+        if action == 'start':
+            if self.profiler.start():
+                print("Профилирование включено")
+            return
+        if action != 'stop':
+            self.post_control({'type': 'error',
+                               'message': f"Неизвестная команда профиля: {action}"})
+            return
+        try:
+            summary = self.profiler.stop(top=int(message.get('top', PROFILE_TOP)),
+                                         sort=message.get('sort', 'cumulative'))
+        except ValueError as e:
+            self.post_control({'type': 'error', 'message': str(e)})
+            return
+        if summary is None:
+            self.post_control({'type': 'error', 'message': "Профилирование не запущено"})
+            return
+        print(format_profile(summary))
+        self.post_control({'type': 'profile', 'profiles': [summary]})
+
+    def stop_simulation(self):
+        """Остановка потоков физики и публикации"""
+        self.running = False
+        if self.simulation_thread and self.simulation_thread is not threading.current_thread():
+            self.simulation_thread.join(timeout=1.0)
+        if self.simulation:
+            self.simulation.stop()
+
+    def disconnect_client(self):
+        """Отключение прежнего клиента перед приемом нового.
+
+        Сокет закрывается, а поток чтения его сообщений завершается до
+        того, как сервер переключится на новое соединение: иначе старый
+        клиент мог бы менять кредиты и симуляцию нового.
+        """
+        self.stop_simulation()
+        client_socket, self.client_socket = self.client_socket, None
+        if client_socket:
+            try:
+                # shutdown прерывает recv, в котором ждет поток чтения
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            client_socket.close()
+        control_thread, self.control_thread = self.control_thread, None
+        if control_thread and control_thread is not threading.current_thread():
+            control_thread.join(timeout=1.0)
+
+    def restart_simulation(self, settings):
+        """Пересоздание частиц и перезапуск потоков физики и публикации"""
+        # Останавливаем текущую симуляцию если она запущена
+        self.stop_simulation()
+        self.settings = dict(settings)
+
+        # Новый набор частиц; прежний не очищаем на месте - его еще может
+        # держать не успевший остановиться поток физики
+        self.particles = ParticleSystem()
+        
+        if settings.get('replay'):
+            # Воспроизведение записи: без расчета, кадры читаются с диска
+            try:
+                trajectory = Trajectory(settings['replay'])
+            except (OSError, ValueError, KeyError) as e:
+                # Потоки публикации остановлены: сообщение не смешается с кадрами
+                print(f"Не удалось открыть траекторию: {e}")
+                protocol.send_control(self.client_socket, {
+                    'type': 'error', 'message': f"Не удалось открыть траекторию: {e}"})
+                return
+            print(f"Воспроизведение {settings['replay']}: {len(trajectory)} кадров, "
+                  f"{trajectory.positions.shape[1]} частиц")
+            self.replay = Replay(trajectory, rate=settings.get('replay_rate', 30))
+            self.simulation = self.replay
+        else:
+            self.replay = None
+            # Контрольные точки: файл и интервал в шагах
+            checkpoint = settings.get('checkpoint')
+            interval = int(settings.get('checkpoint_interval', 1000)) if checkpoint else 0
+            rate = settings.get('step_rate', 100)
+            collide = bool(settings.get('collisions', False))
+            if settings.get('resume'):
+                # Продолжение с контрольной точки вместо создания частиц
+                self.simulation = Simulation.resume(settings['resume'], rate=rate,
+                                                    checkpoint=checkpoint,
+                                                    checkpoint_interval=interval,
+                                                    collide=collide)
+                self.particles = self.simulation.system
+                print(f"Продолжение с {settings['resume']}: шаг {self.simulation.step_count}, "
+                      f"{len(self.particles)} частиц")
+            else:
+                # Создаем частицы с новыми настройками
+                self.create_particles(settings)
+
+                # Физика в своем потоке с целевой частотой шагов
+                self.simulation = Simulation(self.particles, dt=0.01, rate=rate,
+                                             checkpoint=checkpoint, checkpoint_interval=interval,
+                                             collide=collide)
+        self.simulation.profiler = self.profiler
+        self.simulation.start()
+
+        # Отправку кадров ведет отдельный поток
+        self.running = True
+        self.simulation_thread = threading.Thread(target=self.simulate, name='publisher')
+        self.simulation_thread.daemon = True
+        self.simulation_thread.start()
+
+    def update_simulation(self, settings):
+        """Изменение настроек: на ходу, если это возможно, иначе перезапуск.
+
+        Температура, вязкость, число и размер частиц и т.п. применяются
+        потоком физики между шагами, и поток кадров не прерывается.
+        Остальные настройки (seed, replay, resume, ...) и остановленная
+        симуляция ведут к полному перезапуску.
+        """
+        changes = hot_changes(self.settings, settings)
+        simulation = self.simulation
+        if changes is None or not isinstance(simulation, Simulation) or not simulation.running:
+            self.restart_simulation(dict(self.settings, **settings))
+            return
+        if changes:
+            simulation.update(changes)
+        self.settings.update(settings)
+
+    def handle_control(self, message):
+        """Обработка управляющего сообщения клиента"""
+        kind = message.get('type')
+        if kind == 'credit':
+            with self.credit_condition:
+                self.credits += int(message.get('frames', 1))
+                self.credit_condition.notify()
+        elif kind == 'settings':
+            print(f"Получены настройки: {message['settings']}")
+            self.restart_simulation(message['settings'])
+        elif kind == 'update':
+            print(f"Изменение настроек: {message['settings']}")
+            self.update_simulation(message['settings'])
+        elif kind == 'replay':
+            if self.replay:
+                self.replay.control(seek=message.get('seek'), speed=message.get('speed'),
+                                    skip=message.get('skip'), paused=message.get('paused'))
+        elif kind == 'render':
+            self.render = protocol.parse_render(message.get('render'), self.encoding)
+            print(f"Режим отображения: {self.render}")
+        elif kind == 'profile':
+            self.handle_profile(message)
+        elif kind == 'stop':
+            self.stop_simulation()
+        else:
+            print(f"Неизвестное управляющее сообщение: {kind}")
+
+    def read_control(self, client_socket):
+        """Чтение управляющих сообщений клиента в режиме кредитов"""
+        while True:
+            try:
+                message = protocol.recv_control(client_socket)
+            except (OSError, ValueError) as e:
+                print(f"Ошибка при чтении управляющего сообщения: {e}")
+                break
+            if message is None:
+                break
+            self.handle_control(message)
 
     def handle_client(self, client_socket):
         """Обработка подключения клиента"""
         try:
             # Получаем настройки
-            data = client_socket.recv(1024).decode()
-            settings = json.loads(data)
-            print(f"Получены настройки: {data}")
+            settings = protocol.recv_settings(client_socket)
+            if settings is None:
+                return
+            print(f"Получены настройки: {settings}")
             
             # Останавливаем текущую симуляцию если она запущена
-            if self.running:
-                self.running = False
-                if self.simulation_thread:
-                    self.simulation_thread.join()
+            self.stop_simulation()
+            self.outbox.clear()
             
-            # Очищаем список частиц
-            self.particles.clear()
-            
-            # Создаем частицы с новыми настройками
-            self.create_particles(settings)
-            
-            # Запускаем симуляцию в отдельном потоке
-            self.running = True
-            self.simulation_thread = threading.Thread(target=self.simulate)
-            self.simulation_thread.daemon = True
-            self.simulation_thread.start()
+            # Согласуем формат кадров и управление потоком: новые клиенты
+            # присылают поле 'protocol' и получают ответ, старые продолжают
+            # получать JSON и подтверждать каждый кадр
+            self.encoding = protocol.choose_encoding(settings)
+            self.encoder = protocol.create_encoder(settings)
+            self.decimator = Decimator(protocol.max_points(settings))
+            self.render = protocol.render_options(settings, self.encoding)
+            self.flow, window = protocol.choose_flow(settings)
+            self.accepts_control = 'protocol' in settings
+            with self.credit_condition:
+                self.credits = window
+            self.transport = protocol.choose_transport(settings, self.encoding, self.flow)
+            self.close_ring()
+            if self.transport == protocol.TRANSPORT_SHM:
+                # Читатель берет только последний кадр: без разностей и сжатия
+                self.encoder = protocol.FrameEncoder(dtype=self.encoder.options()['dtype'])
+                self.ring = SharedFrameRing.create(0)
+            if 'protocol' in settings:
+                protocol.send_control(client_socket, {
+                    'type': 'hello',
+                    'version': protocol.PROTOCOL_VERSION,
+                    'encoding': self.encoding,
+                    'frame': self.encoder.options(),
+                    'flow': {'mode': self.flow, 'window': window},
+                    'max_points': self.decimator.budget,
+                    'render': self.render,
+                    'transport': {'mode': self.transport,
+                                  'name': self.ring.name if self.ring else None}
+                })
+
+            # В режиме кредитов сообщения клиента читает отдельный поток
+            if self.flow == protocol.FLOW_CREDIT:
+                self.control_thread = threading.Thread(
+                    target=self.read_control, args=(client_socket,), name='control')
+                self.control_thread.daemon = True
+                self.control_thread.start()
+
+            self.restart_simulation(settings)
             
         except Exception as e:
             print(f"Ошибка при обработке клиента: {e}")
@@ -120,9 +453,14 @@ class Server:
             print(f"Server listening on {self.host}:{self.port}")
 
             while True:
-                self.client_socket, addr = self.server_socket.accept()
+                client_socket, addr = self.server_socket.accept()
+                # Префикс длины и кадр уходят разными send: без TCP_NODELAY
+                # алгоритм Нейгла и отложенный ACK добавляют ~40 мс на кадр
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                 print(f"Accepted connection from {addr}")
-                self.handle_client(self.client_socket)
+                self.disconnect_client()
+                self.client_socket = client_socket
+                self.handle_client(client_socket)
 
         except Exception as e:
             print(f"Server error: {e}")
@@ -134,6 +472,9 @@ class Server:
         self.running = False
         if self.simulation_thread and self.simulation_thread.is_alive():
             self.simulation_thread.join(timeout=1.0)
+        if self.simulation:
+            self.simulation.stop()
+        self.close_ring()
         if self.client_socket:
             self.client_socket.close()
         if self.server_socket:
@@ -152,20 +493,13 @@ class MPIParticleSimulation:
         while True:
             try:
                 # Обновляем позиции частиц
-                for particle in self.server.particles:
-                    particle.update_position(0.05)
-
-                # Проверяем столкновения между частицами
-                for i in range(len(self.server.particles)):
-                    for j in range(i + 1, len(self.server.particles)):
-                        if self.server.particles[i].check_collision(self.server.particles[j]):
-                            # Обмен скоростями при столкновении
-                            self.server.particles[i].vx, self.server.particles[j].vx = self.server.particles[j].vx, self.server.particles[i].vx
-                            self.server.particles[i].vy, self.server.particles[j].vy = self.server.particles[j].vy, self.server.particles[i].vy
-                            self.server.particles[i].vz, self.server.particles[j].vz = self.server.particles[j].vz, self.server.particles[i].vz
+                self.server.particles.step(0.05)
+
+                # Проверяем столкновения между частицами и обмениваемся скоростями
+                self.server.particles.collide()
 
                 # Отправка координат
-                coordinates = [(p.x, p.y, p.z) for p in self.server.particles]
+                coordinates = self.server.particles.positions.tolist()
                 try:
                     # Отправляем длину сообщения первым
                     data = json.dumps(coordinates).encode()
@@ -213,8 +547,9 @@ def main():
         print(f"Ошибка в главной функции: {e}")
         
     finally:
-        # Финализируем MPI
-        MPI.Finalize()
+        # Финализируем MPI, если он был запущен (mpi4py загружается лениво)
+        if 'mpi4py.MPI' in sys.modules:
+            sys.modules['mpi4py.MPI'].Finalize()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,415 @@
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import uuid
+import protocol
+from particle import Decimator, ParticleSystem, density_grid, positions_to_dicts
+from simulation import Simulation, hot_changes
+
+
+def run_session(settings, encoding, options, budget, render, connection, control, stop_event):
+    """Процесс сессии: физика и кодирование кадров вне процесса сервера.
+
+    Кадры уходят в канал connection; если главный процесс не успевает их
+    забирать, блокируется только отправка, а физика продолжает шаги.
+    Из канала control приходят изменения настроек для Simulation.update.
+    """
+    system = ParticleSystem.from_settings(settings)
+    simulation = Simulation(system, dt=0.01, rate=settings.get('step_rate', 100))
+    simulation.start()
+    encoder = protocol.FrameEncoder(**options)
+    decimator = Decimator(budget)
+
+    last_seq = 0
+    try:
+        while not stop_event.is_set():
+            while control.poll():
+                simulation.update(control.recv())
+            snapshot = simulation.snapshot.acquire(newer_than=last_seq, timeout=0.5)
+            if snapshot is None:
+                continue
+            last_seq = snapshot.seq
+            if render['mode'] == protocol.RENDER_DENSITY:
+                grid = density_grid(snapshot.positions, render['bins'],
+                                    protocol.AXES.get(render['axis']))
+                connection.send_bytes(encoder.encode_density(last_seq, grid,
+                                                             len(snapshot.positions)))
+                continue
+            positions, _ = decimator.sample(snapshot.positions, snapshot.ids)
+            if encoding == protocol.ENCODING_BINARY:
+                data = encoder.encode(last_seq, positions, total=len(snapshot.positions))
+            else:
+                data = json.dumps(positions_to_dicts(positions)).encode()
+            connection.send_bytes(data)
+    except (BrokenPipeError, EOFError, OSError):
+        pass
+    finally:
+        simulation.stop()
+        connection.close()
+        control.close()
+
+
+class SessionSubscriber:
+    """Клиент, подключенный к сессии: последний кадр и управление потоком"""
+
+    def __init__(self, client_socket, flow, window, handle_control=None):
+        self.client_socket = client_socket
+        self.flow = flow
+        self.credits = window
+        # Команды, которые клиент в режиме ACK присылает вместо подтверждения;
+        # обработчик возвращает False, если клиент завершает прием кадров
+        self.handle_control = handle_control
+        self.condition = threading.Condition()
+        self.latest = None
+        self.active = True
+
+    def offer(self, data):
+        """Новый кадр сессии; неотправленный предыдущий заменяется"""
+        with self.condition:
+            self.latest = data
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.active = False
+            self.condition.notify_all()
+
+    def add_credit(self, frames):
+        with self.condition:
+            self.credits += frames
+            self.condition.notify_all()
+
+    def run(self):
+        """Отправка кадров клиенту (ACK на каждый кадр или по кредиту)"""
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: not self.active or (
+                    self.latest is not None
+                    and (self.flow == protocol.FLOW_ACK or self.credits > 0)))
+                if not self.active:
+                    return
+                data, self.latest = self.latest, None
+                if self.flow == protocol.FLOW_CREDIT:
+                    self.credits -= 1
+            try:
+                protocol.send_message(self.client_socket, data)
+                if self.flow != protocol.FLOW_ACK:
+                    continue
+                message = protocol.read_ack_reply(self.client_socket)
+            except (OSError, ValueError):
+                return
+            if message and self.handle_control and self.handle_control(message) is False:
+                return
+
+
+class Session:
+    """Симуляция в отдельном процессе и ее подписчики"""
+
+    def __init__(self, session_id, settings, encoding, options, budget, render, context):
+        self.session_id = session_id
+        self.settings = settings
+        self.encoding = encoding
+        self.options = options
+        self.budget = budget
+        self.render = render
+        self.context = context
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.idle_since = time.monotonic()
+        self.process = None
+        self.connection = None
+        self.control = None
+        self.stop_event = None
+
+    def start(self):
+        """Запуск процесса сессии и потока пересылки кадров"""
+        receiver, sender = self.context.Pipe(duplex=False)
+        control_receiver, control_sender = self.context.Pipe(duplex=False)
+        self.stop_event = self.context.Event()
+        self.process = self.context.Process(
+            target=run_session,
+            args=(self.settings, self.encoding, self.options, self.budget, self.render,
+                  sender, control_receiver, self.stop_event),
+            daemon=True)
+        self.process.start()
+        sender.close()
+        control_receiver.close()
+        self.connection = receiver
+        self.control = control_sender
+
+        forwarder = threading.Thread(target=self.forward, args=(receiver,))
+        forwarder.daemon = True
+        forwarder.start()
+
+    def forward(self, connection):
+        """Раздача кадров процесса сессии подписчикам"""
+        while True:
+            try:
+                data = connection.recv_bytes()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                subscribers = list(self.subscribers)
+            for subscriber in subscribers:
+                subscriber.offer(data)
+
+    def stop(self):
+        """Остановка процесса сессии"""
+        if self.stop_event:
+            self.stop_event.set()
+        if self.process:
+            self.process.join(timeout=2.0)
+            if self.process.is_alive():
+                self.process.terminate()
+        if self.connection:
+            self.connection.close()
+        if self.control:
+            self.control.close()
+
+    def restart(self, settings):
+        """Перезапуск сессии с новыми настройками под тем же идентификатором"""
+        self.stop()
+        self.settings = settings
+        self.start()
+
+    def update(self, settings):
+        """Изменение настроек на ходу: процесс сессии применяет их между
+        шагами; настройки, требующие пересоздания частиц, - перезапуск"""
+        with self.lock:
+            changes = hot_changes(self.settings, settings)
+            alive = self.process is not None and self.process.is_alive()
+            if changes is not None and alive:
+                if changes:
+                    self.control.send(changes)
+                self.settings = dict(self.settings, **settings)
+                return
+        self.restart(dict(self.settings, **settings))
+
+    def attach(self, subscriber):
+        with self.lock:
+            self.subscribers.add(subscriber)
+
+    def detach(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+            if not self.subscribers:
+                self.idle_since = time.monotonic()
+
+    def describe(self):
+        """Краткое описание сессии для клиентов"""
+        with self.lock:
+            subscribers = len(self.subscribers)
+        return {
+            'session': self.session_id,
+            'particles': int(self.settings['frequency']),
+            'encoding': self.encoding,
+            'max_points': self.budget,
+            'render': self.render,
+            'subscribers': subscribers,
+            'alive': bool(self.process and self.process.is_alive())
+        }
+
+
+class SessionManager:
+    """Ограниченный пул сессий, каждая - в своем процессе.
+
+    Независимые запуски с разными параметрами идут на разных ядрах и не
+    вытесняют друг друга. Сессия без подписчиков живет idle_timeout
+    секунд, чтобы к ней можно было переподключиться.
+    """
+
+    def __init__(self, max_sessions=None, idle_timeout=60.0):
+        self.max_sessions = max_sessions or os.cpu_count() or 1
+        self.idle_timeout = idle_timeout
+        self.context = multiprocessing.get_context('spawn')
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def reap_idle(self):
+        """Закрытие сессий без подписчиков дольше idle_timeout"""
+        now = time.monotonic()
+        with self.lock:
+            idle = [session for session in self.sessions.values()
+                    if not session.subscribers and now - session.idle_since > self.idle_timeout]
+            for session in idle:
+                del self.sessions[session.session_id]
+        for session in idle:
+            print(f"Сессия {session.session_id} закрыта: нет подписчиков")
+            session.stop()
+
+    def create(self, settings, encoding, options, budget=None, render=None):
+        """Новая сессия; RuntimeError, если пул заполнен"""
+        self.reap_idle()
+        with self.lock:
+            if len(self.sessions) >= self.max_sessions:
+                raise RuntimeError(f"Достигнут предел сессий: {self.max_sessions}")
+            session = Session(uuid.uuid4().hex[:8], settings, encoding, options, budget,
+                              render or protocol.parse_render(None), self.context)
+            self.sessions[session.session_id] = session
+        session.start()
+        print(f"Сессия {session.session_id} запущена: {settings['frequency']} частиц")
+        return session
+
+    def get(self, session_id):
+        with self.lock:
+            return self.sessions.get(session_id)
+
+    def describe(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+        return [session.describe() for session in sessions]
+
+    def shutdown(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            session.stop()
+
+
+class SessionServer:
+    """Сервер сессий: клиент в рукопожатии указывает 'session' - 'new'
+    (или ничего) для новой сессии либо идентификатор существующей"""
+
+    def __init__(self, host='127.0.0.2', port=12345, max_sessions=None):
+        self.host = host
+        self.port = port
+        self.manager = SessionManager(max_sessions)
+        self.server_socket = None
+
+    def open_session(self, settings):
+        """Сессия для клиента: существующая или новая"""
+        encoding = protocol.choose_encoding(settings)
+        options = protocol.frame_options(settings)
+        # Кадры одной сессии получают несколько клиентов с пропусками,
+        # поэтому разностные кадры не используются
+        options['keyframe_interval'] = 0
+
+        requested = settings.get('session', 'new')
+        if requested != 'new':
+            session = self.manager.get(requested)
+            if session is None:
+                raise LookupError(f"Сессия {requested} не найдена")
+            if session.encoding != encoding:
+                raise ValueError(f"Сессия {requested} передает кадры {session.encoding}")
+            return session
+        return self.manager.create(settings, encoding, options, protocol.max_points(settings),
+                                   protocol.render_options(settings, encoding))
+
+    def read_control(self, client_socket, session, subscriber):
+        """Сообщения клиента в режиме кредитов"""
+        while True:
+            try:
+                message = protocol.recv_control(client_socket)
+            except (OSError, ValueError):
+                break
+            if message is None or not self.handle_control(client_socket, session,
+                                                          subscriber, message):
+                break
+        subscriber.close()
+
+    def handle_control(self, client_socket, session, subscriber, message):
+        """Команда клиента сессии; False - клиент завершает прием кадров"""
+        kind = message.get('type')
+        if kind == 'credit':
+            subscriber.add_credit(int(message.get('frames', 1)))
+        elif kind == 'settings':
+            print(f"Сессия {session.session_id}: новые настройки {message['settings']}")
+            session.restart(message['settings'])
+        elif kind == 'update':
+            print(f"Сессия {session.session_id}: изменение настроек {message['settings']}")
+            session.update(message['settings'])
+        elif kind == 'sessions':
+            protocol.send_control(client_socket, {'type': 'sessions',
+                                                  'sessions': self.manager.describe()})
+        elif kind == 'render':
+            # Кадры сессии общие для всех ее подписчиков
+            protocol.send_control(client_socket, {
+                'type': 'error',
+                'message': "Режим отображения задается при создании сессии"})
+        elif kind == 'stop':
+            return False
+        return True
+
+    def handle_client(self, client_socket):
+        """Обслуживание одного клиента (в своем потоке)"""
+        subscriber = None
+        session = None
+        try:
+            settings = protocol.recv_settings(client_socket)
+            if settings is None:
+                return
+
+            try:
+                session = self.open_session(settings)
+            except (LookupError, ValueError, RuntimeError) as e:
+                print(f"Отказ в сессии: {e}")
+                protocol.send_control(client_socket, {'type': 'error', 'message': str(e)})
+                return
+
+            flow, window = protocol.choose_flow(settings)
+            if 'protocol' in settings:
+                protocol.send_control(client_socket, {
+                    'type': 'hello',
+                    'version': protocol.PROTOCOL_VERSION,
+                    'encoding': session.encoding,
+                    'frame': session.options,
+                    'flow': {'mode': flow, 'window': window},
+                    'max_points': session.budget,
+                    'render': session.render,
+                    'session': session.session_id,
+                    'sessions': self.manager.describe()
+                })
+
+            subscriber = SessionSubscriber(
+                client_socket, flow, window,
+                lambda message: self.handle_control(client_socket, session, subscriber, message))
+            session.attach(subscriber)
+            if flow == protocol.FLOW_CREDIT:
+                reader = threading.Thread(target=self.read_control,
+                                          args=(client_socket, session, subscriber))
+                reader.daemon = True
+                reader.start()
+            subscriber.run()
+
+        except Exception as e:
+            print(f"Ошибка при обработке клиента: {e}")
+        finally:
+            if session and subscriber:
+                session.detach(subscriber)
+            client_socket.close()
+
+    def start(self):
+        """Запуск сервера сессий"""
+        try:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server_socket.bind((self.host, self.port))
+            self.server_socket.listen()
+            print(f"Session server listening on {self.host}:{self.port}, "
+                  f"до {self.manager.max_sessions} сессий")
+
+            while True:
+                client_socket, addr = self.server_socket.accept()
+                print(f"Accepted connection from {addr}")
+                handler = threading.Thread(target=self.handle_client, args=(client_socket,))
+                handler.daemon = True
+                handler.start()
+
+        except Exception as e:
+            print(f"Server error: {e}")
+        finally:
+            self.close()
+
+    def close(self):
+        """Закрытие сервера и всех сессий"""
+        self.manager.shutdown()
+        if self.server_socket:
+            self.server_socket.close()
+
+
+if __name__ == "__main__":
+    SessionServer().start()
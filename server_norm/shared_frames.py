@@ -0,0 +1,187 @@
+import threading
+import zlib
+import numpy as np
+import protocol
+
+# Кольцо кадров в разделяемой памяти:
+#   заголовок uint64[4]: версия, число слотов, емкость слота (байт),
+#                        номер последнего записанного кадра
+#   слоты: uint64[3] (счетчик seqlock, размер кадра, номер кадра) + емкость
+# Кадры - те же бинарные кадры протокола (без префикса длины)
+RING_VERSION = 1
+RING_SLOTS = 3
+HEADER_WORDS = 4
+SLOT_WORDS = 3
+MIN_CAPACITY = 1 << 20
+
+# Сегменты, созданные этим процессом (их уже учитывает его трекер ресурсов)
+_created = set()
+
+
+class SharedFrameRing:
+    """Кольцо последних кадров в multiprocessing.shared_memory.
+
+    Пишет один процесс (сервер), читает другой (GUI на той же машине).
+    Каждый слот защищен seqlock: писатель делает счетчик нечетным,
+    копирует кадр и делает его снова четным; читатель разбирает слот
+    на месте и проверяет, что счетчик не менялся. Писатель никого не ждет, а
+    читатель при гонке просто берет более свежий кадр.
+    """
+
+    def __init__(self, memory, owner):
+        self.memory = memory
+        self.owner = owner
+        self.header = np.ndarray(HEADER_WORDS, dtype=np.uint64, buffer=memory.buf)
+        if self.header[0] != RING_VERSION:
+            self.header = None
+            raise ValueError(f"Неподдерживаемая версия кольца кадров: {memory.name}")
+        self.slots = int(self.header[1])
+        self.capacity = int(self.header[2])
+        slot_size = SLOT_WORDS * 8 + self.capacity
+        self._meta = []
+        self._data = []
+        for slot in range(self.slots):
+            offset = HEADER_WORDS * 8 + slot * slot_size
+            self._meta.append(np.ndarray(SLOT_WORDS, dtype=np.uint64, buffer=memory.buf,
+                                         offset=offset))
+            self._data.append(memory.buf[offset + SLOT_WORDS * 8:offset + slot_size])
+
+    @classmethod
+    def create(cls, capacity, slots=RING_SLOTS):
+        """Новое кольцо со слотами не меньше capacity байт (процесс-писатель)"""
+        # multiprocessing загружается только при включении транспорта
+        from multiprocessing import shared_memory
+        capacity = max(int(capacity), MIN_CAPACITY)
+        size = HEADER_WORDS * 8 + slots * (SLOT_WORDS * 8 + capacity)
+        memory = shared_memory.SharedMemory(create=True, size=size)
+        _created.add(memory._name)
+        header = np.ndarray(HEADER_WORDS, dtype=np.uint64, buffer=memory.buf)
+        header[:] = (RING_VERSION, slots, capacity, 0)
+        del header
+        return cls(memory, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        """Подключение к кольцу писателя по имени (процесс-читатель)"""
+        from multiprocessing import resource_tracker, shared_memory
+        memory = shared_memory.SharedMemory(name=name)
+        # Сегментом владеет писатель: трекер ресурсов читателя не должен
+        # удалять его при выходе. Если писатель в этом же процессе, трекер
+        # общий и запись о сегменте остается за писателем
+        if memory._name not in _created:
+            resource_tracker.unregister(memory._name, 'shared_memory')
+        return cls(memory, owner=False)
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    @property
+    def latest(self):
+        """Номер последнего записанного кадра (0 - кадров еще не было)"""
+        return int(self.header[3])
+
+    def write(self, data):
+        """Запись кадра в следующий слот (False, если кадр не помещается)"""
+        size = len(data)
+        if size > self.capacity:
+            return False
+        number = self.latest + 1
+        meta = self._meta[number % self.slots]
+        meta[0] += 1  # нечетный: слот пишется
+        meta[1] = size
+        meta[2] = number
+        self._data[number % self.slots][:size] = data
+        meta[0] += 1
+        self.header[3] = number
+        return True
+
+    def read(self, newer_than=0, attempts=3, decode=bytes):
+        """Последний кадр новее newer_than: (номер, decode(слот)) или None.
+
+        decode получает memoryview слота без копирования и возвращает
+        собственную копию нужных данных (по умолчанию - байты кадра).
+        Результат принимается, только если seqlock подтверждает, что
+        писатель слот за это время не трогал; ошибка разбора слота,
+        который перезаписывался, означает лишь гонку.
+        """
+        for _ in range(attempts):
+            number = self.latest
+            if number <= newer_than:
+                return None
+            meta = self._meta[number % self.slots]
+            sequence = int(meta[0])
+            if sequence % 2:
+                continue
+            size = int(meta[1])
+            try:
+                data = decode(self._data[number % self.slots][:size])
+            except (ValueError, zlib.error):
+                if int(meta[0]) == sequence:
+                    raise
+                continue
+            if int(meta[0]) == sequence and int(meta[2]) == number:
+                return number, data
+        return None
+
+    def close(self):
+        """Отключение от сегмента; владелец также удаляет его"""
+        if self.header is None:
+            return
+        # Представления буфера нужно освободить до закрытия сегмента
+        self.header = None
+        self._meta = []
+        for view in self._data:
+            view.release()
+        self._data = []
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+            _created.discard(self.memory._name)
+
+
+class SharedFrameMailbox:
+    """Источник кадров для GUI из кольца в разделяемой памяти.
+
+    Интерфейс как у client.FrameMailbox: поток Tk по таймеру забирает
+    take() самый свежий кадр прямо из разделяемой памяти, без потока
+    приема и без сокета. received - кадров записано сервером, dropped -
+    из них не показано.
+    """
+
+    def __init__(self, name):
+        self._lock = threading.Lock()
+        self.ring = SharedFrameRing.attach(name)
+        self.decoder = protocol.FrameDecoder()
+        self.last = self.ring.latest
+        self.received = 0
+        self.dropped = 0
+
+    def attach(self, name):
+        """Переход на новое кольцо (сервер увеличил слоты)"""
+        with self._lock:
+            self.ring.close()
+            self.ring = SharedFrameRing.attach(name)
+            self.last = 0
+
+    def take(self):
+        """Последний кадр (protocol.Frame) или None, если нового кадра нет"""
+        with self._lock:
+            if self.ring.header is None:
+                return None
+            result = self.ring.read(self.last, decode=self.decode)
+            if result is None:
+                return None
+            number, frame = result
+            self.received += number - self.last
+            self.dropped += number - self.last - 1
+            self.last = number
+            return frame
+
+    def decode(self, payload):
+        """Кадр прямо из слота кольца: копируются только итоговые массивы"""
+        return protocol.detach_frame(self.decoder.decode(payload))
+
+    def close(self):
+        with self._lock:
+            self.ring.close()
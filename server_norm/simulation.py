@@ -0,0 +1,344 @@
+import threading
+import time
+from collections import namedtuple
+import numpy as np
+from checkpoint import Checkpointer, load_checkpoint
+from stats import RollingStats
+
+# Снимок состояния: номер, координаты (N, 3) и идентификаторы частиц
+Snapshot = namedtuple('Snapshot', ['seq', 'positions', 'ids'])
+
+# Настройки, которые меняются на ходу без пересоздания частиц;
+# остальные (seed, resume, replay, checkpoint, ...) требуют перезапуска
+HOT_SETTINGS = frozenset({'temperature', 'viscosity', 'frequency', 'size', 'mass',
+                          'integrator', 'step_rate', 'collisions'})
+
+
+def hot_changes(current, settings):
+    """Изменившиеся настройки {ключ: значение}, если все они меняются на
+    ходу, иначе None (нужен перезапуск)"""
+    changes = {key: value for key, value in settings.items() if current.get(key) != value}
+    if not changes.keys() <= HOT_SETTINGS:
+        return None
+    return changes
+
+
+class SnapshotBuffer:
+    """Тройной буфер последнего состояния частиц.
+
+    Поток физики пишет в свой задний буфер и под блокировкой меняет его
+    местами с готовым; читатель забирает готовый буфер в передний. Запись
+    никогда не касается буфера, который сейчас читается, поэтому ни
+    физика, ни отправка не ждут друг друга дольше обмена ссылками.
+    Рассчитан на одного писателя и одного читателя.
+    """
+
+    def __init__(self, dtype=np.float32):
+        self.dtype = dtype
+        self._condition = threading.Condition()
+        self._back = None
+        self._ready = None
+        self._front = None
+        self._ready_seq = 0
+        self._front_seq = 0
+        self._ready_ids = None
+        self._front_ids = None
+
+    def publish(self, positions, ids=None):
+        """Публикация нового состояния (вызывается потоком физики).
+
+        Массив ids не копируется: ParticleSystem заменяет его при
+        изменении набора частиц, а не меняет на месте.
+        """
+        back = self._back
+        if back is None or back.shape != positions.shape:
+            back = np.empty(positions.shape, dtype=self.dtype)
+        np.copyto(back, positions, casting='same_kind')
+
+        with self._condition:
+            self._back, self._ready = self._ready, back
+            self._ready_ids = ids
+            self._ready_seq += 1
+            self._condition.notify_all()
+
+    def acquire(self, newer_than=0, timeout=None):
+        """Самый свежий снимок новее newer_than (Snapshot) или None.
+
+        Массив принадлежит читателю до следующего вызова acquire.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._ready_seq > newer_than, timeout):
+                return None
+            if self._ready_seq > self._front_seq:
+                self._front, self._ready = self._ready, self._front
+                self._front_seq = self._ready_seq
+                self._front_ids = self._ready_ids
+            return Snapshot(self._front_seq, self._front, self._front_ids)
+
+
+class Simulation:
+    """Поток физики: шаги с целевой частотой независимо от отправки кадров.
+
+    После каждого шага состояние публикуется в snapshot; сетевой код
+    забирает оттуда только последний снимок. steps_per_second - измеренная
+    частота шагов за последнюю секунду. С checkpoint каждые
+    checkpoint_interval шагов состояние записывается в фоне в этот файл.
+    В stats - время фаз шага (step_ms, collide_ms, publish_ms); profiler
+    (Profiler или None) переключается на границе каждого шага.
+    update() меняет параметры на ходу: они применяются между шагами.
+    """
+
+    def __init__(self, system, dt=0.01, rate=100.0, checkpoint=None, checkpoint_interval=0,
+                 step_count=0, collide=False):
+        self.system = system
+        self.dt = dt
+        self.rate = rate  # шагов в секунду, 0 - без ограничения
+        self.collide = collide
+        self.stats = RollingStats()
+        self.profiler = None
+        self.snapshot = SnapshotBuffer()
+        self.step_count = step_count
+        self.checkpoint_interval = checkpoint_interval if checkpoint else 0
+        self.checkpointer = Checkpointer(checkpoint) if self.checkpoint_interval else None
+        self.steps_per_second = 0.0
+        self.running = False
+        self.thread = None
+        self._stop_lock = threading.Lock()
+        self._update_lock = threading.Lock()
+        self._update = None
+
+    @classmethod
+    def resume(cls, path, rate=100.0, checkpoint=None, checkpoint_interval=0, collide=False):
+        """Продолжение расчета с контрольной точки (тот же dt и номер шага)"""
+        system, step_count, dt = load_checkpoint(path)
+        return cls(system, dt=dt, rate=rate, checkpoint=checkpoint,
+                   checkpoint_interval=checkpoint_interval, step_count=step_count,
+                   collide=collide)
+
+    def capture(self):
+        """Состояние для контрольной точки (между шагами)"""
+        return dict(self.system.state(), step=self.step_count, dt=self.dt)
+
+    def start(self):
+        """Запуск потока физики"""
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='physics')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Остановка потока физики (stop может прийти сразу из двух потоков
+        сервера: каждый возвращается только после остановки)"""
+        self.running = False
+        with self._stop_lock:
+            stopped = True
+            if self.thread and self.thread is not threading.current_thread():
+                self.thread.join(timeout=1.0)
+                stopped = not self.thread.is_alive()
+            self.thread = None
+            checkpointer, self.checkpointer = self.checkpointer, None
+            if checkpointer:
+                # Последнее состояние - только если шаг точно не идет
+                if stopped:
+                    checkpointer.submit(self.capture())
+                checkpointer.close()
+
+    def update(self, settings):
+        """Изменение параметров на ходу (ключи HOT_SETTINGS).
+
+        Вызывается из любого потока: изменения копятся и применяются
+        потоком физики перед следующим шагом, поэтому шаг не видит
+        наполовину обновленную систему.
+        """
+        with self._update_lock:
+            self._update = dict(self._update or {}, **settings)
+
+    def apply_update(self):
+        """Применение накопленных изменений (поток физики, между шагами)"""
+        with self._update_lock:
+            settings, self._update = self._update, None
+        try:
+            self.system.update(temperature=settings.get('temperature'),
+                               viscosity=settings.get('viscosity'),
+                               count=settings.get('frequency'),
+                               radius=settings.get('size'),
+                               mass=settings.get('mass'),
+                               integrator=settings.get('integrator'))
+        except (ValueError, TypeError) as e:
+            print(f"Не удалось изменить параметры: {e}")
+        if 'step_rate' in settings:
+            self.rate = settings['step_rate']
+        if 'collisions' in settings:
+            self.collide = bool(settings['collisions'])
+        print(f"Параметры изменены: {settings}, частиц: {len(self.system)}")
+
+    def advance(self):
+        """Один шаг физики с публикацией снимка"""
+        if self._update is not None:
+            self.apply_update()
+        stats = self.stats
+        start = time.perf_counter()
+        self.system.step(self.dt)
+        stepped = time.perf_counter()
+        stats.add('step_ms', (stepped - start) * 1000)
+        if self.collide:
+            self.system.collide()
+            collided = time.perf_counter()
+            stats.add('collide_ms', (collided - stepped) * 1000)
+            stepped = collided
+        self.step_count += 1
+        self.snapshot.publish(self.system.positions, self.system.ids)
+        stats.add('publish_ms', (time.perf_counter() - stepped) * 1000)
+        checkpointer = self.checkpointer
+        if checkpointer and self.step_count % self.checkpoint_interval == 0:
+            checkpointer.submit(self.capture())
+
+    def run(self):
+        """Основной цикл физики"""
+        next_step = time.perf_counter()
+        window_start = next_step
+        window_steps = 0
+
+        profiler = self.profiler
+        while self.running:
+            if profiler:
+                profiler.boundary()
+            try:
+                self.advance()
+            except Exception as e:
+                print(f"Ошибка в цикле физики: {e}")
+                self.running = False
+                break
+
+            now = time.perf_counter()
+            window_steps += 1
+            if now - window_start >= 1.0:
+                self.steps_per_second = window_steps / (now - window_start)
+                window_start = now
+                window_steps = 0
+
+            # Выдерживаем целевую частоту, не накапливая отставание;
+            # частота может измениться на ходу
+            period = 1.0 / self.rate if self.rate else 0.0
+            if period:
+                next_step = max(next_step + period, now - period)
+                delay = next_step - now
+                if delay > 0:
+                    time.sleep(delay)
+        if profiler:
+            profiler.leave()
+
+
+class Replay:
+    """Воспроизведение записанной траектории вместо расчета.
+
+    Интерфейс совпадает с Simulation (snapshot, start, stop,
+    steps_per_second), поэтому публикация кадров не меняется. Кадр
+    читается из отображенного в память файла только когда он нужен,
+    так что стоимость воспроизведения - чтение с диска. rate - кадров
+    в секунду при скорости 1; skip - через сколько кадров шагать.
+    В stats - время чтения кадра (read_ms).
+    """
+
+    def __init__(self, trajectory, rate=30.0):
+        self.trajectory = trajectory
+        self.rate = rate
+        self.snapshot = SnapshotBuffer()
+        # Число частиц в записи постоянно: идентификаторы - номера строк
+        self.ids = np.arange(trajectory.positions.shape[1], dtype=np.int64)
+        self.frame = 0
+        self.speed = 1.0
+        self.skip = 1
+        self.paused = False
+        self.step_count = 0
+        self.steps_per_second = 0.0
+        self.stats = RollingStats()
+        self.profiler = None
+        self.running = False
+        self.thread = None
+        self._condition = threading.Condition()
+        self._pending = True  # текущий кадр еще не опубликован
+
+    def control(self, seek=None, speed=None, skip=None, paused=None):
+        """Перемотка к кадру seek, скорость, шаг по кадрам, пауза"""
+        with self._condition:
+            if seek is not None:
+                self.frame = min(max(0, int(seek)), len(self.trajectory) - 1)
+                self._pending = True
+            if speed is not None:
+                self.speed = max(0.0, float(speed))
+            if skip is not None:
+                self.skip = max(1, int(skip))
+            if paused is not None:
+                self.paused = bool(paused)
+            self._condition.notify_all()
+
+    def state(self):
+        """Положение воспроизведения для клиента"""
+        with self._condition:
+            return {'frame': self.frame, 'frames': len(self.trajectory),
+                    'speed': self.speed, 'skip': self.skip, 'paused': self.paused}
+
+    def start(self):
+        """Запуск потока воспроизведения"""
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='replay')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Остановка потока воспроизведения"""
+        self.running = False
+        with self._condition:
+            self._condition.notify_all()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout=1.0)
+        self.thread = None
+
+    def next_frame(self, next_tick):
+        """Номер кадра для публикации (или None) и время следующего кадра"""
+        last = len(self.trajectory) - 1
+        with self._condition:
+            now = time.perf_counter()
+            if self._pending:
+                self._pending = False
+                return self.frame, now
+            if self.paused or self.speed == 0 or self.frame >= last:
+                self._condition.wait(0.1)
+                return None, time.perf_counter()
+            if now < next_tick:
+                self._condition.wait(next_tick - now)
+                return None, next_tick
+            period = 1.0 / (self.rate * self.speed)
+            self.frame = min(self.frame + self.skip, last)
+            return self.frame, max(next_tick + period, now - period)
+
+    def run(self):
+        """Основной цикл воспроизведения"""
+        next_tick = time.perf_counter()
+        window_start = next_tick
+        window_frames = 0
+        profiler = self.profiler
+
+        while self.running:
+            if profiler:
+                profiler.boundary()
+            frame, next_tick = self.next_frame(next_tick)
+            if frame is not None:
+                try:
+                    with self.stats.timer('read_ms'):
+                        self.snapshot.publish(self.trajectory.positions[frame], self.ids)
+                except Exception as e:
+                    print(f"Ошибка чтения кадра {frame}: {e}")
+                    self.running = False
+                    break
+                self.step_count += 1
+                window_frames += 1
+
+            now = time.perf_counter()
+            if now - window_start >= 1.0:
+                self.steps_per_second = window_frames / (now - window_start)
+                window_start = now
+                window_frames = 0
+        if profiler:
+            profiler.leave()
@@ -0,0 +1,56 @@
+import time
+from contextlib import contextmanager
+import numpy as np
+
+# Квантили для сводки, %
+QUANTILES = (50, 95, 99)
+
+
+class RollingStats:
+    """Скользящие замеры по фазам: последние window значений каждой фазы.
+
+    Запись - одно присваивание в кольцевой массив numpy, поэтому замеры
+    можно не выключать. Каждую фазу пишет один поток; сводку можно
+    читать из другого (в худшем случае в нее попадет значение, записанное
+    во время подсчета).
+    """
+
+    def __init__(self, window=1024):
+        self.window = window
+        self._rings = {}
+        self._counts = {}
+
+    def add(self, name, value):
+        """Новое значение фазы name"""
+        ring = self._rings.get(name)
+        if ring is None:
+            ring = np.zeros(self.window)
+            self._counts[name] = 0
+            self._rings[name] = ring
+        count = self._counts[name]
+        ring[count % self.window] = value
+        self._counts[name] = count + 1
+
+    @contextmanager
+    def timer(self, name):
+        """Замер времени блока в миллисекундах"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - start) * 1000)
+
+    def summary(self, quantiles=QUANTILES):
+        """{фаза: {'p50': ..., 'p95': ..., 'p99': ..., 'max': ..., 'count': ...}}"""
+        summary = {}
+        for name, ring in list(self._rings.items()):
+            count = self._counts[name]
+            values = ring[:min(count, self.window)]
+            if not len(values):
+                continue
+            result = {f'p{q}': float(value)
+                      for q, value in zip(quantiles, np.percentile(values, quantiles))}
+            result['max'] = float(values.max())
+            result['count'] = count
+            summary[name] = result
+        return summary
@@ -0,0 +1,37 @@
+"""Запуск под mpiexec: число частиц и сумма v² по рангам на каждом шаге.
+
+Ранг 0 печатает JSON-список [N, Σv², число уникальных id] по шагам.
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from particle import MPIParticleSimulation
+
+
+def main(steps=int(sys.argv[1]) if len(sys.argv) > 1 else 30):
+    simulation = MPIParticleSimulation({'temperature': 300, 'viscosity': 1e-3, 'size': 0.03,
+                                        'mass': 1e-18, 'frequency': 6000, 'seed': 5})
+    comm = simulation.comm
+    system = simulation.create_particles()
+    # Скорости порядка размера ячейки за шаг, чтобы частицы пересекали слои
+    system.velocities[:] = system.rng.uniform(-1, 1, system.velocities.shape)
+    history = []
+    for _ in range(steps):
+        system.step(0.01)
+        simulation.decomposition.migrate(system)
+        simulation.decomposition.collide(system, simulation.boundary_width)
+        ids = comm.gather(system.ids, root=0)
+        energy = comm.reduce(float(np.sum(system.velocities ** 2)), root=0)
+        if simulation.rank == 0:
+            ids = np.concatenate(ids)
+            history.append([len(ids), energy, len(np.unique(ids))])
+    if simulation.rank == 0:
+        print(json.dumps(history))
+
+
+if __name__ == '__main__':
+    main()
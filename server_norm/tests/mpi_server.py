@@ -0,0 +1,25 @@
+"""Запуск под mpiexec: MPIParticleSimulation, обслуживающая одного клиента.
+
+Аргументы: порт и число итераций.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from particle import MPIParticleSimulation
+
+
+def main():
+    port, iterations = int(sys.argv[1]), int(sys.argv[2])
+    simulation = MPIParticleSimulation({'temperature': 300, 'viscosity': 1e-3, 'size': 0.01,
+                                        'mass': 1e-18, 'frequency': 3000, 'seed': 2})
+    try:
+        simulation.setup_server(host='127.0.0.1', port=port)
+        simulation.simulate(max_iterations=iterations)
+    finally:
+        simulation.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import asyncio
+import json
+import socket
+import threading
+import time
+import pytest
+import protocol
+from async_server import AsyncServer
+
+SETTINGS = {'temperature': 300, 'viscosity': 1e-3, 'size': 1e-6, 'mass': 1e-18,
+            'frequency': 20000, 'seed': 1}
+
+
+@pytest.fixture
+def server():
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    server = AsyncServer(host='127.0.0.1', port=port)
+    started = threading.Event()
+    state = {}
+
+    async def run():
+        # asyncio.run по выходе отменяет и задачи подписчиков
+        state['loop'] = asyncio.get_running_loop()
+        state['stop'] = asyncio.Event()
+        task = asyncio.create_task(server.serve_forever())
+        started.set()
+        await state['stop'].wait()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    thread = threading.Thread(target=asyncio.run, args=(run(),), daemon=True)
+    thread.start()
+    started.wait()
+    time.sleep(0.3)
+    yield server
+    state['loop'].call_soon_threadsafe(state['stop'].set)
+    thread.join(timeout=5)
+
+def subscribe(port, counts, key, offer=True):
+    """Подписчик в режиме ACK: считает полученные кадры"""
+    sock = socket.create_connection(('127.0.0.1', port), timeout=10)
+    settings = dict(SETTINGS, protocol=protocol.protocol_offer()) if offer else SETTINGS
+    sock.sendall(json.dumps(settings).encode())
+    try:
+        while True:
+            payload = protocol.recv_message(sock)
+            if payload is None:
+                return
+            if not protocol.is_control_message(payload):
+                counts[key] += 1
+            sock.sendall(b'ACK')
+    except OSError:
+        pass
+    finally:
+        sock.close()
+
+
+def test_json_subscriber_does_not_stall_binary_ones(server):
+    counts = {'binary': 0, 'json': 0}
+    for key, offer in (('binary', True), ('json', False)):
+        threading.Thread(target=subscribe, args=(server.port, counts, key, offer),
+                         daemon=True).start()
+    time.sleep(1.5)
+    start = dict(counts)
+    time.sleep(2.0)
+    binary = counts['binary'] - start['binary']
+    json_frames = counts['json'] - start['json']
+    assert json_frames > 0
+    # Кадр JSON из 20000 словарей кодируется ~0.1 с; двоичный формат
+    # не должен ждать его
+    assert binary > 3 * json_frames
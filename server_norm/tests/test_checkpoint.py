@@ -0,0 +1,67 @@
+import json
+import numpy as np
+import pytest
+from checkpoint import Checkpointer, load_checkpoint, save_checkpoint
+from particle import ParticleSystem
+from simulation import Simulation
+
+SETTINGS = {'temperature': 300, 'viscosity': 1e-3, 'size': 0.01, 'mass': 1e-18,
+            'frequency': 1000, 'integrator': 'brownian', 'seed': 11}
+
+
+def run(simulation, steps):
+    for _ in range(steps):
+        simulation.advance()
+
+
+@pytest.mark.parametrize('collide', [False, True])
+def test_resume_is_bit_identical(tmp_path, collide):
+    path = str(tmp_path / 'state.npz')
+    reference = Simulation(ParticleSystem.from_settings(SETTINGS), collide=collide)
+    run(reference, 20)
+    save_checkpoint(path, reference.capture())
+    run(reference, 30)
+
+    resumed = Simulation.resume(path, collide=collide)
+    assert resumed.step_count == 20 and resumed.dt == reference.dt
+    run(resumed, 30)
+    for name in ('positions', 'velocities', 'radii', 'masses', 'ids'):
+        np.testing.assert_array_equal(getattr(resumed.system, name),
+                                      getattr(reference.system, name))
+    assert resumed.system.next_id == reference.system.next_id
+
+
+def test_checkpoint_keeps_resized_system(tmp_path):
+    path = str(tmp_path / 'state.npz')
+    system = ParticleSystem.from_settings(SETTINGS)
+    system.update(count=1200, temperature=600)
+    save_checkpoint(path, dict(system.state(), step=3, dt=0.01))
+    loaded, step, dt = load_checkpoint(path)
+    assert (step, dt, len(loaded), loaded.temperature) == (3, 0.01, 1200, 600)
+    np.testing.assert_array_equal(loaded.ids, system.ids)
+
+
+def test_checkpointer_writes_latest_state_in_background(tmp_path):
+    path = str(tmp_path / 'state.npz')
+    simulation = Simulation(ParticleSystem.from_settings(SETTINGS))
+    checkpointer = Checkpointer(path)
+    for _ in range(5):
+        simulation.advance()
+        checkpointer.submit(simulation.capture())
+    checkpointer.close()
+    assert checkpointer.last_step == 5
+    assert load_checkpoint(path)[1] == 5
+    assert not (tmp_path / 'state.npz.tmp').exists()
+
+
+def test_newer_checkpoint_version_is_rejected(tmp_path):
+    path = str(tmp_path / 'state.npz')
+    state = dict(ParticleSystem.from_settings(SETTINGS).state(), step=0, dt=0.01)
+    save_checkpoint(path, state)
+    with np.load(path) as data:
+        arrays = {key: data[key] for key in data.files}
+    meta = json.loads(str(arrays['meta']))
+    arrays['meta'] = np.array(json.dumps(dict(meta, version=meta['version'] + 1)))
+    np.savez(path, **arrays)
+    with pytest.raises(ValueError):
+        load_checkpoint(path)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from particle import ParticleSystem, find_collision_pairs, select_disjoint_pairs
+
+
+def brute_force_pairs(positions, radii):
+    """Все пары i < j с расстоянием меньше суммы радиусов, перебором O(N²)"""
+    delta = positions[:, None, :] - positions[None, :, :]
+    distances = np.sqrt((delta ** 2).sum(axis=2))
+    reach = radii[:, None] + radii[None, :]
+    i, j = np.nonzero(np.triu(distances < reach, k=1))
+    return np.stack([i, j], axis=1)
+
+
+@pytest.mark.parametrize('count, radius', [(2, 0.6), (50, 0.1), (800, 0.02), (2000, 0.005)])
+def test_cell_list_matches_brute_force(count, radius):
+    rng = np.random.default_rng(count)
+    positions = rng.random((count, 3))
+    radii = rng.uniform(0.5, 1.0, count) * radius
+    np.testing.assert_array_equal(find_collision_pairs(positions, radii),
+                                  brute_force_pairs(positions, radii))
+
+
+def test_clustered_particles_match_brute_force():
+    # Частицы в углу куба: сетка строится по их ограничивающему прямоугольнику
+    rng = np.random.default_rng(3)
+    positions = rng.random((600, 3)) * 0.05
+    radii = np.full(600, 0.002)
+    np.testing.assert_array_equal(find_collision_pairs(positions, radii),
+                                  brute_force_pairs(positions, radii))
+
+
+def test_disjoint_pairs_use_each_particle_once():
+    rng = np.random.default_rng(4)
+    positions = rng.random((1000, 3))
+    pairs = find_collision_pairs(positions, np.full(1000, 0.03))
+    selected = select_disjoint_pairs(pairs, positions)
+    assert len(np.unique(selected)) == selected.size
+    # Выбор не зависит от порядка входных пар
+    shuffled = pairs[rng.permutation(len(pairs))]
+    np.testing.assert_array_equal(select_disjoint_pairs(shuffled, positions), selected)
+    # Оставшиеся пары задевают хотя бы одну выбранную частицу
+    used = np.zeros(1000, dtype=bool)
+    used[selected.ravel()] = True
+    assert (used[pairs[:, 0]] | used[pairs[:, 1]]).all()
+
+
+def test_collide_swaps_velocities_and_conserves_energy():
+    system = ParticleSystem.from_settings({'temperature': 300, 'viscosity': 1e-3, 'size': 0.02,
+                                           'mass': 1e-18, 'frequency': 1500, 'seed': 1})
+    before = system.velocities.copy()
+    pairs = system.collide()
+    assert len(pairs)
+    np.testing.assert_array_equal(system.velocities[pairs[:, 0]], before[pairs[:, 1]])
+    np.testing.assert_array_equal(system.velocities[pairs[:, 1]], before[pairs[:, 0]])
+    assert np.sum(system.velocities ** 2) == pytest.approx(np.sum(before ** 2), rel=1e-12)
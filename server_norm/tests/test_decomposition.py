@@ -0,0 +1,79 @@
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+import numpy as np
+import pytest
+import protocol
+
+pytest.importorskip('mpi4py')
+MPIEXEC = shutil.which('mpiexec') or shutil.which('mpirun')
+TESTS = os.path.dirname(os.path.abspath(__file__))
+
+
+def mpi_command(count, script, *args):
+    command = [MPIEXEC, '-n', str(count), sys.executable, os.path.join(TESTS, script)]
+    if os.geteuid() == 0:
+        command[1:1] = ['--allow-run-as-root', '--oversubscribe']
+    return command + [str(arg) for arg in args]
+
+
+def run_ranks(count, steps=30):
+    """История [N, Σv², уникальных id] по шагам для count рангов"""
+    command = mpi_command(count, 'mpi_conservation.py', steps)
+    completed = subprocess.run(command, capture_output=True, text=True, timeout=300, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+@pytest.mark.skipif(MPIEXEC is None, reason="нет mpiexec")
+@pytest.mark.parametrize('ranks', [1, 4])
+def test_particles_and_energy_conserved_across_slabs(ranks):
+    history = run_ranks(ranks)
+    count, energy, unique = history[0]
+    assert unique == count == 6000
+    for step_count, step_energy, step_unique in history:
+        assert step_count == step_unique == count
+        assert step_energy == pytest.approx(energy, rel=1e-12)
+
+
+@pytest.mark.skipif(MPIEXEC is None, reason="нет mpiexec")
+def test_gathered_frames_are_sent_as_binary():
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    server = subprocess.Popen(mpi_command(2, 'mpi_server.py', port, 20),
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    try:
+        for _ in range(300):
+            try:
+                sock = socket.create_connection(('127.0.0.1', port), timeout=10)
+                break
+            except OSError:
+                time.sleep(0.05)
+        offer = protocol.protocol_offer(frame={'dtype': 'uint16'})
+        sock.sendall(json.dumps({'protocol': offer}).encode())
+        hello = protocol.recv_control(sock)
+        assert hello['encoding'] == protocol.ENCODING_BINARY
+        assert hello['flow']['mode'] == protocol.FLOW_ACK
+
+        decoder = protocol.FrameDecoder()
+        frames = 0
+        while True:
+            payload = protocol.recv_message(sock)
+            if payload is None:
+                break
+            frame = decoder.decode(payload)
+            assert frame.positions.shape == (3000, 3)
+            assert np.all((frame.positions >= 0) & (frame.positions <= 1))
+            frames += 1
+            sock.sendall(b'ACK')
+        sock.close()
+        output = server.communicate(timeout=60)[0]
+    finally:
+        server.kill()
+    assert frames == 20
+    assert 'gather_ms p50' in output
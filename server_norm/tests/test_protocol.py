@@ -0,0 +1,218 @@
+import json
+import socket
+import threading
+import time
+import numpy as np
+import pytest
+import protocol
+from client import NO_MESSAGE, Client
+
+
+def send_frames(frames, encoder):
+    """Кадры через socketpair и Client.receive_message: декодированные координаты"""
+    server, client_socket = socket.socketpair()
+    client = Client()
+    client.client_socket = client_socket
+    decoder = protocol.FrameDecoder()
+    decoded = []
+    try:
+        for seq, positions in enumerate(frames):
+            protocol.send_message(server, encoder.encode(seq, positions))
+            message = client.receive_message()
+            decoded.append(decoder.decode(message).positions.copy())
+    finally:
+        server.close()
+        client_socket.close()
+    return decoded
+
+
+def test_delta_reference_survives_receive_buffer_reuse():
+    # Несжатые квантованные дельты: опорный кадр не должен ссылаться на
+    # буфер приема, который перезаписывает следующее сообщение
+    rng = np.random.default_rng(0)
+    frames = [rng.random((500, 3), dtype=np.float32)]
+    for _ in range(3):
+        frames.append(np.clip(frames[-1] + rng.normal(0, 1e-3, (500, 3)), 0, 1)
+                      .astype(np.float32))
+    encoder = protocol.FrameEncoder(dtype='uint16', keyframe_interval=30)
+    for expected, positions in zip(frames, send_frames(frames, encoder)):
+        np.testing.assert_allclose(positions, expected, atol=1e-4)
+
+
+@pytest.fixture
+def receiver():
+    server, client_socket = socket.socketpair()
+    client = Client()
+    client.client_socket = client_socket
+    client_socket.settimeout(0.2)
+    client.running = True
+    yield server, client
+    server.close()
+    client_socket.close()
+
+
+def test_stalled_frame_does_not_close_connection(receiver):
+    server, client = receiver
+    payload = protocol.encode_frame(1, np.ones((1000, 3), dtype=np.float32))
+    message = len(payload).to_bytes(4, byteorder='big') + payload
+
+    def send():
+        server.sendall(message[:100])
+        # Пауза внутри кадра дольше таймаута чтения
+        time.sleep(0.5)
+        server.sendall(message[100:])
+
+    sender = threading.Thread(target=send)
+    sender.start()
+    data = client.receive_message()
+    sender.join()
+    assert bytes(data) == payload
+
+
+def test_empty_message_timeout_and_eof_are_distinct(receiver):
+    server, client = receiver
+    assert client.receive_message() is NO_MESSAGE
+    protocol.send_message(server, b'')
+    data = client.receive_message()
+    assert data is not None and data is not NO_MESSAGE and len(data) == 0
+    server.close()
+    assert client.receive_message() is None
+
+
+def test_detach_frame_copies_every_array(receiver):
+    server, client = receiver
+    positions = np.full((10, 3), 0.5, dtype=np.float32)
+    velocities = np.ones((10, 3), dtype=np.float32)
+    protocol.send_message(server, protocol.encode_frame(1, positions, velocities))
+    frame = protocol.detach_frame(client.decode_frame(client.receive_message()))
+    protocol.send_message(server, protocol.encode_frame(2, positions * 0, velocities * 0))
+    client.receive_message()
+    np.testing.assert_array_equal(frame.positions, positions)
+    np.testing.assert_array_equal(frame.velocities, velocities)
+
+
+def test_float32_frame_round_trip():
+    rng = np.random.default_rng(1)
+    positions = rng.random((300, 3)).astype(np.float32)
+    velocities = rng.normal(size=(300, 3)).astype(np.float32)
+    frame = protocol.decode_frame(protocol.FrameEncoder().encode(5, positions, velocities,
+                                                                 total=1000))
+    assert frame.seq == 5 and frame.total == 1000
+    np.testing.assert_array_equal(frame.positions, positions)
+    np.testing.assert_array_equal(frame.velocities, velocities)
+
+
+def test_version_1_frame_is_still_decoded():
+    positions = np.arange(12, dtype=np.float32).reshape(4, 3) / 12
+    payload = protocol.FRAME_HEADER_V1.pack(protocol.FRAME_MAGIC, 1, 0, protocol.DTYPE_FLOAT32,
+                          protocol.FIELD_POSITIONS, 9, 4) + positions.tobytes()
+    frame = protocol.decode_frame(payload)
+    assert frame.seq == 9 and frame.total == 4
+    np.testing.assert_array_equal(frame.positions, positions)
+
+
+def test_corrupt_frames_are_rejected():
+    payload = protocol.encode_frame(1, np.zeros((4, 3), dtype=np.float32))
+    with pytest.raises(ValueError):
+        protocol.decode_frame(b'XXXX' + payload[4:])
+    with pytest.raises(ValueError):
+        protocol.decode_frame(payload[:-4])
+
+
+def test_negotiation_falls_back_for_old_clients():
+    assert protocol.choose_encoding({'temperature': 300}) == protocol.ENCODING_JSON
+    assert protocol.choose_flow({}) == (protocol.FLOW_ACK, 0)
+    offer = protocol.protocol_offer(flow={'mode': protocol.FLOW_CREDIT, 'window': 3})
+    assert protocol.choose_encoding({'protocol': offer}) == protocol.ENCODING_BINARY
+    assert protocol.choose_flow({'protocol': offer}) == (protocol.FLOW_CREDIT, 3)
+
+
+
+def send_in_pieces(sock, data, size=700, pause=0.01):
+    """Отправка data кусками с паузами: каждый кусок - отдельный пакет"""
+    def send():
+        for start in range(0, len(data), size):
+            sock.sendall(data[start:start + size])
+            time.sleep(pause)
+    sender = threading.Thread(target=send)
+    sender.start()
+    return sender
+
+
+@pytest.mark.parametrize('prefixed', [True, False])
+def test_long_settings_split_across_packets(prefixed):
+    server, client_socket = socket.socketpair()
+    offer = protocol.protocol_offer(flow={'mode': protocol.FLOW_ACK, 'window': 0})
+    settings = {'temperature': 300, 'protocol': offer, 'comment': 'x' * 5000}
+    payload = json.dumps(settings).encode()
+    if prefixed:
+        payload = len(payload).to_bytes(4, byteorder='big') + payload
+    sender = send_in_pieces(client_socket, payload)
+    assert protocol.recv_settings(server) == settings
+    sender.join()
+    server.close()
+    client_socket.close()
+
+
+def test_ack_replies_are_read_exactly():
+    server, client_socket = socket.socketpair()
+    command = {'type': 'profile', 'action': 'start', 'note': 'y' * 3000}
+    payload = json.dumps(command).encode()
+    replies = b'ACK' + len(payload).to_bytes(4, byteorder='big') + payload + b'ACK'
+    sender = send_in_pieces(client_socket, replies, size=5, pause=0.001)
+    assert protocol.read_ack_reply(server) is None
+    assert protocol.read_ack_reply(server) == command
+    assert protocol.read_ack_reply(server) is None
+    sender.join()
+    client_socket.sendall(b'STOP')
+    with pytest.raises(ConnectionError):
+        protocol.read_ack_reply(server)
+    client_socket.close()
+    with pytest.raises(ConnectionError):
+        protocol.read_ack_reply(server)
+    server.close()
+
+
+def moving_frames(count=6, size=400, seed=2):
+    """Кадры с малыми смещениями частиц, как у работающей симуляции"""
+    rng = np.random.default_rng(seed)
+    frames = [rng.random((size, 3), dtype=np.float32)]
+    for _ in range(count - 1):
+        frames.append(np.clip(frames[-1] + rng.normal(0, 2e-3, (size, 3)), 0, 1)
+                      .astype(np.float32))
+    return frames
+
+
+@pytest.mark.parametrize('dtype', ['uint16', 'uint8'])
+@pytest.mark.parametrize('compress', [False, True])
+@pytest.mark.parametrize('keyframe_interval', [0, 2])
+def test_quantized_frames_round_trip(dtype, compress, keyframe_interval):
+    encoder = protocol.FrameEncoder(dtype=dtype, compress=compress,
+                                    keyframe_interval=keyframe_interval)
+    decoder = protocol.FrameDecoder()
+    step = 1 / protocol.QUANT_SCALE[protocol.DTYPE_NAMES[dtype]]
+    deltas = 0
+    for seq, positions in enumerate(moving_frames()):
+        payload = encoder.encode(seq, positions)
+        _, _, flags, *_ = protocol.FRAME_HEADER.unpack_from(payload)
+        deltas += bool(flags & protocol.FLAG_DELTA)
+        frame = decoder.decode(payload)
+        assert frame.positions.dtype == np.float32
+        np.testing.assert_allclose(frame.positions, positions, atol=step / 2 + 1e-6)
+    # С интервалом 2: опорный кадр, затем по две разности
+    assert deltas == (4 if keyframe_interval else 0)
+
+
+def test_delta_frame_without_keyframe_is_rejected():
+    encoder = protocol.FrameEncoder(dtype='uint16', keyframe_interval=5)
+    first, second = moving_frames(2)
+    encoder.encode(0, first)
+    with pytest.raises(ValueError):
+        protocol.FrameDecoder().decode(encoder.encode(1, second))
+
+
+def test_zigzag_round_trip():
+    delta = np.array([0, 1, 65535, 2, 65534, 32767, 32768], dtype=np.uint16)
+    codes = protocol.zigzag_encode(delta)
+    assert list(codes[:5]) == [0, 2, 1, 4, 3]
+    np.testing.assert_array_equal(protocol.zigzag_decode(codes), delta)
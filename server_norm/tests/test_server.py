@@ -0,0 +1,112 @@
+import json
+import socket
+import threading
+import time
+import pytest
+import protocol
+from server import Server
+
+SETTINGS = {'temperature': 300, 'viscosity': 1e-3, 'size': 1e-3, 'mass': 1e-18,
+            'frequency': 200, 'seed': 1}
+
+
+@pytest.fixture
+def server():
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    server = Server(host='127.0.0.1', port=port)
+    threading.Thread(target=server.start, daemon=True).start()
+    for _ in range(100):
+        if server.server_socket is not None:
+            break
+        time.sleep(0.01)
+    yield server
+    server.close()
+
+
+def connect(server, flow=protocol.FLOW_CREDIT):
+    """Клиент в режиме кредитов (или ACK): сокет после ответа 'hello'"""
+    sock = socket.create_connection((server.host, server.port), timeout=5)
+    offer = protocol.protocol_offer(flow={'mode': flow, 'window': 4})
+    protocol.send_control(sock, dict(SETTINGS, protocol=offer))
+    while True:
+        message = protocol.recv_control(sock)
+        if message and message.get('type') == 'hello':
+            return sock
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_new_client_disconnects_previous_one(server):
+    old = connect(server)
+    assert wait_for(lambda: server.simulation is not None and server.simulation.running)
+    old_reader = server.control_thread
+    old_simulation = server.simulation
+
+    new = connect(server)
+    assert wait_for(lambda: server.simulation is not old_simulation
+                    and server.simulation.running)
+    assert not old_reader.is_alive()
+    simulation = server.simulation
+
+    # Сообщения прежнего клиента больше не доходят до сервера
+    try:
+        protocol.send_control(old, {'type': 'stop'})
+    except OSError:
+        pass
+    time.sleep(0.2)
+    assert server.simulation is simulation and simulation.running
+    old.close()
+    new.close()
+
+
+def test_profile_command_in_ack_mode(server, tmp_path):
+    server.profiler.directory = str(tmp_path)
+    sock = connect(server, flow=protocol.FLOW_ACK)
+    replies = [{'type': 'profile', 'action': 'start'}, None, None,
+               {'type': 'profile', 'action': 'stop', 'top': 5}]
+    profiles = None
+    for _ in range(50):
+        payload = protocol.recv_message(sock)
+        if protocol.is_control_message(payload):
+            message = json.loads(payload)
+            if message['type'] == 'profile':
+                profiles = message['profiles']
+                break
+            continue
+        # Команда отправляется вместо ACK на кадр
+        reply = replies.pop(0) if replies else None
+        if reply:
+            protocol.send_control(sock, reply)
+        else:
+            sock.sendall(b'ACK')
+    sock.close()
+    assert profiles and profiles[0]['file'].startswith(str(tmp_path))
+    assert 'publisher' in profiles[0]['threads']
+
+
+def test_stats_reach_ack_mode_clients(server):
+    server.stats_interval = 0.2
+    sock = connect(server, flow=protocol.FLOW_ACK)
+    stats = None
+    for _ in range(200):
+        payload = protocol.recv_message(sock)
+        if protocol.is_control_message(payload):
+            message = json.loads(payload)
+            if message['type'] == 'stats' and 'ack_wait_ms' in message['phases']:
+                stats = message
+                break
+            continue
+        sock.sendall(b'ACK')
+    sock.close()
+    assert stats and stats['flow'] == protocol.FLOW_ACK
+    assert stats['frames_per_second'] > 0
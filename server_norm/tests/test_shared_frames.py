@@ -0,0 +1,88 @@
+import os
+import subprocess
+import sys
+import numpy as np
+import protocol
+from shared_frames import MIN_CAPACITY, SharedFrameMailbox, SharedFrameRing
+
+
+def test_ring_keeps_latest_frame():
+    ring = SharedFrameRing.create(0)
+    try:
+        assert ring.read() is None
+        for number in range(1, 6):
+            assert ring.write(bytes([number]) * 10)
+        assert ring.read() == (5, bytes([5]) * 10)
+        assert ring.read(newer_than=5) is None
+        assert not ring.write(b'x' * (MIN_CAPACITY + 1))
+    finally:
+        ring.close()
+
+
+def test_mailbox_decodes_frames_and_counts_drops():
+    ring = SharedFrameRing.create(0)
+    mailbox = SharedFrameMailbox(ring.name)
+    try:
+        encoder = protocol.FrameEncoder()
+        positions = np.random.default_rng(0).random((100, 3), dtype=np.float32)
+        for seq in range(1, 4):
+            ring.write(encoder.encode(seq, positions))
+        frame = mailbox.take()
+        np.testing.assert_array_equal(frame.positions, positions)
+        assert frame.seq == 3 and mailbox.received == 3 and mailbox.dropped == 2
+        assert mailbox.take() is None
+    finally:
+        mailbox.close()
+        ring.close()
+
+
+def test_reader_in_writer_process_leaves_tracker_quiet():
+    # Писатель и читатель в одном процессе (GUI и сервер в одном
+    # интерпретаторе): трекер ресурсов не должен сообщать об ошибках
+    code = ("from shared_frames import SharedFrameRing\n"
+            "ring = SharedFrameRing.create(0)\n"
+            "reader = SharedFrameRing.attach(ring.name)\n"
+            "reader.close()\n"
+            "ring.close()\n")
+    completed = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               timeout=60)
+    assert completed.returncode == 0
+    assert 'Traceback' not in completed.stderr
+
+
+def test_mailbox_frames_survive_slot_reuse():
+    ring = SharedFrameRing.create(0)
+    mailbox = SharedFrameMailbox(ring.name)
+    try:
+        encoder = protocol.FrameEncoder()
+        positions = np.full((50, 3), 0.25, dtype=np.float32)
+        ring.write(encoder.encode(1, positions, positions))
+        frame = mailbox.take()
+        assert frame.positions.flags.owndata and frame.velocities.flags.owndata
+        # Тот же слот снова через ring.slots кадров
+        for seq in range(2, 2 + ring.slots):
+            ring.write(encoder.encode(seq, positions * 0, positions * 0))
+        np.testing.assert_array_equal(frame.positions, positions)
+        np.testing.assert_array_equal(frame.velocities, positions)
+    finally:
+        mailbox.close()
+        ring.close()
+
+
+def test_read_rejects_slot_rewritten_while_decoding():
+    ring = SharedFrameRing.create(0)
+    try:
+        ring.write(b'first')
+
+        def decode(payload):
+            # Писатель успевает пройти все кольцо, пока читатель разбирает слот
+            if ring.latest == 1:
+                for _ in range(ring.slots):
+                    ring.write(b'later')
+                raise ValueError("разорванный кадр")
+            return bytes(payload)
+
+        assert ring.read(decode=decode) == (1 + ring.slots, b'later')
+    finally:
+        ring.close()
@@ -0,0 +1,154 @@
+import multiprocessing
+import socket
+import threading
+import time
+import numpy as np
+import pytest
+import protocol
+from particle import K_B, ParticleSystem
+from sessions import Session, SessionSubscriber
+from simulation import Simulation, hot_changes
+
+SETTINGS = {'temperature': 300, 'viscosity': 1e-3, 'size': 1e-3, 'mass': 1e-18,
+            'frequency': 2000, 'seed': 7}
+
+
+def temperature(system):
+    return float((system.masses[:, None] * system.velocities ** 2).mean() / K_B)
+
+
+def test_hot_changes():
+    assert hot_changes(SETTINGS, dict(SETTINGS)) == {}
+    assert hot_changes(SETTINGS, dict(SETTINGS, temperature=600, frequency=10)) == \
+        {'temperature': 600, 'frequency': 10}
+    assert hot_changes(SETTINGS, dict(SETTINGS, seed=8)) is None
+    assert hot_changes(SETTINGS, dict(SETTINGS, replay='run.npy')) is None
+
+
+def test_update_rescales_temperature_and_keeps_particles():
+    system = ParticleSystem.from_settings(SETTINGS)
+    positions, ids = system.positions.copy(), system.ids.copy()
+    before = temperature(system)
+    system.update(temperature=1200)
+    assert temperature(system) == pytest.approx(before * 4)
+    np.testing.assert_array_equal(system.positions, positions)
+    np.testing.assert_array_equal(system.ids, ids)
+
+
+def test_update_resizes_by_difference():
+    system = ParticleSystem.from_settings(SETTINGS)
+    ids = system.ids.copy()
+    system.update(count=1500)
+    assert len(system) == 1500
+    assert np.isin(system.ids, ids).all()
+
+    kept = system.ids.copy()
+    system.update(count=2500)
+    assert len(system) == 2500
+    assert np.isin(kept, system.ids).all()
+    assert len(np.unique(system.ids)) == 2500
+    assert system.radii[-1] == SETTINGS['size']
+
+
+def test_update_viscosity_and_size_refresh_sigma():
+    system = ParticleSystem.from_settings(dict(SETTINGS, integrator='brownian'))
+    system.step(0.01)
+    sigma = system._sigma.copy()
+    system.update(viscosity=4e-3)
+    system.step(0.01)
+    np.testing.assert_allclose(system._sigma, sigma / 2)
+    system.update(radius=4e-3)
+    system.step(0.01)
+    np.testing.assert_allclose(system._sigma, sigma / 4)
+
+
+def test_particle_view_cannot_change_the_medium():
+    system = ParticleSystem.from_settings(SETTINGS)
+    particle = system[0]
+    assert particle.temperature == system.temperature
+    with pytest.raises(AttributeError):
+        particle.temperature = 600
+    with pytest.raises(AttributeError):
+        particle.viscosity = 2e-3
+    assert system.temperature == SETTINGS['temperature']
+    assert system.viscosity == SETTINGS['viscosity']
+
+def test_update_mass_keeps_temperature():
+    system = ParticleSystem.from_settings(SETTINGS)
+    before = temperature(system)
+    system.update(mass=4e-18)
+    assert temperature(system) == pytest.approx(before)
+
+
+def test_simulation_applies_update_between_steps():
+    simulation = Simulation(ParticleSystem.from_settings(SETTINGS), rate=0)
+    simulation.advance()
+    simulation.update({'frequency': 1000, 'step_rate': 50, 'collisions': True})
+    assert len(simulation.system) == 2000
+    simulation.advance()
+    assert len(simulation.system) == 1000
+    assert simulation.rate == 50 and simulation.collide
+    assert len(simulation.snapshot.acquire().positions) == 1000
+
+
+class Collector:
+    """Подписчик сессии, который только запоминает кадры"""
+
+    def __init__(self):
+        self.frames = []
+        self.condition = threading.Condition()
+
+    def offer(self, data):
+        with self.condition:
+            self.frames.append(protocol.decode_frame(data))
+            self.condition.notify_all()
+
+    def wait(self, condition, timeout=30):
+        with self.condition:
+            return self.condition.wait_for(lambda: condition(self.frames), timeout)
+
+
+def test_session_update_keeps_process_and_stream():
+    session = Session('test', dict(SETTINGS), protocol.ENCODING_BINARY, {}, None,
+                      protocol.parse_render(None), multiprocessing.get_context('spawn'))
+    collector = Collector()
+    session.attach(collector)
+    session.start()
+    try:
+        assert collector.wait(lambda frames: frames)
+        process = session.process
+        session.update(dict(SETTINGS, frequency=1000, temperature=600))
+        assert collector.wait(lambda frames: frames[-1].total == 1000)
+        assert session.process is process and process.is_alive()
+        # Кадры идут и после изменения, без перезапуска
+        count = len(collector.frames)
+        assert collector.wait(lambda frames: len(frames) > count + 5)
+    finally:
+        session.stop()
+
+
+def test_ack_subscriber_routes_control_replies():
+    server, client = socket.socketpair()
+    client.settimeout(5)
+    received = []
+    subscriber = SessionSubscriber(server, protocol.FLOW_ACK, 0,
+                                   lambda message: received.append(message) or True)
+    sender = threading.Thread(target=subscriber.run)
+    sender.start()
+
+    # Настройки вместо ACK не теряются и сами служат подтверждением кадра
+    subscriber.offer(b'frame-1')
+    assert protocol.recv_message(client) == b'frame-1'
+    update = {'type': 'update', 'settings': {'temperature': 400}}
+    protocol.send_control(client, update)
+    subscriber.offer(b'frame-2')
+    assert protocol.recv_message(client) == b'frame-2'
+    client.sendall(b'ACK')
+    subscriber.offer(b'frame-3')
+    assert protocol.recv_message(client) == b'frame-3'
+    assert received == [update]
+
+    client.close()
+    sender.join(timeout=5)
+    assert not sender.is_alive()
+    server.close()
@@ -0,0 +1,82 @@
+import json
+import numpy as np
+
+# Файлы траектории с общим префиксом:
+#   <prefix>.json           - настройки, шаг по времени, число кадров
+#   <prefix>.positions.npy  - координаты (frames, N, 3)
+#   <prefix>.velocities.npy - скорости (frames, N, 3), если записывались
+POSITIONS_SUFFIX = '.positions.npy'
+VELOCITIES_SUFFIX = '.velocities.npy'
+METADATA_SUFFIX = '.json'
+
+
+class TrajectoryWriter:
+    """Запись траектории в заранее выделенные файлы .npy через np.memmap.
+
+    Кадр копируется из массивов ParticleSystem прямо в отображенную
+    память файла, без промежуточных объектов Python; сброс на диск
+    выполняет ОС (и flush/close).
+    """
+
+    def __init__(self, prefix, frames, count, velocities=False, dtype=np.float32,
+                 metadata=None):
+        self.prefix = prefix
+        self.frames = frames
+        self.written = 0
+        self.metadata = dict(metadata or {})
+        self.positions = np.lib.format.open_memmap(
+            prefix + POSITIONS_SUFFIX, mode='w+', dtype=dtype, shape=(frames, count, 3))
+        self.velocities = None
+        if velocities:
+            self.velocities = np.lib.format.open_memmap(
+                prefix + VELOCITIES_SUFFIX, mode='w+', dtype=dtype, shape=(frames, count, 3))
+
+    def write(self, system):
+        """Запись текущего состояния системы следующим кадром"""
+        if self.written >= self.frames:
+            raise ValueError(f"Траектория заполнена: {self.frames} кадров")
+        if len(system) != self.positions.shape[1]:
+            raise ValueError("Число частиц не совпадает с размером траектории")
+        np.copyto(self.positions[self.written], system.positions, casting='same_kind')
+        if self.velocities is not None:
+            np.copyto(self.velocities[self.written], system.velocities, casting='same_kind')
+        self.written += 1
+
+    def flush(self):
+        self.positions.flush()
+        if self.velocities is not None:
+            self.velocities.flush()
+
+    def close(self):
+        """Сброс данных и запись метаданных (число фактически записанных кадров)"""
+        self.flush()
+        metadata = dict(self.metadata, frames=self.written,
+                        particles=self.positions.shape[1],
+                        dtype=self.positions.dtype.name,
+                        velocities=self.velocities is not None)
+        with open(self.prefix + METADATA_SUFFIX, 'w', encoding='utf-8') as file:
+            json.dump(metadata, file, ensure_ascii=False, indent=4)
+        self.positions = self.velocities = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Trajectory:
+    """Записанная траектория, отображенная в память только для чтения"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        with open(prefix + METADATA_SUFFIX, encoding='utf-8') as file:
+            self.metadata = json.load(file)
+        frames = self.metadata['frames']
+        self.positions = np.load(prefix + POSITIONS_SUFFIX, mmap_mode='r')[:frames]
+        self.velocities = None
+        if self.metadata.get('velocities'):
+            self.velocities = np.load(prefix + VELOCITIES_SUFFIX, mmap_mode='r')[:frames]
+
+    def __len__(self):
+        return len(self.positions)